@@ -1,48 +1,34 @@
 
 import os
+import shutil
 
 import pandas as pd
 import numpy as np
 
 from itertools import product, combinations
+from concurrent.futures import ThreadPoolExecutor
 
-from graphpype.utils_stats import (compute_oneway_anova_fwe,
-                                   compute_pairwise_ttest_fdr)
-from graphpype.utils_cor import return_corres_correl_mat
+from graphpype.utils_stats import (group_edge_moments, paired_edge_moments,
+                                   compute_oneway_anova_fwe_from_moments,
+                                   compute_pairwise_ttest_fdr_from_moments)
+from graphpype.utils_cor import _scatter_corres_mat
+from graphpype.utils_dtype_coord import where_in_coords
+from graphpype.utils_condensed import (triu_indices, condense_sym_mat,
+                                       append_edge_store)
 
 
 def isInAlphabeticalOrder(word):
     return list(word) == sorted(word)
 
 
-def return_all_iter_cormats(cormat_path, iterables, iternames,
-                            gm_mask_coords_file=0, gm_mask_labels_file=0,
-                            mapflow_iterables=0, mapflow_iternames=0,
-                            export_df=False):
-    """
-    gm_mask_coords_file is the coords commun to all analyses
-    """
-    print(product(*iterables))
-
-    all_iter_cormats = []
+def _return_iter_cormat_files(cormat_path, iterables, iternames,
+                              mapflow_iterables=0):
+    """descriptors, cormat files and coords files of all iterations"""
     all_descriptors = []
-
-    assert isInAlphabeticalOrder(iternames), \
-        ("Warning, iternames are not in alphabetical oroder, check the \
-         iterables order as well")
-
-    if gm_mask_coords_file != 0:
-        gm_mask_coords = np.loadtxt(gm_mask_coords_file)
-
-        print(gm_mask_coords)
-
-    if export_df:
-        writer = pd.ExcelWriter(os.path.join(cormat_path, "all_cormats.xls"))
+    all_files = []
 
     for iter_obj in product(*iterables):
 
-        print(iter_obj)
-
         assert len(iter_obj) == len(
             iternames), "Error, different number of iternames and iterables"
 
@@ -50,7 +36,9 @@ def return_all_iter_cormats(cormat_path, iterables, iternames,
                            zip_iter[1].strip() for zip_iter in zip(iternames,
                                                                    iter_obj)])
 
-        print(iter_dir)
+        coords_file = os.path.join(
+            cormat_path, iter_dir, "extract_mean_ROI_ts",
+            "subj_coord_rois.txt")
 
         if mapflow_iterables == 0:
 
@@ -58,35 +46,8 @@ def return_all_iter_cormats(cormat_path, iterables, iternames,
                 cormat_path, iter_dir, "compute_conf_cor_mat",
                 "Z_cor_mat_resid_ts.npy")
 
-            assert os.path.exists(cormat_file), \
-                ("Warning, file {} could not be found".format(cormat_file))
-
-            cormat = np.load(cormat_file)
-            print(cormat.shape)
-
-            if gm_mask_coords_file != 0:
-                coords_file = os.path.join(
-                    cormat_path, iter_dir, "extract_mean_ROI_ts",
-                    "subj_coord_rois.txt")
-
-                coords = np.loadtxt(coords_file)
-
-                cormat, _ = return_corres_correl_mat(
-                    cormat, coords, gm_mask_coords)
-
-            if export_df:
-                if gm_mask_labels_file:
-                    labels = [line.strip()
-                              for line in open(gm_mask_labels_file)]
-                else:
-                    labels = list(range(cormat.shape[0]))
-
-                df = pd.DataFrame(cormat, columns=labels, index=labels)
-
-                df.to_excel(writer, "_".join(iter_obj))
-
-            all_iter_cormats.append(cormat)
             all_descriptors.append(iter_obj)
+            all_files.append((cormat_file, coords_file))
 
         else:
             for i, map_iter in enumerate(mapflow_iterables):
@@ -97,59 +58,160 @@ def return_all_iter_cormats(cormat_path, iterables, iternames,
                                            "_compute_conf_cor_mat"+str(i),
                                            "Z_cor_mat_resid_ts.npy")
 
-                new_iter_obj = list(iter_obj)
+                all_descriptors.append(list(iter_obj) + [str(map_iter)])
+                all_files.append((cormat_file, coords_file))
+
+    return all_descriptors, all_files
+
+
+def _export_all_iter_cormats(cormat_path, all_iter_cormats,
+                             pd_all_descriptors, gm_mask_labels_file=0):
+    """
+    export all matrices as an edge store (one row per iteration, one
+    column per pair of labels), and the descriptors as csv
+    """
+    if gm_mask_labels_file:
+        labels = [line.strip() for line in open(gm_mask_labels_file)]
+    else:
+        labels = [str(i) for i in range(all_iter_cormats.shape[1])]
 
-                new_iter_obj.append(str(map_iter))
+    triu_i, triu_j = triu_indices(len(labels), k=1)
+    pair_labels = [labels[i] + "_" + labels[j]
+                   for i, j in zip(triu_i.tolist(), triu_j.tolist())]
 
-                assert os.path.exists(cormat_file), \
-                    ("Warning, file {} could not be found".format(cormat_file))
+    store_dir = os.path.join(cormat_path, "all_cormats")
 
-                cormat = np.load(cormat_file)
+    # overwritten, as the excel files were before
+    if os.path.exists(store_dir):
+        shutil.rmtree(store_dir)
 
-                if gm_mask_coords_file:
-                    coords_file = os.path.join(
-                        cormat_path, iter_dir, "extract_mean_ROI_ts",
-                        "subj_coord_rois.txt")
+    append_edge_store(store_dir, condense_sym_mat(all_iter_cormats),
+                      pd_all_descriptors, edge_labels=pair_labels)
 
-                    coords = np.loadtxt(coords_file)
+    pd_all_descriptors.to_csv(os.path.join(cormat_path,
+                                           "all_descriptors.csv"))
 
-                    cormat, _ = return_corres_correl_mat(
-                        cormat, coords, gm_mask_coords)
 
-                if export_df:
-                    if gm_mask_labels_file:
-                        labels = [line.strip()
-                                  for line in open(gm_mask_labels_file)]
-                    else:
-                        labels = list(range(cormat.shape[0]))
+def return_all_iter_cormats(cormat_path, iterables, iternames,
+                            gm_mask_coords_file=0, gm_mask_labels_file=0,
+                            mapflow_iterables=0, mapflow_iternames=0,
+                            export_df=False, all_cormats_file=None,
+                            n_jobs=4):
+    """
+    gm_mask_coords_file is the coords commun to all analyses
 
-                    df = pd.DataFrame(cormat, columns=labels, index=labels)
+    The (nb_iterations, n, n) stack is allocated once, memory-mapped on
+    all_cormats_file if given (.npy format), and filled by n_jobs threads;
+    the correspondance with gm_mask_coords is computed once for all
+    iterations sharing the same coords.
 
-                    df.to_excel(writer, "_".join(new_iter_obj))
+    export_df: export all matrices as an edge store ("all_cormats"
+    directory, see utils_condensed) and descriptors as csv
+    """
+    assert isInAlphabeticalOrder(iternames), \
+        ("Warning, iternames are not in alphabetical oroder, check the \
+         iterables order as well")
 
-                all_iter_cormats.append(cormat)
-                all_descriptors.append(new_iter_obj)
+    all_descriptors, all_files = _return_iter_cormat_files(
+        cormat_path, iterables, iternames, mapflow_iterables)
+
+    for cormat_file, _ in all_files:
+        assert os.path.exists(cormat_file), \
+            ("Warning, file {} could not be found".format(cormat_file))
+
+    if gm_mask_coords_file != 0:
+        gm_mask_coords = np.loadtxt(gm_mask_coords_file)
+        mat_size = gm_mask_coords.shape[0]
+
+    else:
+        mat_size = np.load(all_files[0][0], mmap_mode='r').shape[0]
+
+    stack_shape = (len(all_files), mat_size, mat_size)
+
+    if all_cormats_file is None:
+        all_iter_cormats = np.zeros(stack_shape, dtype=float)
+    else:
+        all_iter_cormats = np.lib.format.open_memmap(
+            all_cormats_file, mode='w+', dtype=float, shape=stack_shape)
+
+    # correspondance indexes, per distinct subject coords
+    where_in_corres_cache = {}
+
+    def _load_cormat(index):
+
+        cormat_file, coords_file = all_files[index]
+
+        cormat = np.load(cormat_file)
+
+        if gm_mask_coords_file == 0:
+            all_iter_cormats[index] = cormat
+            return
+
+        coords = np.loadtxt(coords_file)
+
+        key = coords.tobytes()
+        if key not in where_in_corres_cache:
+            where_in_corres_cache[key] = where_in_coords(coords,
+                                                         gm_mask_coords)
+
+        _scatter_corres_mat(cormat, where_in_corres_cache[key], mat_size,
+                            sym=True, corres_mat=all_iter_cormats[index])
+
+    if n_jobs > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(_load_cormat, range(len(all_files))))
+    else:
+        for index in range(len(all_files)):
+            _load_cormat(index)
+
+    print("Loaded {} matrices ({} distinct coords)".format(
+        len(all_files), len(where_in_corres_cache)))
 
     if mapflow_iternames != 0:
-        iternames .append(mapflow_iternames)
+        iternames = list(iternames) + [mapflow_iternames]
+
     pd_all_descriptors = pd.DataFrame(all_descriptors, columns=iternames)
 
     if export_df:
-        pd_all_descriptors.to_excel(os.path.join(
-            cormat_path, "all_descriptors.xls"))
+        _export_all_iter_cormats(cormat_path, all_iter_cormats,
+                                 pd_all_descriptors, gm_mask_labels_file)
+
+    return all_iter_cormats, pd_all_descriptors
 
-    return np.array(all_iter_cormats), pd_all_descriptors
 
 # stats over cormats, mean and T-Test of F-Test
 
 
-def compute_mean_cormats(all_cormats, all_descriptors, descript_columns):
+def _return_group_labels(all_descriptors, column, column_groups):
+    """group index of each matrix (-1 if not in column_groups)"""
+    group_labels = np.zeros(all_descriptors.shape[0], dtype=int) - 1
+
+    for index_group, cond_name in enumerate(column_groups):
+        group_labels[(all_descriptors[column] == cond_name).values] = \
+            index_group
 
+    return group_labels
+
+
+def compute_mean_cormats(all_cormats, all_descriptors, descript_columns,
+                         chunk_size=100000):
+    """
+    mean matrix of each group of descriptors (NaN are ignored)
+
+    Means of all groups are computed at once (see group_edge_moments),
+    all_cormats can be memory-mapped
+    """
     dict_mean = {}
 
+    descript_columns = list(descript_columns)
+
     if 'all' in descript_columns:
 
-        dict_mean['all'] = np.mean(all_cormats, axis=0)
+        _, mean_vals, _ = group_edge_moments(
+            all_cormats, np.zeros(all_cormats.shape[0], dtype=int),
+            chunk_size=chunk_size)
+
+        dict_mean['all'] = mean_vals[0]
 
         descript_columns.remove('all')
 
@@ -160,9 +222,18 @@ def compute_mean_cormats(all_cormats, all_descriptors, descript_columns):
             assert column in all_descriptors.columns, \
                 ("Error, {} not in {}".format(column, all_descriptors.columns))
 
-        for elem, lines in all_descriptors.groupby(by=descript_columns):
-            elem_cormats = all_cormats[lines.index, :, :]
-            mean_elem = np.mean(elem_cormats, axis=0)
+        group_indices = all_descriptors.groupby(by=descript_columns).indices
+
+        group_labels = np.zeros(all_descriptors.shape[0], dtype=int) - 1
+
+        for index_group, indices in enumerate(group_indices.values()):
+            group_labels[indices] = index_group
+
+        _, mean_vals, _ = group_edge_moments(
+            all_cormats, group_labels, len(group_indices),
+            chunk_size=chunk_size)
+
+        for elem, mean_elem in zip(group_indices.keys(), mean_vals):
             dict_mean[elem] = mean_elem
 
     return dict_mean
@@ -170,8 +241,15 @@ def compute_mean_cormats(all_cormats, all_descriptors, descript_columns):
 
 def compute_stats_cormats(all_cormats, all_descriptors, descript_columns,
                           groups=[], keep_intracon=False, cor_alpha=0.05,
-                          uncor_alpha=0.01):
+                          uncor_alpha=0.01, chunk_size=100000):
+    """
+    F-test between all groups and paired T-tests between each pair of
+    groups, for each descriptor column
 
+    Tests are computed from grouped moments (see group_edge_moments and
+    paired_edge_moments), without copying the matrices of each group;
+    all_cormats can be memory-mapped
+    """
     print(all_cormats.shape)
 
     for column in descript_columns:
@@ -186,36 +264,43 @@ def compute_stats_cormats(all_cormats, all_descriptors, descript_columns,
     for column in descript_columns:
 
         if len(groups) == 0:
-            groups = all_descriptors[column].unique().tolist()
-
-        # compute F-test over matrices
-        list_of_list_matrices = []
+            column_groups = all_descriptors[column].unique().tolist()
+        else:
+            column_groups = groups
 
-        for cond_name in groups:
-            desc_index = (all_descriptors[all_descriptors[column] ==
-                          cond_name].index)
+        group_labels = _return_group_labels(all_descriptors, column,
+                                            column_groups)
 
-            list_of_list_matrices.append(all_cormats[desc_index, :, :])
+        # compute F-test over matrices
+        nb_vals, mean_vals, var_vals = group_edge_moments(
+            all_cormats, group_labels, len(column_groups),
+            chunk_size=chunk_size)
 
-        signif_adj_mat, p_val_mat, F_stat_mat = compute_oneway_anova_fwe(
-            list_of_list_matrices, cor_alpha=cor_alpha,
-            uncor_alpha=uncor_alpha, keep_intracon=keep_intracon)
+        signif_adj_mat, p_val_mat, F_stat_mat = \
+            compute_oneway_anova_fwe_from_moments(
+                nb_vals, mean_vals, var_vals, cor_alpha=cor_alpha,
+                uncor_alpha=uncor_alpha, keep_intracon=keep_intracon)
 
         dict_signif["F-test_" + column] = signif_adj_mat
         dict_p_val["F-test_" + column] = p_val_mat
         dict_stats["F-test_" + column] = F_stat_mat
 
-        for combi_pair in combinations(groups, 2):
+        for combi_pair in combinations(column_groups, 2):
             pair_name = "-".join(combi_pair)
 
+            index_X, = np.where(group_labels ==
+                                column_groups.index(combi_pair[0]))
+            index_Y, = np.where(group_labels ==
+                                column_groups.index(combi_pair[1]))
+
             try:
+                diff_moments = paired_edge_moments(
+                    all_cormats, index_X, index_Y, chunk_size=chunk_size)
+
                 signif_adj_mat, p_val_mat, T_stat_mat = \
-                    compute_pairwise_ttest_fdr(
-                        X=list_of_list_matrices[groups.index(combi_pair[0])],
-                        Y=list_of_list_matrices[groups.index(combi_pair[1])],
-                        cor_alpha=cor_alpha, uncor_alpha=uncor_alpha,
-                        paired=True, old_order=False,
-                        keep_intracon=keep_intracon)
+                    compute_pairwise_ttest_fdr_from_moments(
+                        diff_moments, cor_alpha=cor_alpha,
+                        uncor_alpha=uncor_alpha, keep_intracon=keep_intracon)
 
                 dict_signif["T-test_" + pair_name] = signif_adj_mat
                 dict_p_val["T-test_" + pair_name] = p_val_mat
@@ -1,17 +1,25 @@
 # -*- coding: utf-8 -*-
 
 import os
-
+import re
 import glob
+import pickle
+import hashlib
+
+from concurrent.futures import ProcessPoolExecutor
 
 import pandas as pd
 import numpy as np
 
 from collections import Counter
 
-from graphpype.utils_net import read_lol_file, read_Pajek_corres_nodes
+from graphpype.utils_net import read_Pajek_corres_nodes
 from graphpype.utils_dtype_coord import where_in_coords
+from graphpype.utils_condensed import (triu_indices, condense_sym_mat,
+                                       is_edge_store, append_edge_store,
+                                       read_edge_store_index, read_edge_store)
 
+from graphpype.utils_mod import read_lol_file
 from graphpype.utils_mod import get_modularity_value_from_lol_file
 from graphpype.utils_mod import get_values_from_global_info_file
 from graphpype.utils_mod import get_path_length_from_info_dists_file
@@ -33,121 +41,111 @@ def glob_natural_sorted(reg_exp):
     return natural_sorted_files, list(range(len(files)))
 
 
-def compute_rada_df(iter_path, df, radatools_version="3.2", mapflow=[],
-                    mapflow_name=""):
-    """gather rada """
+def _return_net_prop_dir(radatools_version="3.2"):
+    """directory of radatools net properties, depending on the version"""
     if radatools_version == "3.2":
-
-        net_prop_dir = "net_prop"
+        return "net_prop"
 
     elif radatools_version == "4.0":
+        return "prep_rada"
 
-        net_prop_dir = "prep_rada"
-    else:
-        print("Warning, could not find radatools_version {}"
-              .format(radatools_version))
-        return
-
-    # modularity
-    if len(mapflow) == 0:
+    print("Warning, could not find radatools_version {}"
+          .format(radatools_version))
+    return None
 
-        modularity_file = os.path.join(
-            iter_path, "community_rada", "Z_List.lol")
 
-        print(modularity_file)
-
-        if os.path.exists(modularity_file):
-
-            mod_val = get_modularity_value_from_lol_file(modularity_file)
-            df['Modularity'] = mod_val
-
-        print(df)
-
-        # info_global
-        global_info_file = os.path.join(
-            iter_path, net_prop_dir, "Z_List-info_global.txt")
+def _return_rada_files(iter_path, net_prop_dir, mapflow_index=None):
+    """modularity, info_global and info_dists files of one iteration (or of
+    one mapflow element of the iteration)"""
+    if mapflow_index is None:
+        mod_dir = os.path.join(iter_path, "community_rada")
+        prop_dir = os.path.join(iter_path, net_prop_dir)
+    else:
+        mod_dir = os.path.join(iter_path, "community_rada", "mapflow",
+                               "_community_rada" + str(mapflow_index))
+        prop_dir = os.path.join(iter_path, net_prop_dir, "mapflow",
+                                "_" + net_prop_dir + str(mapflow_index))
 
-        if os.path.exists(global_info_file):
+    return (os.path.join(mod_dir, "Z_List.lol"),
+            os.path.join(prop_dir, "Z_List-info_global.txt"),
+            os.path.join(prop_dir, "Z_List-info_dists.txt"))
 
-            global_info_values = get_values_from_global_info_file(
-                global_info_file)
 
-            df.update(global_info_values)
+def _to_float(value):
+    """float conversion of parsed values, NaN if not a number"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
 
-        # info_dists
-        path_length_file = os.path.join(
-            iter_path, net_prop_dir, "Z_List-info_dists.txt")
 
-        if os.path.exists(path_length_file):
+def parse_rada_files(rada_files):
+    """
+    numeric global values from the modularity, info_global and info_dists
+    files (as returned by _return_rada_files); missing files are skipped
+    """
+    modularity_file, global_info_file, path_length_file = rada_files
 
-            mean_path_length, diameter, global_efficiency = \
-                get_path_length_from_info_dists_file(path_length_file)
+    values = {}
 
-            df['Mean_path_length'] = str(mean_path_length)
-            df['Diameter'] = str(diameter)
-            df['Global_efficiency'] = str(global_efficiency)
+    if os.path.exists(modularity_file):
+        values['Modularity'] = _to_float(
+            get_modularity_value_from_lol_file(modularity_file))
 
-    else:
+    if os.path.exists(global_info_file):
+        global_info_values = get_values_from_global_info_file(
+            global_info_file)
 
-        df['Modularity'] = []
-        df[mapflow_name] = []
+        for key, value in global_info_values.items():
+            values[key] = _to_float(value)
 
-        df['Mean_path_length'] = []
-        df['Diameter'] = []
-        df['Global_efficiency'] = []
+    if os.path.exists(path_length_file):
+        mean_path_length, diameter, global_efficiency = \
+            get_path_length_from_info_dists_file(path_length_file)
 
-        for i, cond in enumerate(mapflow):
+        values['Mean_path_length'] = float(mean_path_length)
+        values['Diameter'] = float(diameter)
+        values['Global_efficiency'] = float(global_efficiency)
 
-            df[mapflow_name].append(cond)
+    return values
 
-            modularity_file = os.path.join(
-                iter_path, "community_rada", "mapflow",
-                "_community_rada"+str(i), "Z_List.lol")
 
-            if os.path.exists(modularity_file):
-
-                mod_val = get_modularity_value_from_lol_file(modularity_file)
-
-                df['Modularity'].append(mod_val)
-
-            else:
-                df['Modularity'].append(np.nan)
+def compute_rada_df(iter_path, df, radatools_version="3.2", mapflow=[],
+                    mapflow_name=""):
+    """gather rada """
+    net_prop_dir = _return_net_prop_dir(radatools_version)
 
-            # info_global
-            global_info_file = os.path.join(
-                iter_path, net_prop_dir, "mapflow", "_" + net_prop_dir+str(i),
-                "Z_List-info_global.txt")
+    if net_prop_dir is None:
+        return
 
-            if os.path.exists(global_info_file):
+    if len(mapflow) == 0:
 
-                global_info_values = get_values_from_global_info_file(
-                    global_info_file)
+        df.update(parse_rada_files(_return_rada_files(iter_path,
+                                                      net_prop_dir)))
 
-                for key, value in global_info_values.items():
+    else:
 
-                    if key not in list(df.keys()):
-                        df[key] = []
+        df[mapflow_name] = []
 
-                    df[key].append(value)
+        for key in ['Modularity', 'Mean_path_length', 'Diameter',
+                    'Global_efficiency']:
+            df[key] = []
 
-            # info_dists
-            path_length_file = os.path.join(
-                iter_path, net_prop_dir, "mapflow", "_" + net_prop_dir+str(i),
-                "Z_List-info_dists.txt")
+        for i, cond in enumerate(mapflow):
 
-            if os.path.exists(path_length_file):
+            df[mapflow_name].append(cond)
 
-                mean_path_length, diameter, global_efficiency = \
-                    get_path_length_from_info_dists_file(path_length_file)
+            values = parse_rada_files(_return_rada_files(
+                iter_path, net_prop_dir, mapflow_index=i))
 
-                df['Mean_path_length'].append(str(mean_path_length))
-                df['Diameter'].append(str(diameter))
-                df['Global_efficiency'].append(str(global_efficiency))
-            else:
+            for key, value in values.items():
+                if key not in list(df.keys()):
+                    df[key] = [np.nan] * i
 
-                df['Mean_path_length'].append(str(np.nan))
-                df['Diameter'].append(str(np.nan))
-                df['Global_efficiency'].append(str(np.nan))
+            # NaN for values missing in this mapflow element
+            for key in df.keys():
+                if key != mapflow_name and isinstance(df[key], list):
+                    df[key].append(values.get(key, np.nan))
 
 
 def compute_nodes_rada_df(local_dir, gm_coords, coords_file, labels_file,
@@ -180,21 +178,19 @@ def compute_nodes_rada_df(local_dir, gm_coords, coords_file, labels_file,
 
         # node_coords
         node_coords = coords[node_corres, :]
-        node_labels = labels[node_corres].reshape(-1, 1)
 
         # where_in_gm_mask
         where_in_gm_mask = where_in_coords(node_coords, gm_coords)
 
-        where_in_gm_mask = where_in_gm_mask.reshape(
-            where_in_gm_mask.shape[0], 1)
-
-        # print where_in_gm_mask
-        print(where_in_gm_mask.shape)
-
-        list_df.append(pd.DataFrame(
-            np.concatenate((where_in_gm_mask, node_labels, node_coords),
-                           axis=1),
-            columns=['Where_in_GM_mask', 'labels', 'MNI_x', 'MNI_y', 'MNI_z']))
+        # one column per property, to keep numeric dtypes
+        list_df.append(pd.DataFrame({
+            'Where_in_GM_mask': where_in_gm_mask,
+            'labels': labels[node_corres],
+            'MNI_x': node_coords[:, 0],
+            'MNI_y': node_coords[:, 1],
+            'MNI_z': node_coords[:, 2]},
+            columns=['Where_in_GM_mask', 'labels', 'MNI_x', 'MNI_y',
+                     'MNI_z']))
     else:
         if not os.path.exists(coords_file):
             print("Missing {}".format(coords_file))
@@ -241,22 +237,278 @@ def compute_nodes_rada_df(local_dir, gm_coords, coords_file, labels_file,
         node_roles = np.array(np.loadtxt(roles_file), dtype=int)
 
         part_coeff = np.loadtxt(part_coeff_file)
-        part_coeff = part_coeff.reshape(part_coeff.shape[0], 1)
 
         Z_com_degree = np.loadtxt(Z_com_degree_file)
-        Z_com_degree = Z_com_degree.reshape(Z_com_degree.shape[0], 1)
 
-        list_df.append(pd.DataFrame(
-            np.concatenate((node_roles, part_coeff, Z_com_degree), axis=1),
+        list_df.append(pd.DataFrame({
+            'Role_quality': node_roles[:, 0],
+            'Role_quantity': node_roles[:, 1],
+            'Participation_coefficient': part_coeff,
+            'Z_community_degree': Z_com_degree},
             columns=['Role_quality', 'Role_quantity',
                      'Participation_coefficient', 'Z_community_degree']))
 
     return list_df
 
 
+# parallel and cached gathering
+def find_rada_dirs(res_path, pattern="*"):
+    """
+    all (natural sorted) iteration directories of res_path containing
+    radatools results (a community_rada directory)
+    """
+    iter_paths = [os.path.dirname(os.path.normpath(com_dir))
+                  for com_dir in glob.glob(os.path.join(res_path, pattern,
+                                                        "community_rada"))]
+
+    def _natural_key(path):
+        return [int(part) if part.isdigit() else part
+                for part in re.split(r'(\d+)', path)]
+
+    return sorted(iter_paths, key=_natural_key)
+
+
+def _file_stamps(files):
+    """modification time of each file (None if missing)"""
+    return tuple(os.path.getmtime(file) if os.path.exists(file) else None
+                 for file in files)
+
+
+def _load_gather_index(index_file):
+    """persistent index of already parsed results"""
+    if index_file is None or not os.path.exists(index_file):
+        return {}
+
+    with open(index_file, 'rb') as f:
+        return pickle.load(f)
+
+
+def _save_gather_index(index_file, index):
+    if index_file is None:
+        return
+
+    tmp_index_file = index_file + ".tmp"
+
+    with open(tmp_index_file, 'wb') as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    os.rename(tmp_index_file, index_file)
+
+
+def _cached_map(func, tasks, index_file=None, n_jobs=1):
+    """
+    apply func to all tasks, in a process pool if n_jobs > 1
+
+    tasks is a list of (key, files, args): func(*args) is only computed if
+    key is not in the index, or if one of the files was modified since it
+    was indexed
+    """
+    index = _load_gather_index(index_file)
+
+    results = [None] * len(tasks)
+    to_compute = []
+
+    for task_index, (key, files, args) in enumerate(tasks):
+
+        stamps = _file_stamps(files)
+
+        if key in index and index[key][0] == stamps:
+            results[task_index] = index[key][1]
+        else:
+            to_compute.append((task_index, stamps))
+
+    print("{} results from index, {} to parse".format(
+        len(tasks) - len(to_compute), len(to_compute)))
+
+    if len(to_compute):
+
+        list_args = [tasks[task_index][2] for task_index, _ in to_compute]
+
+        if n_jobs > 1:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                computed = list(executor.map(func, *zip(*list_args)))
+        else:
+            computed = [func(*args) for args in list_args]
+
+        for (task_index, stamps), result in zip(to_compute, computed):
+            results[task_index] = result
+            index[tasks[task_index][0]] = (stamps, result)
+
+        _save_gather_index(index_file, index)
+
+    return results
+
+
+def gather_rada_df(iter_paths, radatools_version="3.2", mapflow=[],
+                   mapflow_name="", index_file=None, n_jobs=1):
+    """
+    global radatools values of all iterations, as one DataFrame with
+    numeric columns (one row per iteration, or per iteration and mapflow
+    element)
+
+    Parsing is done in a process pool if n_jobs > 1; if index_file is given,
+    parsed values are stored (with the modification times of the files),
+    and only new or modified results are parsed again
+    """
+    net_prop_dir = _return_net_prop_dir(radatools_version)
+
+    assert net_prop_dir is not None, \
+        "Error, unknown radatools_version {}".format(radatools_version)
+
+    tasks = []
+    rows = []
+
+    for iter_path in iter_paths:
+
+        if len(mapflow) == 0:
+            list_index = [None]
+        else:
+            list_index = list(range(len(mapflow)))
+
+        for i in list_index:
+
+            rada_files = _return_rada_files(iter_path, net_prop_dir,
+                                            mapflow_index=i)
+
+            tasks.append((rada_files, rada_files, (rada_files,)))
+
+            row = {'Path': iter_path}
+
+            if i is not None:
+                row[mapflow_name] = mapflow[i]
+
+            rows.append(row)
+
+    all_values = _cached_map(parse_rada_files, tasks, index_file=index_file,
+                             n_jobs=n_jobs)
+
+    for row, values in zip(rows, all_values):
+        row.update(values)
+
+    df = pd.DataFrame(rows)
+
+    # missing values are NaN, all value columns are float
+    value_columns = [col for col in df.columns
+                     if col not in ['Path', mapflow_name]]
+    df[value_columns] = df[value_columns].astype(float)
+
+    return df
+
+
+def _nodes_rada_files(local_dir, coords_file, labels_file, net_prop_dir):
+    """files read by compute_nodes_rada_df"""
+    return (coords_file, labels_file,
+            os.path.join(local_dir, "prep_rada", "Z_List.net"),
+            os.path.join(local_dir, net_prop_dir, "Z_List-info_nodes.txt"),
+            os.path.join(local_dir, "community_rada", "Z_List.lol"),
+            os.path.join(local_dir, "node_roles", "node_roles.txt"),
+            os.path.join(local_dir, "node_roles",
+                         "all_participation_coeff.txt"),
+            os.path.join(local_dir, "node_roles", "all_Z_com_degree.txt"))
+
+
+def _concat_nodes_rada_df(local_dir, gm_coords, coords_file, labels_file,
+                          radatools_version):
+    """one DataFrame of node properties for one iteration"""
+    list_df = compute_nodes_rada_df(local_dir, gm_coords, coords_file,
+                                    labels_file, radatools_version)
+
+    if len(list_df) == 0:
+        return pd.DataFrame()
+
+    return pd.concat(list_df, axis=1)
+
+
+def gather_nodes_rada_df(local_dirs, gm_coords, coords_file, labels_file,
+                         radatools_version="3.2", index_file=None, n_jobs=1):
+    """
+    node properties of all iterations, concatenated in one DataFrame
+    (with a Path column for the iteration directory)
+
+    Same process pool and persistent index as gather_rada_df; the index is
+    also invalidated if gm_coords change
+    """
+    net_prop_dir = _return_net_prop_dir(radatools_version)
+
+    assert net_prop_dir is not None, \
+        "Error, unknown radatools_version {}".format(radatools_version)
+
+    gm_coords = np.asarray(gm_coords)
+    gm_coords_hash = hashlib.md5(
+        np.ascontiguousarray(gm_coords).tobytes()).hexdigest()
+
+    tasks = []
+
+    for local_dir in local_dirs:
+
+        files = _nodes_rada_files(local_dir, coords_file, labels_file,
+                                  net_prop_dir)
+
+        tasks.append(((files, gm_coords_hash), files,
+                      (local_dir, gm_coords, coords_file, labels_file,
+                       radatools_version)))
+
+    list_df = _cached_map(_concat_nodes_rada_df, tasks,
+                          index_file=index_file, n_jobs=n_jobs)
+
+    for local_dir, df in zip(local_dirs, list_df):
+        df.insert(0, 'Path', local_dir)
+
+    return pd.concat(list_df, axis=0, ignore_index=True)
+
+
+def _count_higher_lower(sorted_null, values):
+    """
+    number of values of sorted_null (sorted, without NaN) strictly higher
+    and strictly lower than each of values (0 for NaN values)
+    """
+    values = np.asarray(values, dtype=float)
+
+    nb_higher = len(sorted_null) - np.searchsorted(sorted_null, values,
+                                                   side='right')
+    nb_lower = np.searchsorted(sorted_null, values, side='left')
+    nb_lower[np.isnan(values)] = 0
+
+    return nb_higher, nb_lower
+
+
+def _count_higher_lower_per_col(null_vals, orig_vals, chunk_size=1000):
+    """
+    number of values in each column of null_vals (nb_permuts, nb_cols)
+    strictly higher and strictly lower than orig_vals (by chunks of
+    columns, NaN are never counted)
+    """
+    nb_cols = null_vals.shape[1]
+
+    nb_higher = np.zeros(nb_cols, dtype=int)
+    nb_lower = np.zeros(nb_cols, dtype=int)
+
+    for start in range(0, nb_cols, chunk_size):
+        stop = min(start + chunk_size, nb_cols)
+
+        with np.errstate(invalid='ignore'):
+            nb_higher[start:stop] = np.sum(
+                null_vals[:, start:stop] > orig_vals[start:stop], axis=0)
+            nb_lower[start:stop] = np.sum(
+                null_vals[:, start:stop] < orig_vals[start:stop], axis=0)
+
+    return nb_higher, nb_lower
+
+
+def _max_min_null(null_vals):
+    """sorted max and min over columns for each permutation (FWE)"""
+    valid = ~np.all(np.isnan(null_vals), axis=1)
+
+    if not np.any(valid):
+        return np.array([]), np.array([])
+
+    return (np.sort(np.nanmax(null_vals[valid], axis=1)),
+            np.sort(np.nanmin(null_vals[valid], axis=1)))
+
+
 def compute_signif_permuts(permut_df, permut_col="Seed",
                            session_col="Session", start_col=0, stop_col=0,
-                           columns=[]):
+                           columns=[], two_sided=False, fwe=False):
     """
     Computing permutation-based stats per nodes, over several sheetnames
 
@@ -266,6 +518,10 @@ def compute_signif_permuts(permut_df, permut_col="Seed",
     stop_col: last column to be included
     (in fact, excluded except if value is 0, in this case goes to the last
     column of the df)
+    two_sided: p-values of both tails are doubled (and bounded to 1)
+    fwe: family-wise error correction over columns, the original value of
+    each column is compared to the max (or min) over columns of each
+    permutation
 
     return:
     all_p_higher, all_p_lower: "vector of p_values obtained for 1 tail t-test
@@ -283,8 +539,6 @@ def compute_signif_permuts(permut_df, permut_col="Seed",
 
     expected_permut_indexes = list(range(len(seed_index)-1))
 
-    print(expected_permut_indexes)
-
     # should start at 0 and have all values in between
     assert all(x in seed_index[1:] for x in expected_permut_indexes), \
         ("Error, permut indexes should be consecutive and start with \
@@ -309,31 +563,36 @@ def compute_signif_permuts(permut_df, permut_col="Seed",
 
     print(data_cols)
 
-    # looping over selected columns
     all_p_higher = np.zeros(shape=(len(data_cols)), dtype='float64') - 1
     all_p_lower = np.zeros(shape=(len(data_cols)), dtype='float64') - 1
 
-    cols = []
-
     if session_col == -1 or len(permut_df[session_col].unique()) == 1:
 
-        for index_col, col in enumerate(data_cols):
+        # (nb_rows, nb_cols), original values on the seed -1 row
+        values = np.asarray(permut_df[data_cols].values, dtype=float)
+        is_orig = (permut_df[permut_col].values == -1)
+
+        orig_vals = values[is_orig][0]
+        null_vals = values[~is_orig]
+        nb_vals = float(values.shape[0])
+
+        if fwe:
+            sorted_max, sorted_min = _max_min_null(null_vals)
+            nb_higher, _ = _count_higher_lower(sorted_max, orig_vals)
+            _, nb_lower = _count_higher_lower(sorted_min, orig_vals)
+        else:
+            nb_higher, nb_lower = _count_higher_lower_per_col(null_vals,
+                                                              orig_vals)
 
-            print(index_col, col)
+        all_p_higher = (nb_higher + 1)/nb_vals
+        all_p_lower = (nb_lower + 1)/nb_vals
 
-            sum_higher = np.sum(
-                (permut_df[col].iloc[1:] > permut_df[col].iloc[0])
-                .values.astype(int))
-            all_p_higher[index_col] = (
-                sum_higher+1)/float(permut_df[col].shape[0])
+        # no valid original value
+        all_p_higher[np.isnan(orig_vals)] = np.nan
+        all_p_lower[np.isnan(orig_vals)] = np.nan
 
-            sum_lower = np.sum(
-                (permut_df[col].iloc[1:] < permut_df[col].iloc[0])
-                .values.astype(int))
-            all_p_lower[index_col] = (sum_lower+1) / \
-                float(permut_df[col].shape[0])
+        cols = [str(col) for col in data_cols]
 
-            cols.append(str(col))
     else:
         # all unique values should have 2 different samples
         count_elements = Counter(permut_df[permut_col].values)
@@ -348,54 +607,46 @@ def compute_signif_permuts(permut_df, permut_col="Seed",
             print("Error, all permut indexes should have 2 lines: {}"
                   .format(count_elements))
 
-        # computing diff df
-
-        for index_col, col in enumerate(data_cols):
-
-            df_col = permut_df.pivot(
-                index=permut_col, columns=session_col, values=col)
+        # (nb_seeds, nb_cols) differences first session - second session,
+        # seed -1 (original) on first row
+        sessions = np.unique(permut_df[session_col].values)
 
-            df_col["Diff"] = pd.to_numeric(
-                df_col.iloc[:, 0]) - pd.to_numeric(df_col.iloc[:, 1])
+        sess_values = [np.asarray(
+            permut_df[permut_df[session_col] == sess].set_index(
+                permut_col)[data_cols].reindex(seed_index).values,
+            dtype=float) for sess in sessions[:2]]
 
-            # asked by flake8 but not sure relevant for pandas Series...
-            non_nan_indexes, = np.where(np.isnan(df_col["Diff"]) is False)
+        diff_vals = sess_values[0] - sess_values[1]
 
-            print(non_nan_indexes)
+        orig_vals = diff_vals[0]
+        null_vals = diff_vals[1:]
+        nb_vals = float(diff_vals.shape[0])
 
-            diff_col = df_col["Diff"].values[non_nan_indexes]
-
-            if not all(val == 2 for val in list(count_elements.values())):
-                print("Error, all permut indexes should have 2 lines: {}"
-                      .format(count_elements))
-
-                print(diff_col)
-                print(diff_col.shape)
-
-            if diff_col.shape[0] == 0:
-
-                all_p_higher[index_col] = np.nan
-                all_p_lower[index_col] = np.nan
-                cols.append(col)
+        if fwe:
+            sorted_max, sorted_min = _max_min_null(null_vals)
+            nb_higher, _ = _count_higher_lower(sorted_max, orig_vals)
+            _, nb_lower = _count_higher_lower(sorted_min, orig_vals)
+        else:
+            nb_higher, nb_lower = _count_higher_lower_per_col(null_vals,
+                                                              orig_vals)
 
-                continue
+        # only the tail of the original difference is tested
+        higher = orig_vals > 0
+        lower = orig_vals < 0
 
-            if diff_col[0] > 0:
-                sum_higher = np.sum(
-                    np.array(diff_col[1:] > diff_col[0], dtype=int))
-                print("sum_higher:", sum_higher)
-                all_p_higher[index_col] = (sum_higher+1)/float(df_col.shape[0])
+        all_p_higher[higher] = (nb_higher[higher] + 1)/nb_vals
+        all_p_lower[lower] = (nb_lower[lower] + 1)/nb_vals
 
-            elif diff_col[0] < 0:
-                sum_lower = np.sum(
-                    np.array(diff_col[1:] < diff_col[0], dtype=int))
-                print("sum_lower:", sum_lower)
-                all_p_lower[index_col] = (sum_lower+1)/float(df_col.shape[0])
+        # no valid original difference
+        all_p_higher[np.isnan(orig_vals)] = np.nan
+        all_p_lower[np.isnan(orig_vals)] = np.nan
 
-            else:
-                print("not able to do diff")
+        cols = list(data_cols)
 
-            cols.append(col)
+    if two_sided:
+        for all_p in [all_p_higher, all_p_lower]:
+            computed = all_p > 0
+            all_p[computed] = np.minimum(2 * all_p[computed], 1.0)
 
     df_res = pd.DataFrame([all_p_higher, all_p_lower], columns=cols)
     df_res.index = ["Higher", "Lower"]
@@ -403,8 +654,15 @@ def compute_signif_permuts(permut_df, permut_col="Seed",
     return df_res
 
 
-def compute_signif_node_prop(orig_df, list_permut_df, columns):
-    """signif node properties"""
+def compute_signif_node_prop(orig_df, list_permut_df, columns,
+                             two_sided=False, fwe=False):
+    """
+    signif node properties: fraction of permutation values higher than
+    each original value
+
+    two_sided: twice the fraction of the observed tail (bounded to 1)
+    fwe: comparison with the max over nodes of each permutation df
+    """
     permut_df = pd.concat(list_permut_df, axis=0)
 
     all_frac_higher = []
@@ -416,16 +674,36 @@ def compute_signif_node_prop(orig_df, list_permut_df, columns):
         assert col in permut_df.columns, \
             "Error, {} not in permut columns {}".format(col, permut_df.columns)
 
-        def sum_higher(a, b):
+        orig_vals = np.asarray(orig_df[col].values, dtype=float)
+
+        if fwe:
+            null_vals = np.array([np.nanmax(np.asarray(
+                df[col].values, dtype=float)) for df in list_permut_df])
+            nb_vals = len(list_permut_df) + 1
+
+        else:
+            null_vals = np.asarray(permut_df[col].values, dtype=float)
+            nb_vals = len(permut_df.index) + 1
 
-            def func(el):
-                return np.sum(el[0] < b.values)
+        sorted_null = np.sort(null_vals[~np.isnan(null_vals)])
 
-            return np.apply_along_axis(func, 1, a[:, None])
+        nb_higher, nb_lower = _count_higher_lower(sorted_null, orig_vals)
 
-        frac_higher = np.array(
-            sum_higher(orig_df[col], permut_df[col])+1,
-            dtype=float)/float(len(permut_df.index) + 1)
+        frac_higher = (nb_higher + 1)/float(nb_vals)
+
+        if two_sided:
+            if fwe:
+                sorted_min = np.sort([np.nanmin(np.asarray(
+                    df[col].values, dtype=float)) for df in list_permut_df])
+                _, nb_lower = _count_higher_lower(
+                    sorted_min[~np.isnan(sorted_min)], orig_vals)
+
+            frac_lower = (nb_lower + 1)/float(nb_vals)
+            frac_higher = np.minimum(
+                2 * np.minimum(frac_higher, frac_lower), 1.0)
+
+        # no valid original value
+        frac_higher[np.isnan(orig_vals)] = np.nan
 
         all_frac_higher.append(frac_higher)
 
@@ -435,148 +713,153 @@ def compute_signif_node_prop(orig_df, list_permut_df, columns):
     return df_signif
 
 
-def gather_diff_con_values(res_path, cond, nb_permuts, labels):
-    """gather con values"""
-
+def _return_con_values_paths(res_path, cond):
+    """legacy csv file and edge store directory of permutation con values"""
     if isinstance(cond, tuple):
         # si plusieurs conditions = IRMf
-        df_filename = os.path.join(
-            res_path, "permuts_" + ".".join(cond) + '_con_values.csv')
-
+        cond_name = ".".join(cond)
     else:
         # si une seule valeur
-        df_filename = os.path.join(
-            res_path, "permuts_" + cond + '_con_values.csv')
+        cond_name = cond
 
-    if not os.path.exists(df_filename):
+    df_filename = os.path.join(
+        res_path, "permuts_" + cond_name + '_con_values.csv')
 
-        # pair of labels and tri triu_indices
+    return df_filename, os.path.splitext(df_filename)[0]
 
-        triu_indices_i, triu_indices_j = np.triu_indices(len(labels), k=1)
 
-        pair_labels = [labels[i] + "_" + labels[j]
-                       for i, j in zip(triu_indices_i.tolist(),
-                                       triu_indices_j.tolist())]
+def _return_permut_iter_dir(cond, seed):
+    if isinstance(cond, tuple):
+        return "_cond_" + ".".join(cond) + "_permut_" + str(seed)
 
-        print(pair_labels)
-        print(len(pair_labels))
+    return "_freq_band_name_" + cond + "_permut_" + str(seed)
 
-        # creating dataframe
-        all_vect_cormats = []
 
-        all_global_info_values = []
+def _return_pair_labels(labels):
+    """pair of labels, in triu_indices order"""
+    triu_indices_i, triu_indices_j = triu_indices(len(labels), k=1)
 
-        for seed in range(-1, nb_permuts):
+    return [labels[i] + "_" + labels[j]
+            for i, j in zip(triu_indices_i.tolist(),
+                            triu_indices_j.tolist())]
 
-            print(seed)
 
-            for sess in ['1', '2']:
+def _update_con_values_store(store_dir, pair_labels, list_info_files,
+                             info_columns, load_func):
+    """
+    append to the store the con values of the files not already stored
+    (as a new chunk), and return the store rows sorted by info_columns
+    """
+    stored_keys = set()
 
-                print(sess)
+    if is_edge_store(store_dir):
+        rows_info, _ = read_edge_store_index(store_dir)
+        stored_keys = set(map(tuple, rows_info[info_columns].values.tolist()))
 
-                dict_global_info_values = {'Session': sess, 'Seed': seed}
+    all_vect_cormats = []
+    all_global_info_values = []
 
-                all_global_info_values.append(dict_global_info_values)
+    for dict_global_info_values, avg_cormat_file in list_info_files:
 
-                # avg_cormat
+        key = tuple(dict_global_info_values[col] for col in info_columns)
 
-                if isinstance(cond, tuple):
-                    iter_dir = "_cond_" + \
-                        ".".join(cond) + "_permut_" + str(seed)
+        if key in stored_keys:
+            continue
 
-                else:
-                    iter_dir = "_freq_band_name_" + \
-                        cond + "_permut_" + str(seed)
+        if os.path.exists(avg_cormat_file):
+            all_vect_cormats.append(load_func(avg_cormat_file))
+            all_global_info_values.append(dict_global_info_values)
 
-                avg_cormat_file = os.path.join(
-                    res_path, iter_dir,
-                    "prepare_mean_correl" + sess, "avg_cormat.npy")
+        else:
+            print("Warning, could not find file {}".format(avg_cormat_file))
 
-                print(avg_cormat_file)
+    print("Adding {} rows to {}".format(len(all_global_info_values),
+                                        store_dir))
 
-                if os.path.exists(avg_cormat_file):
-                    avg_cormat = np.load(avg_cormat_file)
-                    vect_avg_cormat = avg_cormat[triu_indices_i,
-                                                 triu_indices_j]
-                    all_vect_cormats.append(vect_avg_cormat)
+    if len(all_global_info_values) or not is_edge_store(store_dir):
+        append_edge_store(
+            store_dir,
+            np.array(all_vect_cormats, dtype="float32").reshape(
+                -1, len(pair_labels)),
+            pd.DataFrame(all_global_info_values, columns=info_columns),
+            edge_labels=pair_labels)
 
-        df_info = pd.DataFrame(all_global_info_values)
+    rows_info, _ = read_edge_store_index(store_dir)
 
-        df_con = pd.DataFrame(all_vect_cormats, columns=pair_labels)
+    return np.lexsort(rows_info[info_columns[::-1]].values.T)
 
-        df = pd.concat((df_info, df_con), axis=1)
 
-        df.to_csv(df_filename, index_col=0)
-    else:
-
-        df = pd.read_csv(df_filename, index_col=0)
+def gather_diff_con_values(res_path, cond, nb_permuts, labels, edges=None):
+    """
+    gather con values (for two sessions)
 
-    return df
+    Values are kept in an edge store (float32 seeds x edges, see
+    utils_condensed), next to the legacy csv file; seeds already gathered
+    are not read again, new seeds are appended without rewriting the store.
+    edges: subset of pair labels (or indexes) to read (default all)
+    """
+    df_filename, store_dir = _return_con_values_paths(res_path, cond)
 
+    if os.path.exists(df_filename) and not is_edge_store(store_dir):
+        # gathered with older versions
+        return pd.read_csv(df_filename, index_col=0)
 
-def gather_con_values(res_path, cond, nb_permuts, labels):
+    list_info_files = []
 
-    import os
+    for seed in range(-1, nb_permuts):
 
-    if isinstance(cond, tuple):
-        # si plusieurs conditions = IRMf
-        df_filename = os.path.join(
-            res_path, "permuts_" + ".".join(cond) + '_con_values.csv')
+        for sess in ['1', '2']:
 
-    else:
-        # si une seule valeur
-        df_filename = os.path.join(
-            res_path, "permuts_" + cond + '_con_values.csv')
+            avg_cormat_file = os.path.join(
+                res_path, _return_permut_iter_dir(cond, seed),
+                "prepare_mean_correl" + sess, "avg_cormat.npy")
 
-    if not os.path.exists(df_filename):
+            list_info_files.append(({'Session': int(sess), 'Seed': seed},
+                                    avg_cormat_file))
 
-        # pair of labels and tri triu_indices
-        triu_indices_i, triu_indices_j = np.triu_indices(len(labels), k=1)
+    def _load_avg_cormat(avg_cormat_file):
+        return condense_sym_mat(np.load(avg_cormat_file))
 
-        pair_labels = [labels[i] + "_" + labels[j]
-                       for i, j in zip(triu_indices_i.tolist(),
-                                       triu_indices_j.tolist())]
+    order = _update_con_values_store(
+        store_dir, _return_pair_labels(labels), list_info_files,
+        ['Seed', 'Session'], _load_avg_cormat)
 
-        # creating dataframe
-        all_vect_cormats = []
-        all_global_info_values = []
+    df = read_edge_store(store_dir, rows=order, edges=edges)
 
-        for seed in range(-1, nb_permuts):
+    return df[['Session', 'Seed'] + list(df.columns[2:])]
 
-            dict_global_info_values = {'Seed': seed}
 
-            all_global_info_values.append(dict_global_info_values)
+def gather_con_values(res_path, cond, nb_permuts, labels, edges=None):
+    """
+    gather con values of shuffled matrices
 
-            # avg_cormat
-            if isinstance(cond, tuple):
-                iter_dir = "_cond_" + ".".join(cond) + "_permut_" + str(seed)
+    Same edge store as gather_diff_con_values
+    """
+    df_filename, store_dir = _return_con_values_paths(res_path, cond)
 
-            else:
-                iter_dir = "_freq_band_name_" + cond + "_permut_" + str(seed)
+    if os.path.exists(df_filename) and not is_edge_store(store_dir):
+        # gathered with older versions
+        return pd.read_csv(df_filename, index_col=None)
 
-            avg_cormat_file = os.path.join(
-                res_path, iter_dir, "shuffle_matrix", "shuffled_matrix.npy")
+    list_info_files = []
 
-            if os.path.exists(avg_cormat_file):
-                avg_cormat = np.load(avg_cormat_file)
-                avg_cormat = avg_cormat + np.transpose(avg_cormat)
-                vect_avg_cormat = avg_cormat[triu_indices_i, triu_indices_j]
-                all_vect_cormats.append(vect_avg_cormat)
+    for seed in range(-1, nb_permuts):
 
-            else:
-                print("Warning, could not find file \
-                    {}".format(avg_cormat_file))
+        avg_cormat_file = os.path.join(
+            res_path, _return_permut_iter_dir(cond, seed), "shuffle_matrix",
+            "shuffled_matrix.npy")
 
-        df_info = pd.DataFrame(all_global_info_values)
-        df_con = pd.DataFrame(all_vect_cormats, columns=pair_labels)
-        df = pd.concat((df_info, df_con), axis=1)
-        df.to_csv(df_filename, index=False)
+        list_info_files.append(({'Seed': seed}, avg_cormat_file))
 
-    else:
+    def _load_shuffled_matrix(avg_cormat_file):
+        avg_cormat = np.load(avg_cormat_file)
+        return condense_sym_mat(avg_cormat + np.transpose(avg_cormat))
 
-        df = pd.read_csv(df_filename, index_col=None)
+    order = _update_con_values_store(
+        store_dir, _return_pair_labels(labels), list_info_files, ['Seed'],
+        _load_shuffled_matrix)
 
-    return df
+    return read_edge_store(store_dir, rows=order, edges=edges)
 
 
 def compute_signif_permut_con_values(df, res_path, cond, alpha, labels,
@@ -627,7 +910,7 @@ def compute_signif_permut_con_values(df, res_path, cond, alpha, labels,
     signif_vect_higher = (res_higher < alpha) & (res_higher != -1)
     signif_vect_lower = (res_lower < alpha) & (res_lower != -1)
 
-    triu_indices_i, triu_indices_j = np.triu_indices(
+    triu_indices_i, triu_indices_j = triu_indices(
         signif_mat_higher.shape[0], k=1)
 
     signif_mat_higher[triu_indices_i, triu_indices_j] = signif_vect_higher
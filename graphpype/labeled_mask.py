@@ -9,18 +9,21 @@ The outputs of the functions will always be a labeled mask, with values
 starting from 1 (0 being the background image)
 """
 
-import nipype.interfaces.spm as spm
 from nipype.utils.filemanip import split_filename as split_f
 
 from graphpype.utils import check_np_dimension
+from graphpype.utils_cache import cached_call
 
 import itertools as iter
 
 import numpy as np
+import pandas as pd
 import nibabel as nib
 import glob
 import os
 
+from concurrent.futures import ThreadPoolExecutor
+
 
 from scipy import ndimage as ndimg
 from scipy.spatial.distance import cdist
@@ -65,188 +68,239 @@ def _coord_transform(x, y, z, affine):
 # from a list of MNI coords
 
 
-def create_indexed_mask(ref_img_file, MNI_coords_list, ROI_dir,
-                        ROI_mask_prefix="def", ROI_shape="cube", ROI_size=10):
-    """
-    Create indexed mask at the around ROI coords
+def _ROI_kernel_offsets(ROI_shape, ROI_size, pixdims):
+    """integer voxel offsets of a cube or sphere ROI of ROI_size mm,
+    computed once for all ROIs"""
+    pixdims = np.asarray(pixdims, dtype=float)
 
-        MNI_coords_list: list of list of 3 integer values in MNI space
-        ref_img_file: nifti1 file, the generated indexed mask
-        will use its shape and affine
-        ROI_shape: "cube", or "sphere"
-        ROI_size: ROI size in mm (from MNI space)
-    """
+    if ROI_shape == "cube":
 
-    np_coord = np.array(MNI_coords_list)
+        vox_dims = (float(ROI_size)/pixdims).astype(int)
 
-    if len(np_coord.shape) > 1:
+        print(vox_dims)
 
-        dist = cdist(np_coord, np_coord, metric='euclidean')
+        neigh_range = []
 
-        assert np.all(dist[np.triu_indices(dist.shape[0], k=1)]
-                      > ROI_size), "Error, distance < {}".format(ROI_size)
+        for vox_dim in vox_dims:
 
-    ref_img = nib.load(ref_img_file)
+            vox_neigh = vox_dim // 2
 
-    # data (shape)
-    ref_img_shape = ref_img.get_data().shape
+            # case odd vox_dim
+            if vox_dim % 2 == 1:
+                cur_range = np.arange(-vox_neigh, vox_neigh+1)
 
-    if len(ref_img_shape) == 4:
+            # case even vox_dim
+            else:
+                cur_range = np.arange(-vox_neigh+1, vox_neigh+1)
 
-        print("using 4D image for computing 3D mask, reducing shape")
+            neigh_range.append(cur_range)
 
-        ref_img_shape = ref_img_shape[:-1]
+        return np.stack(np.meshgrid(*neigh_range, indexing='ij'),
+                        axis=-1).reshape(-1, 3)
 
-    print(ref_img_shape)
+    elif ROI_shape == "sphere":
 
-    # affine
-    ref_img_affine = ref_img.affine
-    inv_affine = np.linalg.inv(ref_img_affine)
+        radius = ROI_size/2.0
 
-    # header
-    ref_img_hd = ref_img.header
-    pixdims = ref_img_hd['pixdim'][1:4]
+        vox_dims = (float(radius)/pixdims).astype(int)
 
-    # building indexed mask
-    indexed_mask_data = np.zeros(shape=ref_img_shape) - 1
+        print(vox_dims)
 
-    # shape of the ROI
-    if ROI_shape not in ["sphere", "cube"]:
+        neigh_range = [np.arange(-vox_dim, vox_dim+1) for vox_dim in vox_dims]
 
-        print("Warning, could not determine shape {}, using cube instead"
-              .format(ROI_shape))
+        neigh_coords = np.stack(np.meshgrid(*neigh_range, indexing='ij'),
+                                axis=-1).reshape(-1, 3)
 
-        ROI_shape = "cube"
+        neigh_dist = np.sum((neigh_coords*pixdims)**2, axis=1)
 
-    if ROI_shape == "cube":
+        return neigh_coords[neigh_dist < radius**2]
 
-        print("ROI_shape = cube")
+    raise ValueError("Error, unknown ROI_shape {}".format(ROI_shape))
 
-        vox_dims = list(map(int, float(ROI_size)/pixdims))
 
-        print(vox_dims)
+def rasterize_ROIs(ijk_centres, offsets, shape, overlap="last",
+                   pixdims=(1.0, 1.0, 1.0)):
+    """
+    Indexed mask of ROIs, each ROI being the offsets kernel placed at its
+    centre (in voxels): all voxels are computed with one broadcasted add,
+    clipped to the volume and written at once
+
+        ijk_centres: (nb_ROIs, 3) voxel coords (truncated to int, as int()
+        would do)
+        offsets: (nb_offsets, 3) integer offsets (see _ROI_kernel_offsets)
+        shape: shape of the (3D) mask
+        overlap: rule for voxels shared by several ROIs (always reported),
+        "last" (last ROI, as sequential writes), "nearest" (closest centre,
+        in mm) or "exclude" (set to background)
+
+    Returns the indexed mask (ROI index from 0, -1 for background) and the
+    number of voxels of each ROI
+    """
+    ijk_centres = np.asarray(ijk_centres, dtype=float).reshape(-1, 3)
+    offsets = np.asarray(offsets, dtype=int).reshape(-1, 3)
+    nb_ROIs = ijk_centres.shape[0]
 
-        neigh_range = []
+    assert overlap in ["nearest", "last", "exclude"], \
+        "Error, unknown overlap rule {}".format(overlap)
 
-        for vox_dim in vox_dims:
+    # (nb_ROIs, nb_offsets, 3) voxel positions
+    positions = np.trunc(ijk_centres[:, np.newaxis, :] +
+                         offsets[np.newaxis, :, :]).astype(int)
 
-            vox_neigh = vox_dim/2
+    in_volume = np.all((positions >= 0) & (positions < np.array(shape)),
+                       axis=2)
 
-            # case odd vox_dim
-            if vox_dim % 2 == 1:
+    labels = np.broadcast_to(np.arange(nb_ROIs)[:, np.newaxis],
+                             in_volume.shape)[in_volume]
+    positions = positions[in_volume]
 
-                cur_range = np.arange(-vox_neigh, vox_neigh+1)
+    flat_indexes = np.ravel_multi_index(positions.T, shape)
 
-            elif vox_dim % 2 == 0:
+    # sorted by voxel, then by priority
+    if overlap == "last":
+        priority = -labels
+    else:
+        priority = np.sum(((positions - ijk_centres[labels]) *
+                           np.asarray(pixdims, dtype=float))**2, axis=1)
 
-                cur_range = np.arange(-vox_neigh+1, vox_neigh+1)
+    order = np.lexsort((priority, flat_indexes))
 
-            neigh_range.append(cur_range)
+    flat_indexes = flat_indexes[order]
+    labels = labels[order]
 
-        ROI_coords = []
+    first = np.ones(len(flat_indexes), dtype=bool)
+    first[1:] = flat_indexes[1:] != flat_indexes[:-1]
 
-        for index_mask, MNI_coords in enumerate(MNI_coords_list):
+    if not np.all(first):
 
-            ijk_coord = _coord_transform(MNI_coords[0], MNI_coords[1],
-                                         MNI_coords[2], inv_affine)
+        shared = np.unique(flat_indexes[~first])
+        pairs = np.unique(np.stack((labels[np.where(~first)[0] - 1],
+                                    labels[~first]), axis=1), axis=0)
 
-            neigh_coords = np.array(
-                [list(i) for i in iter.product(*neigh_range)], dtype=int)
+        print("Warning, {} voxels shared by several ROIs ({} pairs of ROIs,\
+ e.g. {}), overlap rule: {}".format(len(shared), len(pairs),
+                                    pairs[:5].tolist(), overlap))
 
-            cur_coords = np.array([list(map(int, ijk_coord + neigh_coord))
-                                   for neigh_coord in neigh_coords])
+    keep = first
 
-            max_i, max_j, max_k = indexed_mask_data.shape
+    if overlap == "exclude":
+        keep = first & ~np.isin(flat_indexes, flat_indexes[~first])
 
-            keep = (0 <= cur_coords[:, 0]) & (cur_coords[:, 0] < max_i) & \
-                (0 <= cur_coords[:, 1]) & (cur_coords[:, 1] < max_j) & \
-                (0 <= cur_coords[:, 2]) & (cur_coords[:, 2] < max_k)
+    indexed_mask_data = np.zeros(shape=shape) - 1
+    indexed_mask_data.flat[flat_indexes[keep]] = labels[keep]
 
-            if np.all(keep is False):
-                continue
+    nb_voxels = np.bincount(labels[keep], minlength=nb_ROIs)
 
-            indexed_mask_data[cur_coords[keep, 0], cur_coords[keep, 1],
-                              cur_coords[keep, 2]] = index_mask
+    if np.any(nb_voxels == 0):
+        print("Warning, ROIs {} have no voxel in the mask".format(
+            np.where(nb_voxels == 0)[0].tolist()))
 
-            print(np.sum(indexed_mask_data == index_mask))
-            ROI_coords.append(ijk_coord)
+    return indexed_mask_data, nb_voxels
 
-    elif ROI_shape == "sphere":
 
-        print("building spheres of {} mm".format(ROI_size))
+def create_indexed_mask(ref_img_file, MNI_coords_list, ROI_dir,
+                        ROI_mask_prefix="def", ROI_shape="cube", ROI_size=10,
+                        overlap="last", cache_dir=None):
+    """
+    Create indexed mask at the around ROI coords
 
-        radius = ROI_size/2.0
+        MNI_coords_list: list of list of 3 integer values in MNI space
+        ref_img_file: nifti1 file, the generated indexed mask
+        will use its shape and affine
+        ROI_shape: "cube", or "sphere"
+        ROI_size: ROI size in mm (from MNI space)
+        overlap: rule for voxels shared by several ROIs (see
+        rasterize_ROIs)
+        cache_dir: if given, the mask is taken from (or stored in) the
+        atlas cache (see utils_cache)
+    """
+
+    np_coord = np.array(MNI_coords_list)
 
-        print(radius)
+    if len(np_coord.shape) > 1:
 
-        vox_dims = list(map(int, float(radius)/pixdims))
+        dist = cdist(np_coord, np_coord, metric='euclidean')
 
-        print(vox_dims)
+        assert np.all(dist[np.triu_indices(dist.shape[0], k=1)]
+                      > ROI_size), "Error, distance < {}".format(ROI_size)
 
-        r2_dim = []
-        neigh_range = []
+    # shape of the ROI
+    if ROI_shape not in ["sphere", "cube"]:
 
-        for i, vox_dim in enumerate(vox_dims):
+        print("Warning, could not determine shape {}, using cube instead"
+              .format(ROI_shape))
 
-            pixdim = pixdims[i]
+        ROI_shape = "cube"
 
-            cur_range = np.arange(-vox_dim, (vox_dim+1))
+    try:
+        os.makedirs(ROI_dir)
 
-            print(cur_range)
+    except OSError:
+        print("directory already created")
 
-            cur_r2 = (cur_range*pixdim)**2
+    indexed_mask_file = os.path.join(
+        ROI_dir, "indexed_mask-" + ROI_mask_prefix + ".nii")
 
-            print(cur_r2)
+    ROI_coords_file = os.path.join(
+        ROI_dir, "ROI_coords-" + ROI_mask_prefix + ".txt")
 
-            neigh_range.append(cur_range.tolist())
+    def _compute_indexed_mask():
 
-            r2_dim.append(cur_r2)
+        ref_img = nib.load(ref_img_file)
 
-        print(neigh_range)
+        # data (shape)
+        ref_img_shape = ref_img.shape
 
-        neigh_coords = np.array(
-            [list(i) for i in iter.product(*neigh_range)], dtype=int)
+        if len(ref_img_shape) == 4:
 
-        neigh_dist = np.array([np.sum(i) for i in iter.product(*r2_dim)])
+            print("using 4D image for computing 3D mask, reducing shape")
 
-        neigh_range = neigh_coords[neigh_dist < radius**2]
+            ref_img_shape = ref_img_shape[:-1]
 
-        ROI_coords = []
+        print(ref_img_shape)
 
-        # pour les ROI
-        for index_mask, MNI_coords in enumerate(MNI_coords_list):
+        # affine
+        ref_img_affine = ref_img.affine
+        inv_affine = np.linalg.inv(ref_img_affine)
 
-            ijk_coord = np.dot(inv_affine, np.array(
-                MNI_coords + [1], dtype='int'))[:-1]
+        # header
+        ref_img_hd = ref_img.header
+        pixdims = ref_img_hd['pixdim'][1:4]
 
-            ROI_coords.append(ijk_coord)
+        print("building {} of {} mm".format(ROI_shape, ROI_size))
 
-            cur_coords = np.array([list(map(int, ijk_coord + neigh_coord))
-                                   for neigh_coord in neigh_range.tolist()])
+        MNI_coords = np.array(MNI_coords_list, dtype=float).reshape(-1, 3)
 
-            indexed_mask_data[cur_coords[:, 0],
-                              cur_coords[:, 1], cur_coords[:, 2]] = index_mask
+        # ROI centres in voxels
+        if ROI_shape == "cube":
+            ROI_coords = np.transpose(_coord_transform(
+                MNI_coords[:, 0], MNI_coords[:, 1], MNI_coords[:, 2],
+                inv_affine)).reshape(-1, 3)
 
-            print(np.sum(indexed_mask_data == index_mask))
+        elif ROI_shape == "sphere":
+            ROI_coords = np.dot(MNI_coords.astype(int),
+                                inv_affine[:3, :3].T) + inv_affine[:3, 3]
 
-    try:
-        os.makedirs(ROI_dir)
+        offsets = _ROI_kernel_offsets(ROI_shape, ROI_size, pixdims)
 
-    except OSError:
-        print("directory already created")
+        indexed_mask_data, nb_voxels = rasterize_ROIs(
+            ROI_coords, offsets, ref_img_shape, overlap=overlap,
+            pixdims=pixdims)
 
-    indexed_mask_file = os.path.join(
-        ROI_dir, "indexed_mask-" + ROI_mask_prefix + ".nii")
+        print(nb_voxels)
 
-    # save ROI_coords_labelled_mask
-    nib.save(nib.Nifti1Image(indexed_mask_data,
-                             ref_img_affine), indexed_mask_file)
+        # save ROI_coords_labelled_mask
+        nib.save(nib.Nifti1Image(indexed_mask_data,
+                                 ref_img_affine), indexed_mask_file)
 
-    ROI_coords_file = os.path.join(
-        ROI_dir, "ROI_coords-" + ROI_mask_prefix + ".txt")
+        # save np coords
+        np.savetxt(ROI_coords_file, np.array(ROI_coords, dtype=int),
+                   fmt="%d")
 
-    # save np coords
-    np.savetxt(ROI_coords_file, np.array(ROI_coords, dtype=int), fmt="%d")
+    cached_call(cache_dir, [ref_img_file],
+                {"MNI_coords": np_coord.tolist(), "ROI_shape": ROI_shape,
+                 "ROI_size": ROI_size, "overlap": overlap},
+                [indexed_mask_file, ROI_coords_file], _compute_indexed_mask)
 
     return indexed_mask_file
 
@@ -309,198 +363,402 @@ def compute_ROI_nii_from_ROI_coords_files(
     return ROI_coords_labelled_mask_file
 
 
-def compute_labelled_mask_from_anat_ROIs(
-        ref_img_file, ROI_dir, list_ROI_img_files=[]):
+_interp_orders = {"nearest": 0, "linear": 1}
+
+
+def _ref_to_ROI_affine(ROI_affine, ref_affine, ROI_affines=None):
     """
-    compute labelled_mask from a list of img files,
-    presenting ROIs extracted from MRIcron in the nii or img format
-    each ROI is represented by a different IMG file and
-    should start by 'ROI_'. Resampling is done based on the shape of
-    ref_img_file
+    affine from the voxels of the reference grid to the voxels of the ROI
+    image; computed once for all ROI images with the same affine (kept in
+    ROI_affines)
     """
+    if ROI_affines is None:
+        ROI_affines = {}
 
-    ref_image = nib.load(ref_img_file)
+    key = ROI_affine.tobytes()
 
-    ref_image_data = ref_image.get_data()
+    if key not in ROI_affines:
+        ROI_affines[key] = np.dot(np.linalg.inv(ROI_affine), ref_affine)
+
+    return ROI_affines[key]
 
-    ref_image_data_shape = ref_image_data.shape
 
-    # case ref is 4D
-    if len(ref_image_data_shape) != 3:
+def _ref_block_coords(ref_to_ROI, ref_slices):
+    """
+    voxel coordinates, in the ROI image, of the voxels of a block (slices)
+    of the reference grid, (3, ) + block shape
+    """
+    block_shape = tuple(sl.stop - sl.start for sl in ref_slices)
 
-        mean_ref_data = np.mean(ref_image_data, axis=3)
+    ref_vox = np.indices(block_shape, dtype=float).reshape(3, -1)
+    ref_vox += np.array([sl.start for sl in ref_slices],
+                        dtype=float)[:, np.newaxis]
 
-        mean_ref_img_file = os.path.join(ROI_dir, "mean_ref.nii")
+    return (np.dot(ref_to_ROI[:3, :3], ref_vox) +
+            ref_to_ROI[:3, 3:]).reshape((3,) + block_shape)
 
-        nib.save(nib.Nifti1Image(mean_ref_data, ref_image.affine,
-                                 ref_image.header), mean_ref_img_file)
 
-        # reloading mean_file as ref_file
-        ref_image = nib.load(mean_ref_img_file)
+def resample_ROI_to_ref(ROI_data, ROI_affine, ref_affine, ref_shape,
+                        interp="nearest", ROI_affines=None):
+    """
+    Resample ROI data on a reference grid, in memory (map_coordinates,
+    interp "nearest" or "linear"), only within the bounding box of the non
+    zero voxels of the ROI
 
-        ref_image_data = ref_image.get_data()
+    ROI_affines: dict of precomputed ref to ROI affines (see
+    _ref_to_ROI_affine), shared between ROI images
 
-        ref_image_data_shape = ref_image_data.shape
+    Returns the slices of the reference grid and the resampled values
+    within (None, None if the ROI is empty or out of the reference grid)
+    """
+    ROI_data = np.asarray(ROI_data, dtype=float).reshape(ROI_data.shape[:3])
 
-    if len(list_ROI_img_files) == 0:
+    ROI_slices = ndimg.find_objects((ROI_data != 0).astype('int8'))
 
-        resliced_ROI_files = glob.glob(os.path.join(ROI_dir, "rROI*.nii"))
+    if len(ROI_slices) == 0:
+        return None, None
 
-        ROI_files = glob.glob(os.path.join(ROI_dir, "ROI*.nii"))
+    # bounding box (with a one voxel margin) in the reference grid
+    ROI_to_ref = np.dot(np.linalg.inv(ref_affine), ROI_affine)
 
-        if len(resliced_ROI_files) != len(ROI_files):
+    corners = np.array(list(iter.product(
+        *[(sl.start - 1, sl.stop) for sl in ROI_slices[0]])))
 
-            for i, ROI_file in enumerate(ROI_files):
+    ref_corners = np.dot(corners, ROI_to_ref[:3, :3].T) + ROI_to_ref[:3, 3]
 
-                ROI_image = nib.load(ROI_file)
+    ref_min = np.clip(np.floor(ref_corners.min(axis=0)).astype(int), 0,
+                      ref_shape)
+    ref_max = np.clip(np.ceil(ref_corners.max(axis=0)).astype(int) + 1, 0,
+                      ref_shape)
 
-                ROI_data = ROI_image.get_data()
+    if np.any(ref_max <= ref_min):
+        return None, None
 
-                print("Original ROI template {} shape: {}".
-                      format(i, ROI_data.shape))
+    ref_slices = tuple(slice(start, stop)
+                       for start, stop in zip(ref_min, ref_max))
 
-                reslice_ROI = spm.Reslice()
-                reslice_ROI.inputs.in_file = ROI_file
-                reslice_ROI.inputs.space_defining = ref_img_file
+    ref_to_ROI = _ref_to_ROI_affine(ROI_affine, ref_affine, ROI_affines)
 
-                resliced_ROI_file = reslice_ROI.run().outputs.out_file
+    values = ndimg.map_coordinates(
+        ROI_data, _ref_block_coords(ref_to_ROI, ref_slices),
+        order=_interp_orders[interp], mode='constant', cval=0.0)
 
-            resliced_ROI_files = glob.glob(os.path.join(ROI_dir, "rROI*.nii"))
-    else:
+    return ref_slices, values
 
-        ROI_files = [os.path.join(ROI_dir, ROI_img_file)
-                     for ROI_img_file in list_ROI_img_files]
 
-        print(ROI_files)
+def _build_labelled_mask(ref_img_file, ROI_files, interp, ROI_thr, overlap,
+                         n_jobs):
+    """labelled mask data and labels of ROI_files on the grid of
+    ref_img_file (see compute_labelled_mask_from_anat_ROIs)"""
+    # only the grid of ref is needed (case ref is 4D included)
+    ref_image = nib.load(ref_img_file)
 
-        resliced_ROI_files = []
+    ref_shape = tuple(ref_image.shape[:3])
 
-        for ROI_img_file in list_ROI_img_files:
-            full_ROI_img_file = os.path.join(ROI_dir, "r"+ROI_img_file)
-            if os.path.exists(full_ROI_img_file):
-                resliced_ROI_files.append(full_ROI_img_file)
+    ref_affine = ref_image.affine
 
-        print(resliced_ROI_files)
-        print(len(resliced_ROI_files))
+    ROI_affines = {}
 
-        if len(resliced_ROI_files) != len(ROI_files):
+    def _load_resample_ROI(ROI_file):
+        ROI_image = nib.load(ROI_file)
 
-            resliced_ROI_files = []
+        return resample_ROI_to_ref(np.asanyarray(ROI_image.dataobj),
+                                   ROI_image.affine, ref_affine, ref_shape,
+                                   interp=interp, ROI_affines=ROI_affines)
 
-            for i, ROI_file in enumerate(ROI_files):
+    labels = []
 
-                ROI_image = nib.load(ROI_file)
+    labelled_mask_data = np.zeros(shape=ref_shape, dtype='int') - 1
 
-                ROI_data = ROI_image.get_data()
+    if overlap == "max_prob":
+        max_prob_data = np.zeros(shape=ref_shape)
 
-                print("Original ROI template {} shape: {}".
-                      format(i, ROI_data.shape))
+    elif overlap == "exclude":
+        nb_ROIs_data = np.zeros(shape=ref_shape, dtype='int')
 
-                reslice_ROI = spm.Reslice()
-                reslice_ROI.inputs.in_file = ROI_file
-                reslice_ROI.inputs.space_defining = ref_img_file
+    with ThreadPoolExecutor(max_workers=max(n_jobs, 1)) as executor:
 
-                resliced_ROI_file = reslice_ROI.run().outputs.out_file
+        for i, (ref_slices, values) in enumerate(
+                executor.map(_load_resample_ROI, ROI_files)):
 
-                resliced_ROI_files.append(resliced_ROI_file)
+            path, fname, ext = split_f(ROI_files[i])
 
-    resliced_ROI_files.sort()
+            labels.append(fname)
 
-    print(resliced_ROI_files)
-    print(len(resliced_ROI_files))
+            if ref_slices is None:
+                print("Warning, ROI {} is empty on ref grid".format(fname))
+                continue
 
-    labels = []
+            in_ROI = values > ROI_thr
 
-    labelled_mask_data = np.zeros(shape=ref_image_data.shape, dtype='int') - 1
+            labelled_block = labelled_mask_data[ref_slices]
 
-    print(labelled_mask_data.shape)
+            if overlap == "last":
+                labelled_block[in_ROI] = i
 
-    for i, resliced_ROI_file in enumerate(resliced_ROI_files):
+            elif overlap == "max_prob":
+                max_prob_block = max_prob_data[ref_slices]
 
-        print(i)
+                in_ROI &= values > max_prob_block
 
-        path, fname, ext = split_f(resliced_ROI_file)
+                labelled_block[in_ROI] = i
+                max_prob_block[in_ROI] = values[in_ROI]
 
-        labels.append(fname)
+            elif overlap == "exclude":
+                labelled_block[in_ROI] = i
+                nb_ROIs_data[ref_slices] += in_ROI
 
-        resliced_ROI_img = nib.load(resliced_ROI_file)
+    if overlap == "exclude":
+        print("{} voxels in several ROIs excluded".format(
+            np.sum(nb_ROIs_data > 1)))
 
-        resliced_ROI_data = resliced_ROI_img.get_data()
+        labelled_mask_data[nb_ROIs_data > 1] = -1
 
-        print(resliced_ROI_data.shape)
+    print(np.unique(labelled_mask_data).shape)
 
-        print(np.sum(resliced_ROI_data != 0))
+    print(len(labels))
 
-        labelled_mask_data[resliced_ROI_data != 0] = i
+    return labelled_mask_data, labels
 
-        print(np.unique(labelled_mask_data))
 
-    print(np.unique(labelled_mask_data).shape)
+def compute_labelled_mask_from_anat_ROIs(
+        ref_img_file, ROI_dir, list_ROI_img_files=[], interp="nearest",
+        ROI_thr=0.0, overlap="last", n_jobs=4, cache_dir=None):
+    """
+    compute labelled_mask from a list of img files,
+    presenting ROIs extracted from MRIcron in the nii or img format
+    each ROI is represented by a different IMG file and
+    should start by 'ROI_'. Resampling is done based on the shape of
+    ref_img_file
 
-    print(len(labels))
+    All ROIs are loaded (by n_jobs threads) and resampled on the grid of
+    ref_img_file in memory (see resample_ROI_to_ref), voxels with a value
+    above ROI_thr belonging to the ROI. Voxels in several ROIs go to:
+        - "last": the last ROI (in file order)
+        - "max_prob": the ROI with the highest resampled value
+        - "exclude": none (background)
+
+    If cache_dir is given, the labelled mask is taken from (or stored in)
+    the atlas cache (see utils_cache)
+    """
+    assert interp in _interp_orders, \
+        "Error, interp should be in {}".format(list(_interp_orders))
+
+    assert overlap in ["last", "max_prob", "exclude"], \
+        "Error, overlap should be 'last', 'max_prob' or 'exclude'"
+
+    if len(list_ROI_img_files) == 0:
+        ROI_files = glob.glob(os.path.join(ROI_dir, "ROI*.nii"))
+
+    else:
+        ROI_files = [os.path.join(ROI_dir, ROI_img_file)
+                     for ROI_img_file in list_ROI_img_files]
+
+    ROI_files.sort()
+
+    print(ROI_files)
+    print(len(ROI_files))
 
-    # save labeled_mask
+    # labeled_mask and labels files
     labelled_mask_data_file = os.path.join(
         ROI_dir, "all_ROIs_labelled_mask.nii")
 
-    nib.save(nib.Nifti1Image(labelled_mask_data, ref_image.affine,
-                             ref_image.header), labelled_mask_data_file)
-
-    # save labels
     labels_list_file = os.path.join(ROI_dir, "labels_all_ROIs.txt")
-    np.savetxt(labels_list_file, np.array(labels, dtype='string'), fmt="%s")
+
+    def _save_labelled_mask():
+
+        ref_image = nib.load(ref_img_file)
+
+        labelled_mask_data, labels = _build_labelled_mask(
+            ref_img_file, ROI_files, interp, ROI_thr, overlap, n_jobs)
+
+        nib.save(nib.Nifti1Image(labelled_mask_data, ref_image.affine,
+                                 ref_image.header), labelled_mask_data_file)
+
+        np.savetxt(labels_list_file, np.array(labels, dtype='str'), fmt="%s")
+
+    cached_call(cache_dir, [ref_img_file] + ROI_files,
+                {"labels": [split_f(ROI_file)[1] for ROI_file in ROI_files],
+                 "interp": interp, "ROI_thr": ROI_thr, "overlap": overlap},
+                [labelled_mask_data_file, labels_list_file],
+                _save_labelled_mask)
 
     return labelled_mask_data_file, labels_list_file
 
 
-def compute_MNI_coords_from_indexed_template(indexed_template_file):
-    """
-    compute MNI coords from an indexed template
-    """
+def _return_ROI_files_base(indexed_template_file):
+    """directory and base name of the files describing an indexed
+    template (e.g. cube_ROI_1 for indexed_mask-cube_ROI_1.nii)"""
     path, base, ext = split_f(indexed_template_file)
 
-    print(base)
-
     if len(base.split("-")) > 1:
         base_name = base.split("-")[1]
     else:
         base_name = base
 
-    ref_image = nib.load(indexed_template_file)
+    return path, base_name
 
-    ref_image_data = ref_image.get_data()
 
-    print(ref_image_data.shape)
+ROI_table_columns = ["index", "nb_voxels", "i", "j", "k", "x", "y", "z",
+                     "i_min", "i_max", "j_min", "j_max", "k_min", "k_max"]
 
-    ref_image_affine = ref_image.affine
 
-    print(ref_image_affine)
+def compute_ROI_table(indexed_data, affine, background_val=None):
+    """
+    Voxel counts, centroids (in voxels, and in MNI space through affine)
+    and bounding boxes (first and last voxel along each axis) of all ROIs
+    of an indexed mask, in one pass over the mask voxels
+
+        background_val: value of the background (default, smallest value of
+        the mask); NaN are considered as background
+
+    Returns a DataFrame (columns ROI_table_columns), one line per ROI
+    sorted by index
+    """
+    indexed_data = np.asarray(indexed_data)
+
+    if background_val is None:
+        background_val = np.nanmin(indexed_data)
+
+    # ROIs from 1, 0 being the background (for bincount and find_objects)
+    shifted_data = np.rint(np.nan_to_num(
+        indexed_data - background_val, nan=0.0)).astype('int64')
+    shifted_data[shifted_data < 0] = 0
+
+    vox_coords = np.nonzero(shifted_data)
+    vox_labels = shifted_data[vox_coords]
+
+    nb_voxels = np.bincount(vox_labels)
+    ROI_labels = np.nonzero(nb_voxels)[0]
+
+    centroids = np.transpose([
+        np.bincount(vox_labels, weights=vox_coord,
+                    minlength=len(nb_voxels))[ROI_labels]
+        for vox_coord in vox_coords]) / nb_voxels[ROI_labels, np.newaxis]
+
+    ROI_slices = ndimg.find_objects(shifted_data)
+
+    return _build_ROI_table(ROI_labels + background_val,
+                            nb_voxels[ROI_labels], centroids,
+                            [ROI_slices[label-1] for label in ROI_labels],
+                            affine)
+
+
+def _build_ROI_table(ROI_index, nb_voxels, centroids, ROI_slices, affine):
+    """
+    private function, ROI table (see compute_ROI_table) from the voxel
+    counts, centroids (in voxels) and slices (from find_objects) of ROIs
+    """
+    centroids = np.asarray(centroids, dtype=float).reshape(-1, 3)
+
+    MNI_centroids = np.dot(centroids, affine[:3, :3].T) + affine[:3, 3]
+
+    bboxes = np.array([[(sl.start, sl.stop - 1) for sl in ROI_slice]
+                       for ROI_slice in ROI_slices],
+                      dtype='int64').reshape(-1, 6)
+
+    ROI_table = pd.DataFrame(
+        np.concatenate((centroids, MNI_centroids), axis=1),
+        columns=["i", "j", "k", "x", "y", "z"])
+
+    ROI_table.insert(0, "index", ROI_index)
+    ROI_table.insert(1, "nb_voxels", nb_voxels)
+
+    for col, bbox in zip(ROI_table_columns[8:], bboxes.T):
+        ROI_table[col] = bbox
+
+    return ROI_table
+
+
+def intersect_indexed_mask(indexed_data, filter_mask, background_val=-1.0,
+                           min_coverage=0.0):
+    """
+    Keep only voxels of an indexed mask within a (boolean) filter mask, and
+    relabel the remaining ROIs from 0 (-1 being the background), in one pass
+
+        background_val: value of the background in indexed_data (ROIs are
+        indexed from background_val + 1); NaN are considered as background
+
+        min_coverage: ROIs with a lower fraction of voxels within the filter
+        mask are dropped
+
+    Returns the relabelled mask (int64), the original index (from 0) of the
+    kept ROIs, and a DataFrame with the number of voxels, of voxels within
+    the filter mask and the coverage of each ROI of indexed_data
+    """
+    indexed_data = np.asarray(indexed_data)
+    filter_mask = np.asarray(filter_mask, dtype=bool)
+
+    assert filter_mask.shape == indexed_data.shape, \
+        ("error, filter_mask {} and indexed_rois {} should have the \
+            same shape".format(filter_mask.shape, indexed_data.shape))
+
+    # ROIs from 0, background (and NaN) to -1
+    ROI_data = np.rint(np.nan_to_num(indexed_data - (background_val + 1),
+                                     nan=-1.0)).astype('int64')
 
-    ROI_coords = []
+    in_ROIs = ROI_data >= 0
+    ROI_vox = ROI_data[in_ROIs]
 
-    ROI_MNI_coords = []
+    nb_voxels = np.bincount(ROI_vox)
+    nb_kept_voxels = np.bincount(ROI_vox[filter_mask[in_ROIs]],
+                                 minlength=len(nb_voxels))
 
-    for index in np.unique(ref_image_data)[1:]:
+    coverage = nb_kept_voxels / np.maximum(nb_voxels, 1)
 
-        i, j, k = np.where(ref_image_data == index)
+    keep_ROIs = (nb_kept_voxels > 0) & (coverage >= min_coverage)
 
-        mean_coord_ijk = np.mean(np.array((i, j, k)), axis=1)
+    index_corres = np.nonzero(keep_ROIs)[0]
 
-        print(mean_coord_ijk)
+    # lookup table, -1 for dropped ROIs and background
+    ROI_lut = np.zeros(len(nb_voxels) + 1, dtype='int64') - 1
+    ROI_lut[index_corres] = np.arange(len(index_corres))
 
-        ROI_coords.append(mean_coord_ijk)
+    ROI_data[~(in_ROIs & filter_mask)] = -1
+    filtered_data = ROI_lut[ROI_data]
 
-        MNI_coord = np.dot(ref_image_affine, np.append(mean_coord_ijk, 1))
+    coverage_ROIs = pd.DataFrame({"index": np.arange(len(nb_voxels)),
+                                  "nb_voxels": nb_voxels,
+                                  "nb_kept_voxels": nb_kept_voxels,
+                                  "coverage": coverage,
+                                  "kept": keep_ROIs})
 
-        print(MNI_coord)
+    coverage_ROIs = coverage_ROIs[nb_voxels > 0].reset_index(drop=True)
 
-        ROI_MNI_coords.append(MNI_coord[:3])
+    print("{} ROIs kept over {}".format(len(index_corres),
+                                        coverage_ROIs.shape[0]))
 
-    ROI_coords = np.array(ROI_coords, dtype=float)
+    return filtered_data, index_corres, coverage_ROIs
+
+
+def save_ROI_table(indexed_template_file, ROI_table):
+    """save the ROI table (csv) next to the indexed template"""
+    path, base_name = _return_ROI_files_base(indexed_template_file)
+
+    ROI_table_file = os.path.join(path, "ROI_table-" + base_name + ".csv")
+
+    ROI_table.to_csv(ROI_table_file, index=False, float_format="%.3f")
+
+    return ROI_table_file
+
+
+def load_ROI_table(ROI_table_file):
+    """load a ROI table saved by save_ROI_table"""
+    return pd.read_csv(ROI_table_file)
+
+
+def _save_ROI_coords(indexed_template_file, ROI_coords, affine):
+    """
+    save ROI coords (in voxels) and ROI MNI coords (through affine) files
+    next to the indexed template
+    """
+    path, base_name = _return_ROI_files_base(indexed_template_file)
+
+    ROI_coords = np.array(ROI_coords, dtype=float).reshape(-1, 3)
 
     print(ROI_coords)
 
-    ROI_MNI_coords = np.array(ROI_MNI_coords, dtype=float)
+    ROI_MNI_coords = np.dot(ROI_coords, affine[:3, :3].T) + affine[:3, 3]
 
     print(ROI_MNI_coords)
 
@@ -514,12 +772,138 @@ def compute_MNI_coords_from_indexed_template(indexed_template_file):
     np.savetxt(ROI_MNI_coords_file, ROI_MNI_coords, fmt="%.3f %.3f %.3f")
 
     return ROI_coords_file, ROI_MNI_coords_file
+
+
+def compute_MNI_coords_from_indexed_template(indexed_template_file):
+    """
+    compute MNI coords from an indexed template
+
+    The ROI table (see compute_ROI_table) is also saved as ROI_table-*.csv
+    """
+    ref_image = nib.load(indexed_template_file)
+
+    ref_image_data = np.asanyarray(ref_image.dataobj)
+
+    print(ref_image_data.shape)
+
+    ref_image_affine = ref_image.affine
+
+    print(ref_image_affine)
+
+    ROI_table = compute_ROI_table(ref_image_data, ref_image_affine)
+
+    save_ROI_table(indexed_template_file, ROI_table)
+
+    return _save_ROI_coords(indexed_template_file,
+                            ROI_table[["i", "j", "k"]].values,
+                            ref_image_affine)
     # nib.load(ref_img_file)
 
 
+def _segment_cubes(bin_mask_data, cub_size, min_frac_vox_in_bin_mask):
+    """
+    tiling of the volume in cubes of (2*cub_size+1) voxels, keeping cubes
+    with more than min_frac_vox_in_bin_mask of their voxels in the mask
+
+    In-mask fractions are computed with a block reduction, and labels
+    (cube index, -1 elsewhere) are written in one pass
+    """
+    cub_len = 2*cub_size+1
+
+    # number of complete cubes along each dimension
+    n_i, n_j, n_k = [dim_mask // cub_len for dim_mask in bin_mask_data.shape]
+
+    indexed_mask_data = np.zeros(shape=bin_mask_data.shape, dtype='int64')-1
+
+    if n_i * n_j * n_k == 0:
+        return indexed_mask_data
+
+    # (n_i, cub_len, n_j, cub_len, n_k, cub_len) view of the tiled volume
+    tiled_shape = (n_i, cub_len, n_j, cub_len, n_k, cub_len)
+
+    tiled_mask = (bin_mask_data[:n_i*cub_len, :n_j*cub_len,
+                                :n_k*cub_len] == 1).reshape(tiled_shape)
+
+    frac_vox_in_bin_mask = tiled_mask.sum(axis=(1, 3, 5))/float(cub_len**3)
+
+    keep = frac_vox_in_bin_mask > min_frac_vox_in_bin_mask
+
+    print("{} cubes kept over {} cubes with voxels in mask".format(
+        np.sum(keep), np.sum(frac_vox_in_bin_mask > 0)))
+
+    cube_labels = np.zeros(shape=keep.shape, dtype='int64')-1
+    cube_labels[keep] = np.arange(np.sum(keep))
+
+    indexed_mask_data[:n_i*cub_len, :n_j*cub_len, :n_k*cub_len] = \
+        np.broadcast_to(cube_labels[:, np.newaxis, :, np.newaxis, :,
+                                    np.newaxis],
+                        tiled_shape).reshape(n_i*cub_len, n_j*cub_len,
+                                             n_k*cub_len)
+
+    return indexed_mask_data
+
+
+def _segment_kmeans(bin_mask_data, pixdims, nb_ROIs, seed=0):
+    """
+    supervoxels: k-means clustering of the coordinates (in mm) of the mask
+    voxels, keeping the largest connected part of each cluster (other parts
+    are set to -1, as background)
+    """
+    from scipy.cluster.vq import kmeans2
+
+    vox_coords = np.array(np.where(bin_mask_data == 1)).T
+
+    assert vox_coords.shape[0] >= nb_ROIs, \
+        ("Error, {} voxels in mask for {} ROIs".format(vox_coords.shape[0],
+                                                       nb_ROIs))
+
+    _, vox_labels = kmeans2(vox_coords*np.asarray(pixdims, dtype=float),
+                            nb_ROIs, minit='++', seed=seed)
+
+    raw_indexed_mask_data = np.zeros(shape=bin_mask_data.shape,
+                                     dtype='int64')-1
+    raw_indexed_mask_data[tuple(vox_coords.T)] = vox_labels
+
+    indexed_mask_data = np.zeros(shape=bin_mask_data.shape, dtype='int64')-1
+
+    nb_removed = 0
+    val = 0
+
+    for index_ROI, ROI_slice in enumerate(
+            ndimg.find_objects(raw_indexed_mask_data + 1)):
+
+        if ROI_slice is None:
+            continue
+
+        comps, nb_comps = ndimg.label(
+            raw_indexed_mask_data[ROI_slice] == index_ROI)
+
+        largest_comp = np.argmax(np.bincount(comps.ravel())[1:]) + 1
+
+        indexed_mask_data[ROI_slice][comps == largest_comp] = val
+        nb_removed += np.sum((comps > 0) & (comps != largest_comp))
+        val = val + 1
+
+    print("{} supervoxels, {} voxels in disconnected parts removed".format(
+        val, nb_removed))
+
+    return indexed_mask_data
+
+
 def segment_mask_in_ROI(
         mask_file, save_dir=0, segment_type="cube", mask_thr=0.99,
-        min_count_voxel_in_ROI=100, cub_size=1, min_frac_vox_in_bin_mask=0.5):
+        min_count_voxel_in_ROI=100, cub_size=1, min_frac_vox_in_bin_mask=0.5,
+        nb_ROIs=0, seed=0):
+    """
+    segment_type:
+        - "cube": tiling in cubes of (2*cub_size+1) voxels, keeping cubes
+        with more than min_frac_vox_in_bin_mask of their voxels in the mask
+        - "disjoint_comp": connected components, with at least
+        min_count_voxel_in_ROI voxels
+        - "kmeans": supervoxels, k-means clustering (nb_ROIs clusters, by
+        default same mean size as cubes) of the voxel coordinates, keeping
+        the largest connected part of each cluster
+    """
 
     print(mask_file)
 
@@ -532,8 +916,6 @@ def segment_mask_in_ROI(
     mask_header = mask.header
     mask_affine = mask.affine
 
-    i_mask, j_mask, k_mask = mask_data.shape
-
     if 'int' in str(mask_data.dtype):
         bin_mask_data = mask_data
 
@@ -543,45 +925,22 @@ def segment_mask_in_ROI(
 
     if segment_type == "cube":
 
-        indexed_mask_data = np.zeros(
-            shape=bin_mask_data.shape, dtype='int64')-1
+        indexed_mask_data = _segment_cubes(bin_mask_data, cub_size,
+                                           min_frac_vox_in_bin_mask)
 
-        i_coords = np.arange(cub_size, i_mask-cub_size, step=2*cub_size+1)
-        j_coords = np.arange(cub_size, j_mask-cub_size, step=2*cub_size+1)
-        k_coords = np.arange(cub_size, k_mask-cub_size, step=2*cub_size+1)
-
-        cub_range = np.arange(-cub_size, cub_size+1)
-        print(cub_range)
-
-        val = 0
-        for x, y, z in iter.product(i_coords, j_coords, k_coords):
-
-            vox = []
-            vox_in_bin = []
-
-            for neigh in iter.product(cub_range, repeat=3):
-                if bin_mask_data[x+neigh[0], y+neigh[1], z+neigh[2]] == 1:
-                    vox_in_bin.append(neigh)
-                vox.append(neigh)
-
-            if len(vox_in_bin) == 0:
-                continue
-
-            frac_vox_in_bin_mask = len(vox)/float(len(vox_in_bin))
+        ROI_mask_prefix = segment_type + "_ROI_" + \
+            str(cub_size) + "_min_frac_" + str(min_frac_vox_in_bin_mask)
 
-            if frac_vox_in_bin_mask > min_frac_vox_in_bin_mask:
-                for neigh in iter.product(cub_range, repeat=3):
-                    indexed_mask_data[x+neigh[0], y+neigh[1], z+neigh[2]] = val
-                val = val + 1
+    elif segment_type == "kmeans":
 
-            else:
-                print("not enough voxels in bin_mask, percent = {}".format(
-                    frac_vox_in_bin_mask))
+        if nb_ROIs == 0:
+            nb_ROIs = max(1, int(np.sum(bin_mask_data == 1) //
+                                 (2*cub_size+1)**3))
 
-            print(val)
+        indexed_mask_data = _segment_kmeans(
+            bin_mask_data, mask_header['pixdim'][1:4], nb_ROIs, seed=seed)
 
-        ROI_mask_prefix = segment_type + "_ROI_" + \
-            str(cub_size) + "_min_frac_" + str(min_frac_vox_in_bin_mask)
+        ROI_mask_prefix = segment_type + "_ROI_" + str(nb_ROIs)
 
     elif segment_type == 'disjoint_comp':
 
@@ -589,28 +948,42 @@ def segment_mask_in_ROI(
 
         ROI_mask_prefix = segment_type + "_ROI_" + str(min_count_voxel_in_ROI)
 
-        raw_indexed_mask_rois_data = ndimg.label(bin_mask_data)[0]
+        raw_indexed_mask_rois_data, nb_comps = ndimg.label(bin_mask_data)
 
-        print(np.unique(raw_indexed_mask_rois_data))
+        # sizes of all components at once, 0 is the background
+        comp_sizes = np.bincount(raw_indexed_mask_rois_data.ravel(),
+                                 minlength=nb_comps+1)
 
-        for index_ROI in np.unique(raw_indexed_mask_rois_data):
-            count_voxel_in_ROI = np.sum(
-                raw_indexed_mask_rois_data == index_ROI)
+        keep = comp_sizes >= min_count_voxel_in_ROI
+        keep[0] = False
 
-            print(index_ROI, count_voxel_in_ROI)
+        print("{} components kept over {}".format(np.sum(keep), nb_comps))
 
-            if count_voxel_in_ROI < min_count_voxel_in_ROI:
-                raw_indexed_mask_rois_data[raw_indexed_mask_rois_data ==
-                                           index_ROI] = 0
+        # lookup table: dropping small components and reordering indexes
+        comp_lut = np.zeros(nb_comps+1, dtype='int64')-1
+        comp_lut[keep] = np.arange(np.sum(keep))
 
-        print(np.unique(raw_indexed_mask_rois_data))
+        indexed_mask_data = comp_lut[raw_indexed_mask_rois_data].astype(
+            float)
 
-        # reordering indexes
-        indexed_mask_data = np.zeros(
-            shape=raw_indexed_mask_rois_data.shape)
+        # centroids of the kept components, from the mask voxels
+        vox_coords = np.nonzero(raw_indexed_mask_rois_data)
+        vox_labels = comp_lut[raw_indexed_mask_rois_data[vox_coords]]
+        in_ROI = vox_labels > -1
 
-        for i, index_ROI in enumerate(np.unique(raw_indexed_mask_rois_data)):
-            indexed_mask_data[raw_indexed_mask_rois_data == index_ROI] = i-1
+        ROI_coords = np.transpose([
+            np.bincount(vox_labels[in_ROI], weights=vox_coord[in_ROI],
+                        minlength=np.sum(keep))
+            for vox_coord in vox_coords]) / comp_sizes[keep][:, np.newaxis]
+
+        # ROI table from the component sizes and centroids, bounding boxes
+        # of the components (labels of kept components are in keep order)
+        comp_slices = ndimg.find_objects(raw_indexed_mask_rois_data)
+
+        ROI_table = _build_ROI_table(
+            np.arange(np.sum(keep)), comp_sizes[keep], ROI_coords,
+            [comp_slices[label-1] for label in np.where(keep)[0]],
+            mask_affine)
 
     else:
         raise ValueError("Error, could not find segment_type {}".format(
@@ -624,7 +997,15 @@ def segment_mask_in_ROI(
         dataobj=indexed_mask_data, header=mask_header,
         affine=mask_affine), indexed_mask_rois_file)
 
-    ROI_coords_file, ROI_MNI_coords_file = \
-        compute_MNI_coords_from_indexed_template(indexed_mask_rois_file)
+    if segment_type != 'disjoint_comp':
+        # centroids from the data in memory, no need to reload the mask
+        ROI_table = compute_ROI_table(indexed_mask_data, mask_affine,
+                                      background_val=-1)
+
+    save_ROI_table(indexed_mask_rois_file, ROI_table)
+
+    ROI_coords_file, ROI_MNI_coords_file = _save_ROI_coords(
+        indexed_mask_rois_file, ROI_table[["i", "j", "k"]].values,
+        mask_affine)
 
     return indexed_mask_rois_file, ROI_coords_file, ROI_MNI_coords_file
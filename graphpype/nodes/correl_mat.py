@@ -24,10 +24,19 @@ from graphpype.utils_cor import (return_corres_correl_mat,
                                  return_conf_cor_mat, regress_parameters,
                                  filter_data, normalize_data,
                                  mean_select_mask_data,
-                                 mean_select_indexed_mask_data)
+                                 return_ROI_projection,
+                                 mask_ROI_projection, project_ROI_ts,
+                                 stream_group_cormats,
+                                 permut_group_mean_cormats,
+                                 label_group_mean_cormats)
+from graphpype.utils_stats import load_permut_plan, return_pooled_labels
 
 
 from graphpype.utils import check_np_dimension
+from graphpype.labeled_mask import intersect_indexed_mask
+from graphpype.utils_cache import cached_call
+from graphpype.utils_condensed import (load_sym_mat, save_sym_mat,
+                                       condense_sym_mat, nb_edges_from_size)
 
 
 # ExtractTS
@@ -61,6 +70,17 @@ class ExtractTSInputSpec(BaseInterfaceInputSpec):
         -1.0, desc='value for background (i.e. outside brain)',
         usedefault=True)
 
+    filter_mask_file = File(
+        exists=True, desc='nii file with (binary) subject mask, voxels \
+            outside are not used for averaging')
+
+    filter_thr = traits.Float(0.99, usedefault=True,
+                              desc='Value to threshold filter_mask')
+
+    cache_dir = traits.Str(
+        desc='directory of the atlas cache (see utils_cache), the projection \
+            operator is reused for the same indexed_rois_file content')
+
 
 class ExtractTSOutputSpec(TraitedSpec):
 
@@ -124,6 +144,27 @@ class ExtractTS(BaseInterface):
             desc='value for background (i.e. outside brain)',
             usedefault = True
 
+        filter_mask_file:
+            type = File, exists=True,
+            desc='nii file with (binary) subject mask, voxels outside are
+            not used for averaging'
+
+        filter_thr:
+            type = Float, default = 0.99, usedefault = True,
+            desc='Value to threshold filter_mask'
+
+        cache_dir:
+            type = Str,
+            desc='directory of the atlas cache (see utils_cache), the
+            projection operator is reused for the same indexed_rois_file
+            content'
+
+    Comments:
+
+    The voxels to ROIs projection operator (see build_ROI_projection) is
+    saved in the node directory (ROI_projection.npz); with cache_dir, it is
+    built once for all subjects
+
     Outputs:
 
         mean_masked_ts_file:
@@ -151,16 +192,26 @@ class ExtractTS(BaseInterface):
         background_val = self.inputs.background_val
         plot_fig = self.inputs.plot_fig
 
-        # loading ROI indexed mask
-        indexed_rois_img = nib.load(indexed_rois_file)
-        indexed_mask_rois_data = indexed_rois_img.get_data()
+        # projection from voxels to ROIs of the indexed mask
+        cache_dir = self.inputs.cache_dir if isdefined(
+            self.inputs.cache_dir) else None
+
+        projection, ROI_index = return_ROI_projection(
+            indexed_rois_file, os.path.abspath("ROI_projection.npz"),
+            background_val=background_val, cache_dir=cache_dir)
+
+        if isdefined(self.inputs.filter_mask_file):
+            filter_mask_data = np.asanyarray(nib.load(
+                self.inputs.filter_mask_file).dataobj) > self.inputs.filter_thr
+
+            projection = mask_ROI_projection(projection, filter_mask_data)
 
         # loading time series
-        orig_ts = nib.load(file_4D).get_data()
+        orig_ts = np.asanyarray(nib.load(file_4D).dataobj)
 
-        mean_masked_ts, keep_rois = mean_select_indexed_mask_data(
-            orig_ts, indexed_mask_rois_data, min_BOLD_intensity,
-            percent_signal=percent_signal, background_val=background_val)
+        mean_masked_ts, keep_rois = project_ROI_ts(
+            projection, orig_ts, min_BOLD_intensity,
+            percent_signal=percent_signal, ROI_index=ROI_index)
 
         # loading ROI coordinates
         if isdefined(self.inputs.MNI_coord_rois_file):
@@ -257,6 +308,14 @@ class IntersectMaskInputSpec(BaseInterfaceInputSpec):
         -1.0, desc='value for background (i.e. outside brain)',
         usedefault=True)
 
+    min_coverage = traits.Float(
+        0.0, usedefault=True,
+        desc='ROIs with a lower fraction of voxels in filter_mask are dropped')
+
+    cache_dir = traits.Str(
+        desc='directory of the atlas cache (see utils_cache), outputs are \
+            reused for the same inputs content and parameters')
+
 
 class IntersectMaskOutputSpec(TraitedSpec):
 
@@ -274,6 +333,11 @@ class IntersectMaskOutputSpec(TraitedSpec):
     filtered_MNI_coords_rois_file = File(
         exists=False, desc='filtered MNI coords txt file')
 
+    coverage_rois_file = File(
+        exists=True,
+        desc='csv file with number of voxels, number of voxels in filter_mask\
+            and coverage of each ROI')
+
 
 class IntersectMask(BaseInterface):
     """
@@ -314,6 +378,16 @@ class IntersectMask(BaseInterface):
             desc='value for background (i.e. outside brain)',
             usedefault = True
 
+        min_coverage:
+            type = Float, default = 0.0, usedefault = True,
+            desc='ROIs with a lower fraction of voxels in filter_mask are
+            dropped'
+
+        cache_dir:
+            type = Str,
+            desc='directory of the atlas cache (see utils_cache), outputs are
+            reused for the same inputs content and parameters'
+
     Outputs:
 
         filtered_indexed_rois_file:
@@ -330,12 +404,42 @@ class IntersectMask(BaseInterface):
         filtered_MNI_coords_rois_file:
             type = File, exists=False, desc='filtered MNI coords txt file'
 
+        coverage_rois_file:
+            type = File, exists=True,
+            desc='csv file with number of voxels, number of voxels in
+            filter_mask and coverage of each ROI'
+
     """
     input_spec = IntersectMaskInputSpec
     output_spec = IntersectMaskOutputSpec
 
     def _run_interface(self, runtime):
 
+        input_files = [self.inputs.indexed_rois_file,
+                       self.inputs.filter_mask_file]
+
+        input_files += [in_file if isdefined(in_file) else None
+                        for in_file in [self.inputs.coords_rois_file,
+                                        self.inputs.MNI_coords_rois_file,
+                                        self.inputs.labels_rois_file]]
+
+        params = {"filter_thr": self.inputs.filter_thr,
+                  "background_val": self.inputs.background_val,
+                  "min_coverage": self.inputs.min_coverage}
+
+        cache_dir = self.inputs.cache_dir if isdefined(
+            self.inputs.cache_dir) else None
+
+        out_files = [out_file for out_file in self._list_outputs().values()
+                     if isdefined(out_file)]
+
+        cached_call(cache_dir, input_files, params, out_files,
+                    self._intersect_mask)
+
+        return runtime
+
+    def _intersect_mask(self):
+
         indexed_rois_file = self.inputs.indexed_rois_file
         filter_mask_file = self.inputs.filter_mask_file
         coords_rois_file = self.inputs.coords_rois_file
@@ -344,56 +448,31 @@ class IntersectMask(BaseInterface):
         background_val = self.inputs.background_val
 
         filter_thr = self.inputs.filter_thr
+        min_coverage = self.inputs.min_coverage
 
         # loading ROI indexed mask
         indexed_rois_img = nib.load(indexed_rois_file)
-        indexed_rois_data = indexed_rois_img.get_data()
-        indexed_rois_data[np.isnan(indexed_rois_data)] = background_val
-
-        # loading time series
-        filter_mask_data = nib.load(filter_mask_file).get_data()
-
-        assert filter_mask_data.shape == indexed_rois_data.shape, \
-            ("error, filter_mask {} and indexed_rois {} should have the \
-                same shape".format(filter_mask_data.shape,
-                                   indexed_rois_data.shape))
-
-        filter_mask_data[filter_mask_data > filter_thr] = 1.0
-        filter_mask_data[filter_mask_data <= filter_thr] = 0.0
-
-        # keep_rois_data
-        if background_val == -1.0:
+        indexed_rois_data = np.asanyarray(indexed_rois_img.dataobj)
 
-            val = filter_mask_data*(indexed_rois_data.copy()+1) - 1
-            keep_rois_data = np.array(val, dtype='int64')
+        # loading filter mask
+        filter_mask_data = np.asanyarray(
+            nib.load(filter_mask_file).dataobj) > filter_thr
 
-        elif background_val == 0.0:
-            keep_rois_data = np.array(filter_mask_data * indexed_rois_data,
-                                      dtype='int64')
-
-        # reorder_indexed_rois (starting from -1 (background) and raising by 1
-        # for all available ROI
-        reorder_indexed_rois_data = np.zeros(
-            shape=keep_rois_data.shape, dtype='int64') - 1
-
-        for i, index in enumerate(np.unique(keep_rois_data)[1:]):
-            assert np.sum(np.array(keep_rois_data == index, dtype=int)), \
-                ("Error, could not find value {} in \
-                 keep_rois_data".format(index))
-            reorder_indexed_rois_data[keep_rois_data == index] = i
+        # keep ROI voxels in filter mask, and reorder indexed rois (starting
+        # from -1 (background) and raising by 1 for all available ROI)
+        reorder_indexed_rois_data, index_corres, coverage_rois = \
+            intersect_indexed_mask(indexed_rois_data, filter_mask_data,
+                                   background_val=background_val,
+                                   min_coverage=min_coverage)
 
         nib.save(nib.Nifti1Image(
             reorder_indexed_rois_data,
-            indexed_rois_img.get_affine(),
-            indexed_rois_img.get_header()),
+            indexed_rois_img.affine,
+            indexed_rois_img.header),
             os.path.abspath("reorder_filtered_indexed_rois.nii"))
 
-        # index_corres
-        if background_val == -1.0:
-            index_corres = np.unique(keep_rois_data)[1:]
-
-        elif background_val == 0.0:
-            index_corres = np.unique(keep_rois_data)[1:]-1
+        coverage_rois.to_csv(os.path.abspath("coverage_rois.csv"),
+                             index=False)
 
         # if ROI coordinates
         if isdefined(coords_rois_file):
@@ -423,8 +502,6 @@ class IntersectMask(BaseInterface):
             np.savetxt(filtered_labels_rois_file,
                        filtered_labels_rois, fmt="%s")
 
-        return runtime
-
     def _list_outputs(self):
 
         outputs = self._outputs().get()
@@ -432,6 +509,8 @@ class IntersectMask(BaseInterface):
         outputs["filtered_indexed_rois_file"] = os.path.abspath(
             "reorder_filtered_indexed_rois.nii")
 
+        outputs["coverage_rois_file"] = os.path.abspath("coverage_rois.csv")
+
         if isdefined(self.inputs.coords_rois_file):
             outputs["filtered_coords_rois_file"] = os.path.abspath(
                 "filtered_coords_rois.txt")
@@ -1294,6 +1373,11 @@ class ComputeConfCorMatInputSpec(BaseInterfaceInputSpec):
         usedefault=True,
         desc='Method used for computing correlation -default Pearson')
 
+    save_condensed = traits.Bool(
+        False, usedefault=True, mandatory=False,
+        desc='Also save Z_cor_mat in condensed form (upper triangle only, \
+            float32, .npz format)')
+
 
 class ComputeConfCorMatOutputSpec(TraitedSpec):
 
@@ -1314,6 +1398,11 @@ class ComputeConfCorMatOutputSpec(TraitedSpec):
         desc="npy file containing the Z-values (after Fisher's R-to-Z \
             trasformation) of correlation")
 
+    Z_cor_mat_condensed_file = File(
+        exists=True,
+        desc="npz file containing the upper triangle of the Z-values \
+            (only if save_condensed)")
+
 
 class ComputeConfCorMat(BaseInterface):
     """
@@ -1351,6 +1440,11 @@ class ComputeConfCorMat(BaseInterface):
             desc='Name of the nodes (used only if plot = true)',
             mandatory=False
 
+        save_condensed:
+            type = Bool, default = False, usedefault = True,
+            desc='Also save Z_cor_mat in condensed form (upper triangle only,
+            float32, .npz format)', mandatory=False
+
     Outputs:
 
         cor_mat_file:
@@ -1366,6 +1460,11 @@ class ComputeConfCorMat(BaseInterface):
             type = File, exists=True,
             desc="npy file containing the confidence interval around R values"
 
+        Z_cor_mat_condensed_file:
+            type = File, exists=True,
+            desc="npz file containing the upper triangle of the Z-values
+            (only if save_condensed)"
+
     """
 
     input_spec = ComputeConfCorMatInputSpec
@@ -1420,6 +1519,17 @@ class ComputeConfCorMat(BaseInterface):
             Z_cor_mat_file = os.path.abspath('Z_cor_mat_' + fname + '.npy')
             np.save(Z_cor_mat_file, Z_cor_mat)
 
+            if self.inputs.save_condensed:
+                if isdefined(labels_file):
+                    labels = [line.strip() for line in open(labels_file)]
+                else:
+                    labels = None
+
+                Z_cor_mat_condensed_file = os.path.abspath(
+                    'Z_cor_mat_' + fname + '.npz')
+                save_sym_mat(Z_cor_mat_condensed_file, Z_cor_mat,
+                             labels=labels)
+
             # saving Z_conf_cor_mat as npy
             Z_conf_cor_mat_file = os.path.abspath(
                 'Z_conf_cor_mat_' + fname + '.npy')
@@ -1525,6 +1635,10 @@ class ComputeConfCorMat(BaseInterface):
         outputs["Z_conf_cor_mat_file"] = os.path.abspath(
             'Z_conf_cor_mat_' + fname + '.npy')
 
+        if self.inputs.save_condensed:
+            outputs["Z_cor_mat_condensed_file"] = os.path.abspath(
+                'Z_cor_mat_' + fname + '.npz')
+
         return outputs
 
 
@@ -1714,6 +1828,13 @@ class PrepareMeanCorrelInputSpec(BaseInterfaceInputSpec):
 
     export_csv = traits.Bool(False, usedefault=True, mandatory=False)
 
+    subject_major = traits.Bool(
+        False, usedefault=True, mandatory=False,
+        desc='if True, group_cor_mat_matrix is (nb_subjects, nb_nodes, \
+            nb_nodes) instead of (nb_nodes, nb_nodes, nb_subjects); without \
+            correspondance (coords_files or labels_files), it is always \
+            (nb_subjects, nb_nodes, nb_nodes), as before')
+
 
 class PrepareMeanCorrelOutputSpec(TraitedSpec):
 
@@ -1732,6 +1853,10 @@ class PrepareMeanCorrelOutputSpec(TraitedSpec):
         exists=True,
         desc="npy file containing the average of all correlation matrices")
 
+    var_cor_mat_matrix_file = File(
+        exists=True,
+        desc="npy file containing the variance of all correlation matrices")
+
 
 class PrepareMeanCorrel(BaseInterface):
     """
@@ -1761,12 +1886,21 @@ class PrepareMeanCorrel(BaseInterface):
     plot_mat:
         type = Bool; default = True, usedefault = True, mandatory = False
 
+    subject_major:
+        type = Bool, default = False, usedefault = True, mandatory = False,
+        desc='if True, group_cor_mat_matrix is (nb_subjects, nb_nodes,
+        nb_nodes) instead of (nb_nodes, nb_nodes, nb_subjects); without
+        correspondance (coords_files or labels_files), it is always
+        (nb_subjects, nb_nodes, nb_nodes), as before'
 
     Outputs:
 
     group_cor_mat_matrix_file:
         type = File,exists=True,
-        desc="npy file containing all correlation matrices in 3D"
+        desc="npy file containing all correlation matrices in 3D (written
+        subject by subject in a memory-mapped file). Without coords or
+        labels, matrices are always stacked as (nb_subjects, nb_nodes,
+        nb_nodes)"
 
     sum_cor_mat_matrix_file
         type = File,exists=True,
@@ -1780,6 +1914,11 @@ class PrepareMeanCorrel(BaseInterface):
     avg_cor_mat_matrix_file:
         type = File, exists=True,
         desc="npy file containing the average of all correlation matrices"
+
+    var_cor_mat_matrix_file:
+        type = File, exists=True,
+        desc="npy file containing the variance of all correlation matrices
+        (computed on the fly, only where edges are defined)"
     """
 
     input_spec = PrepareMeanCorrelInputSpec
@@ -1793,6 +1932,7 @@ class PrepareMeanCorrel(BaseInterface):
         gm_mask_labels_file = self.inputs.gm_mask_labels_file
         plot_mat = self.inputs.plot_mat
         export_csv = self.inputs.export_csv
+        subject_major = self.inputs.subject_major
 
         if isdefined(gm_mask_labels_file):
 
@@ -1804,6 +1944,9 @@ class PrepareMeanCorrel(BaseInterface):
         else:
             labels = []
 
+        self.group_cor_mat_matrix_file = os.path.abspath(
+            'group_cor_mat_matrix.npy')
+
         if isdefined(self.inputs.gm_mask_coords_file) and\
                 isdefined(self.inputs.coords_files):
 
@@ -1813,30 +1956,25 @@ class PrepareMeanCorrel(BaseInterface):
             gm_mask_coords = np.array(
                 np.loadtxt(gm_mask_coords_file), dtype=int)
 
-            sum_cor_mat_matrix = np.zeros(
-                (gm_mask_coords.shape[0], gm_mask_coords.shape[0]),
-                dtype=float)
-
-            sum_possible_edge_matrix = np.zeros(
-                (gm_mask_coords.shape[0], gm_mask_coords.shape[0]), dtype=int)
-
-            group_cor_mat_matrix = np.zeros(
-                (gm_mask_coords.shape[0], gm_mask_coords.shape[0],
-                 len(cor_mat_files)), dtype=float)
-
             assert len(cor_mat_files) == len(coords_files), \
                 ("Error, length of cor_mat_files and coords_files are \
                     imcompatible {} {}".format(len(cor_mat_files),
                                                len(coords_files)))
 
-            for index_file in range(len(cor_mat_files)):
+            def iter_corres_cormats():
+
+                for index_file in range(len(cor_mat_files)):
 
-                print(cor_mat_files[index_file])
+                    print(cor_mat_files[index_file])
 
-                if os.path.exists(cor_mat_files[index_file]) and\
-                        os.path.exists(coords_files[index_file]):
+                    if not (os.path.exists(cor_mat_files[index_file]) and
+                            os.path.exists(coords_files[index_file])):
+                        print("Warning, one or more files between {} and {} \
+                            is missing".format(cor_mat_files[index_file],
+                                               coords_files[index_file]))
+                        continue
 
-                    Z_cor_mat = np.load(cor_mat_files[index_file])
+                    Z_cor_mat = load_sym_mat(cor_mat_files[index_file])
 
                     coords = np.array(np.loadtxt(
                         coords_files[index_file]), dtype=int)
@@ -1845,16 +1983,17 @@ class PrepareMeanCorrel(BaseInterface):
                         return_corres_correl_mat(Z_cor_mat, coords,
                                                  gm_mask_coords)
 
-                    np.fill_diagonal(corres_cor_mat, 0)
                     np.fill_diagonal(possible_edge_mat, 1)
-                    sum_cor_mat_matrix += corres_cor_mat
-                    sum_possible_edge_matrix += possible_edge_mat
-                    group_cor_mat_matrix[:, :, index_file] = corres_cor_mat
 
-                else:
-                    print("Warning, one or more files between {} and {} is \
-                        missing".format(cor_mat_files[index_file],
-                                        coords_files[index_file]))
+                    yield index_file, corres_cor_mat, possible_edge_mat
+
+            group_cor_mat_matrix, sum_cor_mat_matrix, \
+                sum_possible_edge_matrix, avg_cor_mat_matrix, \
+                var_cor_mat_matrix = stream_group_cormats(
+                    iter_corres_cormats(), len(cor_mat_files),
+                    gm_mask_coords.shape[0],
+                    group_cormat_file=self.group_cor_mat_matrix_file,
+                    subject_major=subject_major)
 
         elif isdefined(self.inputs.gm_mask_labels_file) and \
                 isdefined(self.inputs.labels_files):
@@ -1864,24 +2003,23 @@ class PrepareMeanCorrel(BaseInterface):
             gm_mask_labels = [line.strip()
                               for line in open(gm_mask_labels_file)]
 
-            gm_size = len(gm_mask_labels)
-            sum_cor_mat_matrix = np.zeros((gm_size, gm_size), dtype=float)
-            sum_possible_edge_matrix = np.zeros((gm_size, gm_size), dtype=int)
-
-            group_cor_mat_matrix = np.zeros(
-                (gm_size, gm_size, len(cor_mat_files)), dtype=float)
-
             assert len(cor_mat_files) == len(labels_files), \
                 ("warning, length of cor_mat_files, labels_files are \
-                    imcompatible {} {} {}".format(len(cor_mat_files),
-                                                  len(labels_files)))
+                    imcompatible {} {}".format(len(cor_mat_files),
+                                               len(labels_files)))
+
+            def iter_corres_cormats():
 
-            for i in range(len(cor_mat_files)):
+                for i in range(len(cor_mat_files)):
 
-                if os.path.exists(cor_mat_files[i]) and \
-                        os.path.exists(labels_files[i]):
+                    if not (os.path.exists(cor_mat_files[i]) and
+                            os.path.exists(labels_files[i])):
+                        print("Warning, one or more files between {} {} do \
+                            not exists".format(cor_mat_files[i],
+                                               labels_files[i]))
+                        continue
 
-                    Z_cor_mat = np.load(cor_mat_files[i])
+                    Z_cor_mat = load_sym_mat(cor_mat_files[i])
                     print(Z_cor_mat.shape)
 
                     labels = [line.strip() for line in open(labels_files[i])]
@@ -1895,29 +2033,42 @@ class PrepareMeanCorrel(BaseInterface):
 
                     np.fill_diagonal(possible_edge_mat, 1)
 
-                    sum_cor_mat_matrix += corres_cor_mat
+                    yield i, corres_cor_mat, possible_edge_mat
 
-                    sum_possible_edge_matrix += possible_edge_mat
+            group_cor_mat_matrix, sum_cor_mat_matrix, \
+                sum_possible_edge_matrix, avg_cor_mat_matrix, \
+                var_cor_mat_matrix = stream_group_cormats(
+                    iter_corres_cormats(), len(cor_mat_files),
+                    len(gm_mask_labels),
+                    group_cormat_file=self.group_cor_mat_matrix_file,
+                    subject_major=subject_major)
 
-                    group_cor_mat_matrix[:, :, i] = corres_cor_mat
+        else:
 
-                else:
-                    print("Warning, one or more files between {} {} do not \
-                        exists".format(cor_mat_files[i], labels_files[i]))
+            # no correspondance, matrices are stacked subject-major
+            # whatever subject_major (as it was always the case in this
+            # branch)
+            exist_cor_mat_files = [cor_mat_file
+                                   for cor_mat_file in cor_mat_files
+                                   if os.path.exists(cor_mat_file)]
 
-        else:
+            assert len(exist_cor_mat_files), \
+                "Error, none of the {} cor_mat files exists".format(
+                    len(cor_mat_files))
 
-            group_cor_mat_matrix = np.array(
-                [np.load(cor_mat_file) for cor_mat_file in cor_mat_files
-                    if os.path.exists(cor_mat_file)])
-            sum_cor_mat_matrix = np.sum(group_cor_mat_matrix, axis=0)
-            sum_possible_edge_matrix = np.ones(
-                shape=sum_cor_mat_matrix.shape)*len(cor_mat_files)
+            mat_size = load_sym_mat(exist_cor_mat_files[0],
+                                    mmap_mode='r').shape[0]
 
-        self.group_cor_mat_matrix_file = os.path.abspath(
-            'group_cor_mat_matrix.npy')
+            group_cor_mat_matrix, sum_cor_mat_matrix, \
+                sum_possible_edge_matrix, avg_cor_mat_matrix, \
+                var_cor_mat_matrix = stream_group_cormats(
+                    ((i, load_sym_mat(cor_mat_file), None)
+                     for i, cor_mat_file in enumerate(exist_cor_mat_files)),
+                    len(exist_cor_mat_files), mat_size,
+                    group_cormat_file=self.group_cor_mat_matrix_file,
+                    subject_major=True)
 
-        np.save(self.group_cor_mat_matrix_file, group_cor_mat_matrix)
+        del group_cor_mat_matrix
 
         self.sum_cor_mat_matrix_file = os.path.abspath(
             'sum_cor_mat_matrix.npy')
@@ -1929,45 +2080,23 @@ class PrepareMeanCorrel(BaseInterface):
 
         np.save(self.sum_possible_edge_matrix_file, sum_possible_edge_matrix)
 
-        self.avg_cor_mat_matrix_file = os.path.abspath(
-            'avg_cor_mat_matrix.npy')
-
-        if np.sum(np.array(sum_possible_edge_matrix == 0)) == 0:
-
-            avg_cor_mat_matrix = np.divide(
-                np.array(sum_cor_mat_matrix, dtype=float),
-                np.array(sum_possible_edge_matrix, dtype=float))
+        self.var_cor_mat_matrix_file = os.path.abspath(
+            'var_cor_mat_matrix.npy')
 
-            avg_cor_mat_matrix[np.isnan(avg_cor_mat_matrix)] = 0.0
+        np.save(self.var_cor_mat_matrix_file, var_cor_mat_matrix)
 
-            np.save(self.avg_cor_mat_matrix_file, avg_cor_mat_matrix)
-
-            if export_csv:
-                csv_avg_cor_mat_matrix_file = os.path.abspath(
-                    'avg_cor_mat_matrix.csv')
-                df = pd.DataFrame(avg_cor_mat_matrix,
-                                  index=labels, columns=labels)
-                df.to_csv(csv_avg_cor_mat_matrix_file)
-
-        else:
-
-            avg_cor_mat_matrix = np.divide(
-                np.array(sum_cor_mat_matrix, dtype=float),
-                np.array(sum_possible_edge_matrix, dtype=float))
-
-            avg_cor_mat_matrix[np.isnan(avg_cor_mat_matrix)] = 0.0
-
-            np.save(self.avg_cor_mat_matrix_file, avg_cor_mat_matrix)
-
-            if export_csv:
-
-                csv_avg_cor_mat_matrix_file = os.path.abspath(
-                    'avg_cor_mat_matrix.csv')
+        self.avg_cor_mat_matrix_file = os.path.abspath(
+            'avg_cor_mat_matrix.npy')
 
-                df = pd.DataFrame(avg_cor_mat_matrix,
-                                  index=labels, columns=labels)
+        # running mean is 0 where no edge is defined
+        np.save(self.avg_cor_mat_matrix_file, avg_cor_mat_matrix)
 
-                df.to_csv(csv_avg_cor_mat_matrix_file)
+        if export_csv:
+            csv_avg_cor_mat_matrix_file = os.path.abspath(
+                'avg_cor_mat_matrix.csv')
+            df = pd.DataFrame(avg_cor_mat_matrix,
+                              index=labels, columns=labels)
+            df.to_csv(csv_avg_cor_mat_matrix_file)
 
         if plot_mat:
 
@@ -1988,6 +2117,7 @@ class PrepareMeanCorrel(BaseInterface):
         outputs["sum_possible_edge_matrix_file"] = \
             self.sum_possible_edge_matrix_file
         outputs["avg_cor_mat_matrix_file"] = self.avg_cor_mat_matrix_file
+        outputs["var_cor_mat_matrix_file"] = self.var_cor_mat_matrix_file
 
         return outputs
 
@@ -2009,6 +2139,17 @@ class PreparePermutMeanCorrelInputSpec(BaseInterfaceInputSpec):
 
     seed = traits.Int(0, usedefault=True, decs='Start of random process')
 
+    nb_permuts = traits.Int(
+        0, usedefault=True,
+        desc='If > 0, batch mode: the matrices are loaded once and nb_permuts \
+            permutations are computed (one random stream per permutation)')
+
+    permut_plan_file = File(
+        exists=True, mandatory=False,
+        desc='permutation plan (see ComputePermutPlan), batch mode where \
+            the groups of all seeds are read from the plan, cor_mat_files \
+            being all the files of the first group, then the second, etc.')
+
 
 class PreparePermutMeanCorrelOutputSpec(TraitedSpec):
 
@@ -2016,21 +2157,86 @@ class PreparePermutMeanCorrelOutputSpec(TraitedSpec):
         File(exists=True),
         desc="npy files with the average of permuted correlation matrices")
 
+    permut_mean_cormats_file = File(
+        exists=True,
+        desc="batch mode, npy file with the averages of permuted correlation \
+            matrices (nb_permuts, nb_groups, nb_edges), edges being the upper \
+            triangle including the diagonal (k = 0)")
+
+    subj_indexes_file = File(
+        exists=True,
+        desc="batch mode, npy file with the shuffled subject indexes \
+            (nb_permuts, nb_subjects)")
+
 
 class PreparePermutMeanCorrel(BaseInterface):
     """
+    Description:
+
     Return average of correlation values after shuffling orig datasets
+
+    Inputs:
+
+        cor_mat_files:
+            type = List of File, exists=True, desc='Numpy files with
+            correlation matrices gm_mask_coords', mandatory=True
+
+        permut_group_sizes:
+            type = List of Int, desc='How to split the groups after
+            shuffling', mandatory=True
+
+        seed:
+            type = Int, default = 0, usedefault = True,
+            desc='Start of random process'
+
+        nb_permuts:
+            type = Int, default = 0, usedefault = True,
+            desc='If > 0, batch mode: the matrices are loaded once (in a
+            memory-mapped condensed stack) and nb_permuts permutations are
+            computed (one random stream per permutation)'
+
+        permut_plan_file:
+            type = File, exists=True, desc='permutation plan (see
+            ComputePermutPlan), batch mode where the groups of all seeds are
+            read from the plan, cor_mat_files being all the files of the
+            first group, then the second, etc.', mandatory=False
+
+    Outputs:
+
+        permut_mean_cormat_files:
+            type = List of File, exists=True,
+            desc="npy files with the average of permuted correlation
+            matrices (only if nb_permuts = 0)"
+
+        permut_mean_cormats_file:
+            type = File, exists=True,
+            desc="npy file with the averages of permuted correlation
+            matrices (nb_permuts, nb_groups, nb_edges), edges being the upper
+            triangle including the diagonal (k = 0, see expand_condensed)
+            (only if nb_permuts > 0 or permut_plan_file is defined, in this
+            case in the order of the seeds of the plan)"
+
+        subj_indexes_file:
+            type = File, exists=True,
+            desc="npy file with the shuffled subject indexes
+            (nb_permuts, nb_subjects) (only if nb_permuts > 0)"
     """
     input_spec = PreparePermutMeanCorrelInputSpec
     output_spec = PreparePermutMeanCorrelOutputSpec
 
     def _run_interface(self, runtime):
+
+        if self.inputs.nb_permuts > 0 or \
+                isdefined(self.inputs.permut_plan_file):
+            self._run_batch_permuts()
+            return runtime
+
         np.random.seed(self.inputs.seed)
-        cormats = [np.load(cor_mat_file)
+        cormats = [load_sym_mat(cor_mat_file)
                    for cor_mat_file in self.inputs.cor_mat_files]
 
         assert len(cormats) == sum(self.inputs.permut_group_sizes), ("Error,\
-            len(cormats) {} != sum permut_group_sizes {1}".format(
+            len(cormats) {} != sum permut_group_sizes {}".format(
             len(cormats), sum(self.inputs.permut_group_sizes)))
 
         subj_indexes = np.arange(len(cormats))
@@ -2056,7 +2262,63 @@ class PreparePermutMeanCorrel(BaseInterface):
         f.close()
         return runtime
 
+    def _run_batch_permuts(self):
+
+        cor_mat_files = self.inputs.cor_mat_files
+
+        assert len(cor_mat_files) == sum(self.inputs.permut_group_sizes), \
+            ("Error, len(cor_mat_files) {} != sum permut_group_sizes \
+             {}".format(len(cor_mat_files),
+                        sum(self.inputs.permut_group_sizes)))
+
+        # loading all matrices once, in a condensed memory-mapped stack
+        mat_size = load_sym_mat(cor_mat_files[0], mmap_mode='r').shape[0]
+
+        stack_edges = np.lib.format.open_memmap(
+            os.path.abspath("all_cormats_condensed.npy"), mode='w+',
+            dtype=float, shape=(len(cor_mat_files),
+                                nb_edges_from_size(mat_size, k=0)))
+
+        for i, cor_mat_file in enumerate(cor_mat_files):
+            stack_edges[i] = condense_sym_mat(load_sym_mat(cor_mat_file), k=0)
+
+        stack_edges.flush()
+
+        if isdefined(self.inputs.permut_plan_file):
+            permut_plan = load_permut_plan(self.inputs.permut_plan_file)
+
+            assert permut_plan["group_sizes"] == \
+                list(self.inputs.permut_group_sizes), \
+                ("Error, group sizes of permutation plan {} != {}".format(
+                    permut_plan["group_sizes"],
+                    self.inputs.permut_group_sizes))
+
+            permut_means = label_group_mean_cormats(
+                stack_edges, return_pooled_labels(permut_plan),
+                len(permut_plan["group_sizes"]),
+                permut_mean_file=os.path.abspath("permut_mean_cormats.npy"))
+
+        else:
+            permut_means, subj_indexes = permut_group_mean_cormats(
+                stack_edges, self.inputs.permut_group_sizes,
+                nb_permuts=self.inputs.nb_permuts, seed=self.inputs.seed,
+                permut_mean_file=os.path.abspath("permut_mean_cormats.npy"))
+
+            np.save(os.path.abspath("subj_indexes.npy"), subj_indexes)
+
+        del stack_edges, permut_means
+
     def _list_outputs(self):
         outputs = self._outputs().get()
-        outputs["permut_mean_cormat_files"] = self.permut_mean_cormat_files
+
+        if isdefined(self.inputs.permut_plan_file):
+            outputs["permut_mean_cormats_file"] = os.path.abspath(
+                "permut_mean_cormats.npy")
+        elif self.inputs.nb_permuts > 0:
+            outputs["permut_mean_cormats_file"] = os.path.abspath(
+                "permut_mean_cormats.npy")
+            outputs["subj_indexes_file"] = os.path.abspath("subj_indexes.npy")
+        else:
+            outputs["permut_mean_cormat_files"] = \
+                self.permut_mean_cormat_files
         return outputs
@@ -5,8 +5,6 @@ author:: David Meunier <david_meunier_79@univ-amu.fr>
 import numpy as np
 import os
 
-import itertools as iter
-
 from nipype.interfaces.base import BaseInterface, \
     BaseInterfaceInputSpec, traits, File, TraitedSpec, isdefined
 
@@ -18,6 +16,9 @@ import graphpype.utils_stats as stats
 
 from graphpype.utils_cor import (return_corres_correl_mat,
                                  return_corres_correl_mat_labels)
+from graphpype.utils_condensed import load_sym_mat
+from graphpype.utils_net import (return_null_model_mats,
+                                 return_null_net_lists)
 
 
 # StatsPairBinomial
@@ -41,6 +42,12 @@ class StatsPairBinomialInputSpec(BaseInterfaceInputSpec):
         desc='Alpha value used as FDR implementation',
         mandatory=False)
 
+    binom_method = traits.Enum(
+        "normal", "exact",
+        usedefault=True,
+        desc='Test of proportions, normal approximation or Fisher exact test',
+        mandatory=False)
+
 
 class StatsPairBinomialOutputSpec(TraitedSpec):
 
@@ -84,7 +91,7 @@ class StatsPairBinomial(BaseInterface):
 
         signif_signed_adj_mat = stats.compute_pairwise_binom_fdr(
             group_coclass_matrix1, group_coclass_matrix2,
-            conf_interval_binom_fdr)
+            conf_interval_binom_fdr, method=self.inputs.binom_method)
 
         # save pairwise signed stat file
         signif_signed_adj_fdr_mat_file = os.path.abspath(
@@ -315,7 +322,7 @@ class PrepareCormat(BaseInterface):
             assert os.path.exists(cor_mat_files[index_file])
             assert os.path.exists(coords_files[index_file])
 
-            Z_cor_mat = np.load(cor_mat_files[index_file])
+            Z_cor_mat = load_sym_mat(cor_mat_files[index_file])
             print(Z_cor_mat.shape)
 
             coords = np.array(np.loadtxt(
@@ -366,7 +373,7 @@ class PrepareCormat(BaseInterface):
             assert os.path.exists(cor_mat_files[index_file])
             assert os.path.exists(labels_files[index_file])
 
-            Z_cor_mat = np.load(cor_mat_files[index_file])
+            Z_cor_mat = load_sym_mat(cor_mat_files[index_file])
 
             labels = np.array([line.strip() for line in open(
                 labels_files[index_file])], dtype='str')
@@ -425,6 +432,82 @@ class PrepareCormat(BaseInterface):
         outputs["group_vect_file"] = os.path.abspath('group_vect.npy')
         return outputs
 
+# ComputePermutPlan
+
+
+class ComputePermutPlanInputSpec(BaseInterfaceInputSpec):
+
+    group_sizes = traits.List(
+        traits.Int, desc='Number of subjects in each group', mandatory=True)
+
+    seeds = traits.List(
+        traits.Int, desc='seeds of all permutations (-1 keeps the original \
+        groups)', mandatory=True)
+
+    unbalanced = traits.Bool(False, usedefault=True,
+                             desc='Same meaning as in SwapLists')
+
+
+class ComputePermutPlanOutputSpec(TraitedSpec):
+
+    permut_plan_file = File(
+        exists=True, desc='permutation plan in npz format')
+
+
+class ComputePermutPlan(BaseInterface):
+
+    """
+    Description:
+
+    Compute group labels for all permutations (seeds) at once, saved as a
+    compact int8 array in a single file (permutation plan). The plan can be
+    read by SwapLists (one seed) or by PreparePermutMeanCorrel (all seeds,
+    from the already computed matrices of each subject)
+
+    unbalanced = True: each subject (all groups pooled) is assigned to a
+    random group; unbalanced = False (paired design): for each subject, the
+    label is the shift of groups, as in SwapLists
+
+    Inputs:
+
+        group_sizes:
+            type = List of Int, desc='Number of subjects in each group',
+            mandatory=True
+
+        seeds:
+            type = List of Int, desc='seeds of all permutations (-1 keeps the
+            original groups)', mandatory=True
+
+        unbalanced:
+            type = Bool, default = False, usedefault = True,
+            desc='Same meaning as in SwapLists'
+
+    Outputs:
+
+        permut_plan_file:
+            type = File, exists=True, desc='permutation plan in npz format'
+    """
+    input_spec = ComputePermutPlanInputSpec
+    output_spec = ComputePermutPlanOutputSpec
+
+    def _run_interface(self, runtime):
+
+        labels = stats.return_permut_plan(
+            self.inputs.group_sizes, self.inputs.seeds,
+            unbalanced=self.inputs.unbalanced)
+
+        stats.save_permut_plan(
+            os.path.abspath("permut_plan.npz"), labels, self.inputs.seeds,
+            self.inputs.group_sizes, unbalanced=self.inputs.unbalanced)
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs["permut_plan_file"] = os.path.abspath("permut_plan.npz")
+        return outputs
+
+
 # SwapLists
 
 
@@ -440,6 +523,10 @@ class SwapListsInputSpec(BaseInterfaceInputSpec):
     seed = traits.Int(-1, desc='value for seed',
                       mandatory=True, usedefault=True)
 
+    permut_plan_file = File(
+        exists=True, desc='permutation plan (see ComputePermutPlan), if \
+        defined, labels of seed are read from the plan', mandatory=False)
+
 
 class SwapListsOutputSpec(TraitedSpec):
 
@@ -472,6 +559,11 @@ class SwapLists(BaseInterface):
             type = Int, default = -1, desc='value for seed', mandatory=True,
             usedefault = True
 
+        permut_plan_file:
+            type = File, exists=True, desc='permutation plan (see
+            ComputePermutPlan), if defined, labels of seed are read from the
+            plan', mandatory=False
+
     Outputs:
 
         permut_lists_of_lists:
@@ -537,11 +629,28 @@ class SwapLists(BaseInterface):
 
             return runtime
 
-        np.random.seed(seed)
+        if isdefined(self.inputs.permut_plan_file):
 
-        if unbalanced:
+            permut_plan = stats.load_permut_plan(self.inputs.permut_plan_file)
+
+            assert permut_plan["unbalanced"] == unbalanced and \
+                seed in permut_plan["seeds"], \
+                ("Error, seed {} (unbalanced = {}) not in permutation plan \
+                 {}".format(seed, unbalanced, self.inputs.permut_plan_file))
+
+            is_permut = np.array(permut_plan["labels"][
+                permut_plan["seeds"].index(seed)], dtype=int)
+
+            if unbalanced:
+                assert len(is_permut) == sum(nb_files_per_list)
+            else:
+                assert len(is_permut) == nb_files_per_list
 
-            def prod(x, y): return x * y
+            print(is_permut)
+
+        elif unbalanced:
+
+            np.random.seed(seed)
 
             print(sum(nb_files_per_list))
 
@@ -552,9 +661,7 @@ class SwapLists(BaseInterface):
 
         else:
 
-            def prod(x, y): return x * y
-
-            # print reduce(prod,nb_files_per_list,1)
+            np.random.seed(seed)
 
             is_permut = np.array(np.random.randint(
                 nb_set_to_shuffle, size=nb_files_per_list), dtype=int)
@@ -620,12 +727,31 @@ class ShuffleMatrixInputSpec(BaseInterfaceInputSpec):
     seed = traits.Int(-1, desc='value for seed',
                       mandatory=True, usedefault=True)
 
+    seeds = traits.List(
+        traits.Int, desc='batch of seeds, if defined, all shuffled matrices \
+        are saved in a single npy file', mandatory=False)
+
+    null_model = traits.Enum(
+        "values", "edge_swap", "edge_swap_rank", usedefault=True,
+        desc='values: permutation of the values, edge_swap: degree \
+        preserving rewiring, edge_swap_rank: degree preserving rewiring with \
+        weights reassigned by rank (approximately preserving strengths)',
+        mandatory=False)
+
+    nb_swaps_per_edge = traits.Int(
+        10, usedefault=True, mandatory=False,
+        desc='Number of swaps per edge (edge_swap null models)')
+
 
 class ShuffleMatrixOutputSpec(TraitedSpec):
 
     shuffled_matrix_file = File(
         exists=True, desc='shuffled matrix in npy format', mandatory=True)
 
+    shuffled_matrices_file = File(
+        exists=True, desc='shuffled matrices (nb_seeds, nb_nodes, nb_nodes) \
+        in npy format, if seeds is defined')
+
 
 class ShuffleMatrix(BaseInterface):
 
@@ -646,6 +772,23 @@ class ShuffleMatrix(BaseInterface):
             type = Int, default = -1, desc='value for seed', mandatory=True,
             usedefault = True
 
+        seeds:
+            type = List of Int, desc='batch of seeds, if defined, all
+            shuffled matrices are saved in a single npy file', mandatory=False
+
+        null_model:
+            type = Enum("values", "edge_swap", "edge_swap_rank"),
+            default = "values", usedefault = True,
+            desc='values: permutation of the values, edge_swap: degree
+            preserving rewiring (Maslov-Sneppen), edge_swap_rank: degree
+            preserving rewiring with weights reassigned by rank
+            (approximately preserving strengths)', mandatory=False
+
+        nb_swaps_per_edge:
+            type = Int, default = 10, usedefault = True,
+            desc='Number of swaps per edge (edge_swap null models)',
+            mandatory=False
+
     Outputs:
 
         shuffled_matrix_file:
@@ -653,6 +796,12 @@ class ShuffleMatrix(BaseInterface):
             type = File, exists=True, desc='shuffled matrix in npy format',
             mandatory=True
 
+        shuffled_matrices_file:
+
+            type = File, exists=True, desc='shuffled matrices
+            (nb_seeds, nb_nodes, nb_nodes) in npy format, if seeds is
+            defined'
+
 
     """
     input_spec = ShuffleMatrixInputSpec
@@ -665,41 +814,29 @@ class ShuffleMatrix(BaseInterface):
 
         path, fname, ext = split_f(original_matrix_file)
 
-        orig_mat = np.load(original_matrix_file)
-
-        if seed == -1:
-            print("keeping original matrix")
-            shuffled_matrix = orig_mat
+        orig_mat = load_sym_mat(original_matrix_file)
 
+        if isdefined(self.inputs.seeds):
+            seeds = self.inputs.seeds
         else:
+            seeds = [seed]
 
-            print("randomizing " + str(seed))
-            np.random.seed(seed)
-
-            np.fill_diagonal(orig_mat, np.nan)
-
-            shuf_mat = np.zeros(shape=orig_mat.shape, dtype=orig_mat.dtype)
-
-            for i, j in iter.combinations(list(range(orig_mat.shape[0])), 2):
-                bool_ok = False
-
-                while not bool_ok:
-
-                    new_ind = np.random.randint(
-                        low=orig_mat.shape[0], size=2)
-
-                    if not np.isnan(orig_mat[new_ind[0], new_ind[1]]):
+        if seed == -1 and not isdefined(self.inputs.seeds):
+            print("keeping original matrix")
+        else:
+            print("randomizing {} ({})".format(seeds, self.inputs.null_model))
 
-                        shuf_mat[i, j] = orig_mat[new_ind[0], new_ind[1]]
-                        shuf_mat[j, i] = orig_mat[new_ind[0], new_ind[1]]
+        shuffled_matrices = return_null_model_mats(
+            orig_mat, seeds, null_model=self.inputs.null_model,
+            nb_swaps_per_edge=self.inputs.nb_swaps_per_edge)
 
-                        orig_mat[new_ind[0], new_ind[1]] = np.nan
-                        orig_mat[new_ind[1], new_ind[0]] = np.nan
+        shuffled_matrix_file = os.path.abspath("shuffled_matrix.npy")
+        np.save(shuffled_matrix_file, shuffled_matrices[0])
 
-                        bool_ok = True
+        if isdefined(self.inputs.seeds):
+            shuffled_matrices_file = os.path.abspath("shuffled_matrices.npy")
+            np.save(shuffled_matrices_file, shuffled_matrices)
 
-        shuffled_matrix_file = os.path.abspath("shuffled_matrix.npy")
-        np.save(shuffled_matrix_file, shuffled_matrix)
         return runtime
 
     def _list_outputs(self):
@@ -707,6 +844,10 @@ class ShuffleMatrix(BaseInterface):
         outputs["shuffled_matrix_file"] = os.path.abspath(
             "shuffled_matrix.npy")
 
+        if isdefined(self.inputs.seeds):
+            outputs["shuffled_matrices_file"] = os.path.abspath(
+                "shuffled_matrices.npy")
+
         return outputs
 
 
@@ -721,18 +862,74 @@ class ShuffleNetListInputSpec(BaseInterfaceInputSpec):
     seed = traits.Int(-1, desc='value for seed',
                       mandatory=True, usedefault=True)
 
+    seeds = traits.List(
+        traits.Int, desc='batch of seeds, if defined, one shuffled net list \
+        is saved per seed', mandatory=False)
+
+    nb_swaps_per_edge = traits.Int(
+        10, usedefault=True, mandatory=False,
+        desc='Number of swaps per edge')
+
+    weight_mode = traits.Enum(
+        "keep", "rank", usedefault=True, mandatory=False,
+        desc='keep: weights stay with their rewired edge, rank: weights are \
+        reassigned by rank of the product of node strengths')
+
 
 class ShuffleNetListOutputSpec(TraitedSpec):
 
     shuffled_net_list_file = File(
         exists=True, desc='shuffled net list in txt format', mandatory=True)
 
+    shuffled_net_list_files = traits.List(
+        File(exists=True),
+        desc='shuffled net lists in txt format, one per seed (if seeds is \
+        defined)')
+
 
 class ShuffleNetList(BaseInterface):
 
     """
-    Extract mean time series from a labelled mask in Nifti Format
-    where the voxels of interest have values 1
+    Description:
+
+    Degree preserving randomisation (Maslov-Sneppen edge swaps) of a net
+    list (i j weight), without self-loops nor multi-edges
+
+    If seed = -1, no shuffling is done (keep original net list)
+
+    Inputs:
+
+        orig_net_list_file:
+            type = File, exists=True, desc='original net list in txt format',
+            mandatory=True
+
+        seed:
+            type = Int, default = -1, desc='value for seed', mandatory=True,
+            usedefault = True
+
+        seeds:
+            type = List of Int, desc='batch of seeds, if defined, one
+            shuffled net list is saved per seed', mandatory=False
+
+        nb_swaps_per_edge:
+            type = Int, default = 10, usedefault = True,
+            desc='Number of swaps per edge', mandatory=False
+
+        weight_mode:
+            type = Enum("keep", "rank"), default = "keep", usedefault = True,
+            desc='keep: weights stay with their rewired edge, rank: weights
+            are reassigned by rank of the product of node strengths
+            (approximately preserving strengths)', mandatory=False
+
+    Outputs:
+
+        shuffled_net_list_file:
+            type = File, exists=True, desc='shuffled net list in txt format
+            (first seed if seeds is defined)', mandatory=True
+
+        shuffled_net_list_files:
+            type = List of File, exists=True, desc='shuffled net lists in
+            txt format, one per seed (if seeds is defined)'
     """
     input_spec = ShuffleNetListInputSpec
     output_spec = ShuffleNetListOutputSpec
@@ -741,20 +938,33 @@ class ShuffleNetList(BaseInterface):
 
         orig_net_list_file = self.inputs.orig_net_list_file
         seed = self.inputs.seed
-        path, fname, ext = split_f(orig_net_list_file)
-        original_net_list = np.loadtxt(orig_net_list_file)
+        original_net_list = np.loadtxt(orig_net_list_file, ndmin=2)
 
-        if seed == -1:
-            print("keeping original matrix")
+        if isdefined(self.inputs.seeds):
+            seeds = self.inputs.seeds
+        else:
+            seeds = [seed]
 
+        if seed == -1 and not isdefined(self.inputs.seeds):
+            print("keeping original matrix")
         else:
-            print("randomizing " + str(seed))
-            np.random.seed(seed)
-            np.random.shuffle(original_net_list[:, 0])
-            np.random.shuffle(original_net_list[:, 1])
+            print("randomizing " + str(seeds))
+
+        shuffled_net_lists = return_null_net_lists(
+            original_net_list, seeds,
+            nb_swaps_per_edge=self.inputs.nb_swaps_per_edge,
+            weight_mode=self.inputs.weight_mode)
 
         shuffled_net_list_file = os.path.abspath("shuffled_net_list.txt")
-        np.savetxt(shuffled_net_list_file, original_net_list, fmt="%d %d %d")
+        np.savetxt(shuffled_net_list_file, shuffled_net_lists[0],
+                   fmt="%d %d %d")
+
+        if isdefined(self.inputs.seeds):
+            for seed, shuffled_net_list in zip(seeds, shuffled_net_lists):
+                np.savetxt(os.path.abspath(
+                    "shuffled_net_list_{}.txt".format(seed)),
+                    shuffled_net_list, fmt="%d %d %d")
+
         return runtime
 
     def _list_outputs(self):
@@ -762,4 +972,9 @@ class ShuffleNetList(BaseInterface):
         outputs["shuffled_net_list_file"] = os.path.abspath(
             "shuffled_net_list.txt")
 
+        if isdefined(self.inputs.seeds):
+            outputs["shuffled_net_list_files"] = [
+                os.path.abspath("shuffled_net_list_{}.txt".format(seed))
+                for seed in self.inputs.seeds]
+
         return outputs
@@ -33,6 +33,13 @@ def test_extract_ts():
     assert os.path.exists(val.mean_masked_ts_file)
     os.remove(val.mean_masked_ts_file)
 
+    # with subject mask
+    extra_ts.inputs.filter_mask_file = gm_mask_file
+
+    val = extra_ts.run().outputs
+    assert os.path.exists(val.mean_masked_ts_file)
+    os.remove(val.mean_masked_ts_file)
+
 
 def test_intersect_mask():
     """test IntersectMask"""
@@ -44,7 +51,9 @@ def test_intersect_mask():
     val = intersect_mask.run().outputs
     print(val)
     assert os.path.exists(val.filtered_indexed_rois_file)
+    assert os.path.exists(val.coverage_rois_file)
     os.remove(val.filtered_indexed_rois_file)
+    os.remove(val.coverage_rois_file)
 
 
 def test_extract_mean_ts():
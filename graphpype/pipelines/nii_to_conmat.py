@@ -186,7 +186,7 @@ def create_pipeline_nii_to_conmat_seg_template(
 def create_pipeline_nii_to_subj_ROI(
         main_path, filter_gm_threshold=0.9, pipeline_name="nii_to_subj_ROI",
         background_val=-1.0, plot=True, reslice=False, resample=False,
-        min_BOLD_intensity=50, percent_signal=0.5):
+        min_BOLD_intensity=50, percent_signal=0.5, cache_dir=None):
     """
     Description:
 
@@ -240,6 +240,10 @@ def create_pipeline_nii_to_subj_ROI(
     filter_ROI_mask_with_GM.inputs.filter_thr = filter_gm_threshold
     filter_ROI_mask_with_GM.inputs.background_val = background_val
 
+    # filtered atlas shared between subjects with the same inputs
+    if cache_dir is not None:
+        filter_ROI_mask_with_GM.inputs.cache_dir = cache_dir
+
     pipeline.connect(inputnode, 'ROI_mask_file',
                      filter_ROI_mask_with_GM, 'indexed_rois_file')
     pipeline.connect(inputnode, 'ROI_coords_file',
@@ -269,6 +273,10 @@ def create_pipeline_nii_to_subj_ROI(
     extract_mean_ROI_ts.inputs.percent_signal = percent_signal
     extract_mean_ROI_ts.inputs.min_BOLD_intensity = min_BOLD_intensity
 
+    # projection operator shared between subjects with the same atlas
+    if cache_dir is not None:
+        extract_mean_ROI_ts.inputs.cache_dir = cache_dir
+
     pipeline.connect(inputnode, 'nii_4D_file', extract_mean_ROI_ts, 'file_4D')
     pipeline.connect(filter_ROI_mask_with_GM, 'filtered_indexed_rois_file',
                      extract_mean_ROI_ts, 'indexed_rois_file')
@@ -286,7 +294,7 @@ def create_pipeline_nii_to_conmat(
         main_path, filter_gm_threshold=0.9, pipeline_name="nii_to_conmat",
         conf_interval_prob=0.05, background_val=-1.0, plot=True,
         reslice=False, resample=False, min_BOLD_intensity=50,
-        percent_signal=0.5):
+        percent_signal=0.5, cache_dir=None):
     """
     Description:
 
@@ -374,6 +382,10 @@ def create_pipeline_nii_to_conmat(
     filter_ROI_mask_with_GM.inputs.filter_thr = filter_gm_threshold
     filter_ROI_mask_with_GM.inputs.background_val = background_val
 
+    # filtered atlas shared between subjects with the same inputs
+    if cache_dir is not None:
+        filter_ROI_mask_with_GM.inputs.cache_dir = cache_dir
+
     pipeline.connect(inputnode, 'ROI_mask_file',
                      filter_ROI_mask_with_GM, 'indexed_rois_file')
     pipeline.connect(inputnode, 'ROI_coords_file',
@@ -403,6 +415,10 @@ def create_pipeline_nii_to_conmat(
     extract_mean_ROI_ts.inputs.percent_signal = percent_signal
     extract_mean_ROI_ts.inputs.min_BOLD_intensity = min_BOLD_intensity
 
+    # projection operator shared between subjects with the same atlas
+    if cache_dir is not None:
+        extract_mean_ROI_ts.inputs.cache_dir = cache_dir
+
     pipeline.connect(inputnode, 'nii_4D_file', extract_mean_ROI_ts, 'file_4D')
     pipeline.connect(filter_ROI_mask_with_GM, 'filtered_indexed_rois_file',
                      extract_mean_ROI_ts, 'indexed_rois_file')
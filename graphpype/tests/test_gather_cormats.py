@@ -0,0 +1,108 @@
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from graphpype.utils import _make_tmp_dir
+from graphpype.utils_condensed import read_edge_store
+from graphpype.utils_stats import compute_oneway_anova_fwe
+from graphpype.gather.gather_cormats import (return_all_iter_cormats,
+                                             compute_mean_cormats,
+                                             compute_stats_cormats)
+
+
+def _make_cohort(cormat_path, subjects, conds, gm_mask_coords):
+    """random matrices and subsets of coords for each iteration"""
+    all_cormats = {}
+
+    for subj in subjects:
+        for cond in conds:
+            iter_dir = os.path.join(cormat_path,
+                                    "_cond_" + cond + "_subject_id_" + subj)
+
+            keep = np.sort(np.random.choice(len(gm_mask_coords), 6,
+                                            replace=False))
+            cormat = np.random.rand(6, 6)
+
+            os.makedirs(os.path.join(iter_dir, "compute_conf_cor_mat"))
+            os.makedirs(os.path.join(iter_dir, "extract_mean_ROI_ts"))
+
+            np.save(os.path.join(iter_dir, "compute_conf_cor_mat",
+                                 "Z_cor_mat_resid_ts.npy"), cormat)
+            np.savetxt(os.path.join(iter_dir, "extract_mean_ROI_ts",
+                                    "subj_coord_rois.txt"),
+                       gm_mask_coords[keep])
+
+            all_cormats[(cond, subj)] = (keep, cormat)
+
+    return all_cormats
+
+
+def test_return_all_iter_cormats():
+    """test return_all_iter_cormats, with memory-mapped stack and export"""
+    cormat_path = os.path.join(_make_tmp_dir(), "gather_cormats")
+    shutil.rmtree(cormat_path, ignore_errors=True)
+
+    gm_mask_coords = np.random.randint(-50, 50, size=(8, 3))
+    gm_mask_coords_file = os.path.join(_make_tmp_dir(), "gm_coords.txt")
+    np.savetxt(gm_mask_coords_file, gm_mask_coords)
+
+    subjects = ["s1", "s2", "s3"]
+    conds = ["a", "b"]
+    all_cormats = _make_cohort(cormat_path, subjects, conds, gm_mask_coords)
+
+    all_cormats_file = os.path.join(cormat_path, "all_cormats.npy")
+
+    stack, descriptors = return_all_iter_cormats(
+        cormat_path, [conds, subjects], ["cond", "subject_id"],
+        gm_mask_coords_file=gm_mask_coords_file, export_df=True,
+        all_cormats_file=all_cormats_file)
+
+    assert stack.shape == (6, 8, 8)
+    assert isinstance(stack, np.memmap)
+    assert descriptors.columns.tolist() == ["cond", "subject_id"]
+
+    for index, (cond, subj) in enumerate(descriptors.values.tolist()):
+        keep, cormat = all_cormats[(cond, subj)]
+
+        sub_mat = stack[index][np.ix_(keep, keep)]
+        assert np.allclose(np.triu(sub_mat, k=1), np.triu(cormat, k=1))
+        assert np.allclose(sub_mat, sub_mat.T)
+
+    assert np.array_equal(np.load(all_cormats_file), stack)
+
+    df = read_edge_store(os.path.join(cormat_path, "all_cormats"))
+    assert df.shape == (6, 2 + 28)
+    assert df["subject_id"].tolist() == descriptors["subject_id"].tolist()
+    assert np.allclose(df["0_5"], stack[:, 0, 5])
+
+
+def test_compute_stats_cormats():
+    """test grouped mean and stats of cormats (memory-mapped stack)"""
+    stack = np.random.rand(12, 6, 6)
+    stack = stack + np.transpose(stack, (0, 2, 1))
+
+    stack_file = os.path.join(_make_tmp_dir(), "stack_cormats.npy")
+    np.save(stack_file, stack)
+    stack = np.load(stack_file, mmap_mode="r")
+
+    descriptors = pd.DataFrame({"cond": ["a", "b", "c"] * 4,
+                                "subject_id": np.repeat(range(4), 3)})
+
+    dict_mean = compute_mean_cormats(stack, descriptors, ["all", "cond"])
+
+    assert np.allclose(dict_mean["all"], np.mean(stack, axis=0))
+    assert np.allclose(dict_mean["b"], np.mean(stack[1::3], axis=0))
+
+    dict_signif, dict_p_val, dict_stats = compute_stats_cormats(
+        stack, descriptors, ["cond"])
+
+    assert sorted(dict_stats.keys()) == ["F-test_cond", "T-test_a-b",
+                                         "T-test_a-c", "T-test_b-c"]
+
+    _, p_val_mat, F_stat_mat = compute_oneway_anova_fwe(
+        [stack[0::3], stack[1::3], stack[2::3]], uncor_alpha=0.01)
+
+    assert np.allclose(dict_stats["F-test_cond"], F_stat_mat)
+    assert np.allclose(dict_p_val["F-test_cond"], p_val_mat)
@@ -0,0 +1,173 @@
+import os
+import glob
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from graphpype.utils import _make_tmp_dir
+from graphpype.gather.gather_permuts import (compute_rada_df, find_rada_dirs,
+                                             gather_rada_df,
+                                             gather_con_values,
+                                             compute_signif_permuts,
+                                             compute_signif_node_prop)
+
+try:
+    import neuropycon_data as nd
+
+except ImportError:
+    print("neuropycon_data not installed")
+    exit()
+
+data_graph_path = os.path.join(nd.__path__[0], "data", "data_con",
+                               "data_graph")
+
+
+def _make_rada_dirs(res_path, nb_iters):
+    """copy radatools results in nb_iters iteration directories"""
+    for i in range(nb_iters):
+        iter_path = os.path.join(res_path, "_seed_" + str(i))
+
+        for sub_dir, file_name in [("community_rada", "Z_List.lol"),
+                                   ("net_prop", "Z_List-info_global.txt"),
+                                   ("net_prop", "Z_List-info_dists.txt")]:
+            os.makedirs(os.path.join(iter_path, sub_dir), exist_ok=True)
+            shutil.copy(os.path.join(data_graph_path, file_name),
+                        os.path.join(iter_path, sub_dir))
+
+
+def test_gather_rada_df():
+    """test gather_rada_df, with numeric values and persistent index"""
+    res_path = os.path.join(_make_tmp_dir(), "gather_rada")
+    shutil.rmtree(res_path, ignore_errors=True)
+    _make_rada_dirs(res_path, 11)
+
+    iter_paths = find_rada_dirs(res_path)
+    assert len(iter_paths) == 11
+    assert iter_paths[2].endswith("_seed_2")
+    assert iter_paths[10].endswith("_seed_10")
+
+    index_file = os.path.join(res_path, "rada_index.pkl")
+
+    df = gather_rada_df(iter_paths, index_file=index_file)
+
+    assert df.shape[0] == 11
+    assert np.allclose(df['Modularity'], 0.354318)
+    assert df['Vertices'].dtype == float
+    assert df['Mean_path_length'].dtype == float
+
+    # same values as compute_rada_df
+    values = {}
+    compute_rada_df(iter_paths[0], values)
+    for key, value in values.items():
+        assert np.isclose(df[key][0], value)
+
+    # modified results are parsed again
+    os.remove(os.path.join(iter_paths[0], "community_rada", "Z_List.lol"))
+    df_new = gather_rada_df(iter_paths, index_file=index_file, n_jobs=2)
+
+    assert np.isnan(df_new['Modularity'][0])
+    assert np.allclose(df_new['Modularity'][1:], 0.354318)
+    assert df_new.drop('Modularity', axis=1).equals(
+        df.drop('Modularity', axis=1))
+
+
+def test_gather_con_values():
+    """test gather_con_values, with new seeds appended to the store"""
+    res_path = os.path.join(_make_tmp_dir(), "gather_con")
+    shutil.rmtree(res_path, ignore_errors=True)
+
+    labels = ["ROI_" + str(i) for i in range(5)]
+    mats = np.random.rand(5, 5, 5)
+
+    def _save_shuffled_matrices(seeds):
+        for seed in seeds:
+            shuffle_dir = os.path.join(
+                res_path, "_freq_band_name_alpha_permut_" + str(seed),
+                "shuffle_matrix")
+            os.makedirs(shuffle_dir, exist_ok=True)
+            np.save(os.path.join(shuffle_dir, "shuffled_matrix.npy"),
+                    np.triu(mats[seed + 1], k=1))
+
+    _save_shuffled_matrices(range(-1, 2))
+    df = gather_con_values(res_path, "alpha", 4, labels)
+
+    assert df['Seed'].tolist() == [-1, 0, 1]
+    assert df.shape[1] == 11
+    assert np.allclose(df["ROI_0_ROI_3"], mats[:3, 0, 3])
+
+    _save_shuffled_matrices(range(2, 4))
+    df = gather_con_values(res_path, "alpha", 4, labels,
+                           edges=["ROI_1_ROI_2"])
+
+    assert df['Seed'].tolist() == [-1, 0, 1, 2, 3]
+    assert df.columns.tolist() == ['Seed', "ROI_1_ROI_2"]
+    assert np.allclose(df["ROI_1_ROI_2"], mats[:, 1, 2])
+    assert len(glob.glob(os.path.join(res_path, "permuts_alpha_con_values",
+                                      "values_*.npy"))) == 2
+
+
+def test_compute_signif_permuts():
+    """test compute_signif_permuts, for one and two sessions"""
+    permut_vals = np.random.rand(20, 4)
+    permut_vals[0] = [2.0, -1.0, 0.5, np.nan]
+
+    df = pd.DataFrame(permut_vals, columns=["a", "b", "c", "d"])
+    df.insert(0, 'Seed', np.arange(-1, 19))
+
+    df_res = compute_signif_permuts(df, session_col=-1, start_col=1)
+
+    assert df_res.index.tolist() == ["Higher", "Lower"]
+    assert df_res.columns.tolist() == ["a", "b", "c", "d"]
+    assert np.isclose(df_res["a"]["Higher"], 1/20.0)
+    assert np.isclose(df_res["b"]["Lower"], 1/20.0)
+    assert np.isclose(df_res["c"]["Higher"] + df_res["c"]["Lower"],
+                      21/20.0)
+    assert np.all(np.isnan(df_res["d"]))
+
+    df_fwe = compute_signif_permuts(df, session_col=-1, start_col=1,
+                                    fwe=True, two_sided=True)
+    assert np.isclose(df_fwe["a"]["Higher"], 2/20.0)
+    assert np.all(df_fwe[["a", "b", "c"]].values >=
+                  df_res[["a", "b", "c"]].values)
+    assert np.all(np.isnan(df_fwe["d"]))
+
+    # two sessions, difference between sessions
+    df_sess = pd.concat((df.assign(Session=1),
+                         df.assign(Session=2, a=0.0, b=0.0)),
+                        ignore_index=True)
+
+    df_res = compute_signif_permuts(df_sess, columns=["a", "b", "d"])
+
+    assert np.isclose(df_res["a"]["Higher"], 1/20.0)
+    assert df_res["a"]["Lower"] == -1
+    assert np.isclose(df_res["b"]["Lower"], 1/20.0)
+    assert np.all(np.isnan(df_res["d"]))
+
+
+def test_compute_signif_node_prop():
+    """test compute_signif_node_prop against direct counting"""
+    orig_df = pd.DataFrame(np.random.rand(10, 2), columns=["a", "b"])
+    list_permut_df = [pd.DataFrame(np.random.rand(10, 2),
+                                   columns=["a", "b"]) for i in range(30)]
+
+    df_signif = compute_signif_node_prop(orig_df, list_permut_df, ["a", "b"])
+
+    permut_vals = pd.concat(list_permut_df)["a"].values
+    nb_higher = np.sum(permut_vals > orig_df["a"].values[:, None], axis=1)
+
+    assert df_signif.shape == (10, 2)
+    assert np.allclose(df_signif["a"], (nb_higher + 1)/301.0)
+
+    df_fwe = compute_signif_node_prop(orig_df, list_permut_df, ["a", "b"],
+                                      fwe=True)
+    assert np.all(df_fwe.values >= df_signif.values)
+
+    # no p-value for a NaN original value
+    orig_df.loc[3, "a"] = np.nan
+
+    for fwe in [False, True]:
+        df_nan = compute_signif_node_prop(orig_df, list_permut_df, ["a"],
+                                          two_sided=True, fwe=fwe)
+        assert np.isnan(df_nan["a"][3])
+        assert np.sum(np.isnan(df_nan["a"])) == 1
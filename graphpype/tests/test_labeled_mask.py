@@ -1,8 +1,17 @@
-from graphpype.labeled_mask import (segment_mask_in_ROI)
+from graphpype.labeled_mask import (segment_mask_in_ROI, create_indexed_mask,
+                                    rasterize_ROIs, _ROI_kernel_offsets,
+                                    _segment_cubes, compute_ROI_table,
+                                    compute_MNI_coords_from_indexed_template,
+                                    load_ROI_table, ROI_table_columns,
+                                    intersect_indexed_mask,
+                                    compute_labelled_mask_from_anat_ROIs)
 
 import os
 import shutil
 
+import numpy as np
+import nibabel as nib
+
 try:
     import neuropycon_data as nd
 
@@ -44,3 +53,193 @@ def test_segment_mask_in_ROI():
         mask_file, save_dir=tmp_dir, segment_type="disjoint_comp",
         mask_thr=0.99)
     assert os.path.exists(indexed_mask_rois_file)
+
+    # with disjoint_comp, several components
+    indexed_mask_rois_file, ROI_coords_file, _ = segment_mask_in_ROI(
+        mask_file, save_dir=tmp_dir, segment_type="disjoint_comp",
+        mask_thr=0.2, min_count_voxel_in_ROI=1)
+    assert os.path.exists(indexed_mask_rois_file)
+
+    # centroids computed with the components are the centroids of the mask
+    indexed_mask_data = np.round(
+        nib.load(indexed_mask_rois_file).get_fdata())
+    ROI_coords = np.loadtxt(ROI_coords_file)
+
+    assert ROI_coords.shape[0] == indexed_mask_data.max() + 1
+    assert np.allclose(ROI_coords[3],
+                       np.mean(np.where(indexed_mask_data == 3), axis=1),
+                       atol=0.001)
+
+    # same ROI table as computed from the saved mask
+    ROI_table = load_ROI_table(os.path.join(
+        tmp_dir, "ROI_table-disjoint_comp_ROI_1.csv"))
+    ref_ROI_table = compute_ROI_table(indexed_mask_data, np.eye(4),
+                                      background_val=-1)
+
+    assert np.allclose(ROI_table[ROI_table_columns[:5]].values,
+                       ref_ROI_table[ROI_table_columns[:5]].values,
+                       atol=0.001)
+    assert np.array_equal(ROI_table[ROI_table_columns[8:]].values,
+                          ref_ROI_table[ROI_table_columns[8:]].values)
+
+    # with kmeans supervoxels
+    indexed_mask_rois_file, ROI_coords_file, _ = segment_mask_in_ROI(
+        mask_file, save_dir=tmp_dir, segment_type="kmeans", mask_thr=0.99,
+        nb_ROIs=20)
+    assert os.path.exists(indexed_mask_rois_file)
+    assert np.loadtxt(ROI_coords_file).shape == (20, 3)
+
+
+def test_segment_cubes():
+    """test cube tiling, only cubes mostly in the mask are kept"""
+    bin_mask_data = np.zeros((10, 9, 8), dtype='int64')
+    bin_mask_data[:3, :3, :3] = 1
+    bin_mask_data[3:5, 3:6, 3:6] = 1
+
+    indexed_mask_data = _segment_cubes(bin_mask_data, 1, 0.5)
+
+    assert np.all(indexed_mask_data[:3, :3, :3] == 0)
+    assert np.all(indexed_mask_data[3:6, 3:6, 3:6] == 1)
+    assert np.sum(indexed_mask_data > -1) == 2 * 27
+
+
+def test_create_indexed_mask():
+    """test create_indexed_mask with spheres"""
+    img = nib.load(mask_file)
+
+    vox_coords = np.array([[10, 8, 10], [25, 20, 15], [40, 12, 20]])
+    MNI_coords = (np.dot(vox_coords, img.affine[:3, :3].T) +
+                  img.affine[:3, 3]).astype(int).tolist()
+
+    indexed_mask_file = create_indexed_mask(
+        mask_file, MNI_coords, tmp_dir, ROI_shape="sphere", ROI_size=10)
+
+    indexed_mask_data = nib.load(indexed_mask_file).get_fdata()
+
+    assert indexed_mask_data.shape == img.shape
+    assert np.array_equal(np.unique(indexed_mask_data), [-1, 0, 1, 2])
+
+    for index_mask, vox_coord in enumerate(vox_coords):
+        assert indexed_mask_data[tuple(vox_coord)] == index_mask
+
+
+def test_rasterize_ROIs():
+    """test rasterize_ROIs: clipping and overlap rules"""
+    offsets = _ROI_kernel_offsets("cube", 3, np.array([1.0, 1.0, 1.0]))
+    assert offsets.shape == (27, 3)
+
+    # first cube partly out of the volume, overlap of 2 x 3 x 3 voxels
+    centres = [[0, 5, 5], [5, 5, 5], [6.5, 5, 5]]
+
+    mask_data, nb_voxels = rasterize_ROIs(centres, offsets, (10, 10, 10))
+    assert nb_voxels.tolist() == [18, 9, 27]
+    assert mask_data[5, 5, 5] == 2
+
+    mask_data, nb_voxels = rasterize_ROIs(centres, offsets, (10, 10, 10),
+                                          overlap="nearest")
+    assert nb_voxels.tolist() == [18, 18, 18]
+    assert mask_data[6, 5, 5] == 2 and mask_data[5, 5, 5] == 1
+
+    mask_data, nb_voxels = rasterize_ROIs(centres, offsets, (10, 10, 10),
+                                          overlap="exclude")
+    assert nb_voxels.tolist() == [18, 9, 9]
+    assert mask_data[6, 5, 5] == -1
+
+
+def test_compute_ROI_table():
+    """test compute_ROI_table (counts, centroids and bounding boxes) and the
+    ROI table saved with the coords files"""
+    indexed_mask_data = np.zeros((10, 9, 8)) - 1
+    indexed_mask_data[1:4, 2:4, 3] = 0
+    indexed_mask_data[5, 6, 1:7] = 2
+
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    affine[:3, 3] = [-10, -20, -30]
+
+    ROI_table = compute_ROI_table(indexed_mask_data, affine)
+
+    assert ROI_table["index"].tolist() == [0, 2]
+    assert ROI_table["nb_voxels"].tolist() == [6, 6]
+    assert np.allclose(ROI_table[["i", "j", "k"]].values,
+                       [[2, 2.5, 3], [5, 6, 3.5]])
+    assert np.allclose(ROI_table[["x", "y", "z"]].values,
+                       [[-6, -15, -24], [0, -8, -23]])
+    assert ROI_table.loc[1, ["k_min", "k_max"]].tolist() == [1, 6]
+
+    indexed_mask_file = os.path.join(tmp_dir, "indexed_mask-table.nii")
+    nib.save(nib.Nifti1Image(indexed_mask_data, affine), indexed_mask_file)
+
+    ROI_coords_file, ROI_MNI_coords_file = \
+        compute_MNI_coords_from_indexed_template(indexed_mask_file)
+
+    assert np.allclose(np.loadtxt(ROI_MNI_coords_file), ROI_table[
+        ["x", "y", "z"]].values)
+
+    saved_ROI_table = load_ROI_table(
+        os.path.join(tmp_dir, "ROI_table-table.csv"))
+    assert saved_ROI_table["nb_voxels"].tolist() == [6, 6]
+
+
+def test_intersect_indexed_mask():
+    """test intersect_indexed_mask: relabel and coverage of ROIs"""
+    indexed_mask_data = np.zeros((6, 6, 6)) - 1
+    indexed_mask_data[0, :4, 0] = 0
+    indexed_mask_data[2, :4, 0] = 1
+    indexed_mask_data[4, :4, 0] = 3
+    indexed_mask_data[5, 5, 5] = np.nan
+
+    filter_mask = np.zeros((6, 6, 6), dtype=bool)
+    filter_mask[:, 3:, 0] = True
+    filter_mask[0, :, 0] = True
+
+    filtered_data, index_corres, coverage_ROIs = intersect_indexed_mask(
+        indexed_mask_data, filter_mask)
+
+    assert filtered_data.dtype == np.int64
+    assert index_corres.tolist() == [0, 1, 3]
+    assert np.array_equal(np.unique(filtered_data), [-1, 0, 1, 2])
+    assert filtered_data[4, 3, 0] == 2 and filtered_data[4, 2, 0] == -1
+    assert coverage_ROIs["coverage"].tolist() == [1.0, 0.25, 0.25]
+
+    # with background 0 and min coverage
+    filtered_data, index_corres, coverage_ROIs = intersect_indexed_mask(
+        indexed_mask_data + 1, filter_mask, background_val=0.0,
+        min_coverage=0.5)
+
+    assert index_corres.tolist() == [0]
+    assert np.sum(filtered_data == 0) == 4
+    assert coverage_ROIs["kept"].tolist() == [True, False, False]
+
+
+def test_compute_labelled_mask_from_anat_ROIs():
+    """test compute_labelled_mask_from_anat_ROIs: ROIs at 1mm resampled
+    on a 2mm grid, with overlap rules"""
+    ROI_dir = os.path.join(tmp_dir, "anat_ROIs")
+    os.makedirs(ROI_dir)
+
+    ref_img_file = os.path.join(ROI_dir, "ref.nii")
+    nib.save(nib.Nifti1Image(np.zeros((10, 10, 10, 2)),
+                             np.diag([2.0, 2.0, 2.0, 1.0])), ref_img_file)
+
+    # ROI_A in ref voxels [2:5], ROI_B in ref voxels [4:7] (overlap at 4)
+    for ROI_name, start, val in [("ROI_A", 4, 1.0), ("ROI_B", 8, 0.5)]:
+        ROI_data = np.zeros((20, 20, 20))
+        ROI_data[start:start+6, start:start+6, start:start+6] = val
+        nib.save(nib.Nifti1Image(ROI_data, np.eye(4)),
+                 os.path.join(ROI_dir, ROI_name + ".nii"))
+
+    for overlap, overlap_val in [("last", 1), ("max_prob", 0),
+                                 ("exclude", -1)]:
+        labelled_mask_file, labels_file = \
+            compute_labelled_mask_from_anat_ROIs(ref_img_file, ROI_dir,
+                                                 overlap=overlap)
+
+        labelled_mask_data = nib.load(labelled_mask_file).get_fdata()
+
+        assert labelled_mask_data.shape == (10, 10, 10)
+        assert labelled_mask_data[4, 4, 4] == overlap_val
+        assert labelled_mask_data[3, 3, 3] == 0
+        assert labelled_mask_data[6, 6, 6] == 1
+        assert np.sum(labelled_mask_data == 0) == 26 + (overlap_val == 0)
+
+    assert np.loadtxt(labels_file, dtype=str).tolist() == ["ROI_A", "ROI_B"]
@@ -0,0 +1,63 @@
+import os
+import time
+
+import numpy as np
+
+from graphpype.utils import _make_tmp_dir
+
+from graphpype.utils_cache import cache_key, cached_call, evict_cache
+
+
+def test_cached_call():
+    """test cached_call: key from input content and params, reuse of the
+    cached files, LRU eviction"""
+    tmp_dir = _make_tmp_dir()
+    cache_dir = os.path.join(tmp_dir, "cache")
+
+    in_file = os.path.join(tmp_dir, "in.txt")
+    np.savetxt(in_file, np.arange(10))
+
+    # same content, other name -> same key
+    other_in_file = os.path.join(tmp_dir, "other_in.txt")
+    np.savetxt(other_in_file, np.arange(10))
+
+    assert cache_key([in_file], {"a": 1}) == \
+        cache_key([other_in_file], {"a": 1})
+    assert cache_key([in_file], {"a": 1}) != cache_key([in_file], {"a": 2})
+
+    out_file = os.path.join(tmp_dir, "out.txt")
+    nb_calls = []
+
+    def _compute():
+        nb_calls.append(1)
+        np.savetxt(out_file, np.loadtxt(in_file) * 2)
+
+    assert not cached_call(cache_dir, [in_file], {"a": 1}, [out_file],
+                           _compute)
+
+    os.remove(out_file)
+
+    assert cached_call(cache_dir, [other_in_file], {"a": 1}, [out_file],
+                       _compute)
+    assert len(nb_calls) == 1
+    assert np.array_equal(np.loadtxt(out_file), np.arange(10) * 2)
+
+    # without cache_dir, always computed
+    assert not cached_call(None, [in_file], {"a": 1}, [out_file], _compute)
+    assert len(nb_calls) == 2
+
+    # eviction of the least recently used entry
+    for val in [2, 3]:
+        time.sleep(0.01)
+        cached_call(cache_dir, [in_file], {"a": val}, [out_file], _compute)
+
+    entry_size = os.path.getsize(out_file)
+
+    cached_call(cache_dir, [in_file], {"a": 1}, [out_file], _compute)
+
+    assert evict_cache(cache_dir, max_size=2 * entry_size) == 2 * entry_size
+    assert len(nb_calls) == 4
+
+    assert cached_call(cache_dir, [in_file], {"a": 1}, [out_file], _compute)
+    assert not cached_call(cache_dir, [in_file], {"a": 2}, [out_file],
+                           _compute)
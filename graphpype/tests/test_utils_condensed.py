@@ -0,0 +1,125 @@
+import os
+import shutil
+
+import numpy as np
+
+from graphpype.utils import _make_tmp_dir
+
+from graphpype.utils_condensed import (triu_indices, nb_edges_from_size,
+                                       size_from_nb_edges, condense_sym_mat,
+                                       expand_condensed, CondensedSymMat,
+                                       save_sym_mat, load_sym_mat,
+                                       is_edge_store, append_edge_store,
+                                       read_edge_store_index, read_edge_store)
+
+
+def _rand_sym_mat(size, nb_mats=None):
+    shape = (size, size) if nb_mats is None else (nb_mats, size, size)
+    mat = np.random.rand(*shape)
+    mat = mat + np.swapaxes(mat, -1, -2)
+    mat[..., np.arange(size), np.arange(size)] = 0.0
+    return mat
+
+
+def test_triu_indices():
+    """test cached triu_indices"""
+    triu_i, triu_j = triu_indices(10, k=1)
+    ref_i, ref_j = np.triu_indices(10, k=1)
+
+    assert np.array_equal(triu_i, ref_i) and np.array_equal(triu_j, ref_j)
+    assert triu_indices(10, k=1)[0] is triu_i
+    assert not triu_i.flags.writeable
+
+    assert nb_edges_from_size(10) == len(triu_i)
+    assert nb_edges_from_size(10, k=0) == len(np.triu_indices(10)[0])
+    assert size_from_nb_edges(45) == 10
+    assert size_from_nb_edges(55, k=0) == 10
+
+
+def test_condense_expand():
+    """test round trip dense -> condensed -> dense, for one matrix and
+    for a stack of matrices"""
+    mat = _rand_sym_mat(10)
+    values = condense_sym_mat(mat)
+
+    assert values.shape == (45,)
+    assert np.array_equal(expand_condensed(values), mat)
+
+    mats = _rand_sym_mat(10, nb_mats=3)
+    all_values = condense_sym_mat(mats)
+
+    assert all_values.shape == (3, 45)
+    assert np.array_equal(expand_condensed(all_values), mats)
+
+    # with diagonal
+    np.fill_diagonal(mat, 1.0)
+    assert np.array_equal(expand_condensed(condense_sym_mat(mat, k=0), k=0),
+                          mat)
+    assert np.array_equal(expand_condensed(values, diag_val=1.0), mat)
+
+
+def test_save_load_sym_mat():
+    """test save_sym_mat and load_sym_mat (dense and condensed files)"""
+    tmp_dir = _make_tmp_dir()
+
+    mat = _rand_sym_mat(10)
+    labels = ["ROI_" + str(i) for i in range(10)]
+
+    condensed_file = os.path.join(tmp_dir, "mat.npz")
+    save_sym_mat(condensed_file, mat, labels=labels, dtype="float32")
+
+    sym_mat = load_sym_mat(condensed_file, dense=False)
+    assert isinstance(sym_mat, CondensedSymMat)
+    assert sym_mat.shape == (10, 10)
+    assert sym_mat.dtype == np.float32
+    assert sym_mat.labels == labels
+    assert np.allclose(np.asarray(sym_mat), mat)
+    assert np.allclose(load_sym_mat(condensed_file), mat)
+
+    # source dtype by default
+    save_sym_mat(condensed_file, mat)
+    assert np.array_equal(load_sym_mat(condensed_file), mat)
+
+    # upper triangular matrices are loaded as saved
+    triu_mat = np.triu(mat)
+    save_sym_mat(condensed_file, triu_mat)
+    assert not load_sym_mat(condensed_file, dense=False).sym
+    assert np.array_equal(load_sym_mat(condensed_file), triu_mat)
+
+    # dense files are read as before
+    dense_file = os.path.join(tmp_dir, "mat.npy")
+    np.save(dense_file, mat)
+    assert np.array_equal(load_sym_mat(dense_file), mat)
+    assert np.array_equal(load_sym_mat(dense_file, dense=False).to_dense(),
+                          mat)
+
+
+def test_edge_store():
+    """test append_edge_store and read_edge_store (subsets of rows and
+    edges, over several chunks)"""
+    store_dir = os.path.join(_make_tmp_dir(), "edge_store")
+    shutil.rmtree(store_dir, ignore_errors=True)
+
+    edge_labels = ["e" + str(i) for i in range(45)]
+    values = np.random.rand(7, 45)
+
+    append_edge_store(store_dir, values[:4], [{'Seed': i} for i in range(4)],
+                      edge_labels=edge_labels)
+    append_edge_store(store_dir, values[4:],
+                      [{'Seed': i} for i in range(4, 7)])
+
+    assert is_edge_store(store_dir)
+
+    rows_info, store_labels = read_edge_store_index(store_dir)
+    assert store_labels == edge_labels
+    assert rows_info['Chunk'].tolist() == [0] * 4 + [1] * 3
+
+    df = read_edge_store(store_dir)
+    assert df.columns.tolist() == ['Seed'] + edge_labels
+    assert df['e3'].dtype == np.float32
+    assert np.allclose(df[edge_labels].values, values)
+
+    rows_info, sub_values = read_edge_store(
+        store_dir, rows=[5, 1, 6], edges=["e2", "e40"], as_frame=False)
+    assert rows_info['Seed'].tolist() == [5, 1, 6]
+    assert np.allclose(sub_values, values[[5, 1, 6]][:, [2, 40]])
@@ -3,13 +3,22 @@ import string
 import numpy as np
 import nibabel as nib
 
+from graphpype.utils import _make_tmp_dir
+
 from graphpype.utils_cor import (mean_select_mask_data,
                                  mean_select_indexed_mask_data,
+                                 build_ROI_projection, mask_ROI_projection,
+                                 project_ROI_ts, return_ROI_projection,
+                                 load_ROI_projection,
                                  regress_parameters, return_conf_cor_mat,
                                  filter_data, normalize_data,
                                  return_corres_correl_mat,
                                  where_in_labels,
-                                 return_corres_correl_mat_labels)
+                                 return_corres_correl_mat_labels,
+                                 return_corres_correl_mat_stack,
+                                 stream_group_cormats,
+                                 permut_group_mean_cormats,
+                                 label_group_mean_cormats)
 
 
 try:
@@ -57,6 +66,75 @@ def test_mean_select_indexed_mask_data():
     assert keep_rois.shape[0] == len(np.unique(data_indexed_mask))-1
 
 
+def test_ROI_projection():
+    """test projection operator: indexed and weighted atlases, masking of
+    voxels, saving next to the indexed mask"""
+    data_img = np.random.rand(4, 5, 6, 20) * 100 + 100
+    data_indexed_mask = np.zeros((4, 5, 6)) - 1
+    data_indexed_mask[:2, :, :3] = 0
+    data_indexed_mask[2:, :2, :] = 3
+
+    projection, ROI_index = build_ROI_projection(data_indexed_mask)
+
+    assert projection.shape == (2, 4 * 5 * 6)
+    assert ROI_index.tolist() == [0, 3]
+
+    mean_masked_ts, keep_rois = project_ROI_ts(projection, data_img)
+    assert np.all(keep_rois)
+    assert np.allclose(mean_masked_ts[1],
+                       np.mean(data_img[data_indexed_mask == 3], axis=0),
+                       rtol=1e-5)
+
+    # masking voxels (columns) of the operator
+    voxel_mask = np.ones((4, 5, 6), dtype=bool)
+    voxel_mask[:, :, 0] = False
+
+    mean_masked_ts, keep_rois = project_ROI_ts(
+        mask_ROI_projection(projection, voxel_mask), data_img)
+    assert np.allclose(mean_masked_ts[0], np.mean(
+        data_img[(data_indexed_mask == 0) & voxel_mask], axis=0), rtol=1e-5)
+
+    # weighted atlas, one volume per ROI
+    weighted_atlas = np.zeros((4, 5, 6, 2))
+    weighted_atlas[0, 0, 0, 0] = 0.25
+    weighted_atlas[1, 0, 0, 0] = 0.75
+    weighted_atlas[3, 4, 5, 1] = 1.0
+
+    projection, ROI_index = build_ROI_projection(weighted_atlas)
+    mean_masked_ts, keep_rois = project_ROI_ts(projection, data_img)
+    assert np.allclose(mean_masked_ts[0], 0.25 * data_img[0, 0, 0] +
+                       0.75 * data_img[1, 0, 0], rtol=1e-5)
+
+    # built in projection_file, then taken from the cache
+    tmp_dir = _make_tmp_dir()
+    indexed_rois_file = os.path.join(tmp_dir, "indexed_mask-test.nii")
+    nib.save(nib.Nifti1Image(data_indexed_mask, np.eye(4)),
+             indexed_rois_file)
+
+    cache_dir = os.path.join(tmp_dir, "cache")
+
+    for subj in ["subj_0", "subj_1"]:
+        os.makedirs(os.path.join(tmp_dir, subj))
+        projection_file = os.path.join(tmp_dir, subj, "ROI_projection.npz")
+
+        projection, ROI_index = return_ROI_projection(
+            indexed_rois_file, projection_file, cache_dir=cache_dir)
+
+        assert os.path.exists(projection_file)
+        assert (projection != build_ROI_projection(
+            data_indexed_mask)[0]).nnz == 0
+
+    assert len(os.listdir(cache_dir)) == 1
+
+    saved_projection, saved_ROI_index = load_ROI_projection(projection_file)
+    assert (saved_projection != projection).nnz == 0
+    assert np.array_equal(saved_ROI_index, ROI_index)
+
+    # nothing written next to the indexed mask
+    assert sorted(os.listdir(tmp_dir)) == [
+        "cache", "indexed_mask-test.nii", "subj_0", "subj_1"]
+
+
 # test regressing out signals
 time_length = 100
 nb_ROI = 10
@@ -133,3 +211,105 @@ def test_return_corres_correl_mat_labels():
     ref_mat = return_corres_correl_mat_labels(
         mat, labels, np_ref_labels.tolist())
     print(ref_mat)
+
+
+def test_return_corres_correl_mat_stack():
+    """test batched corres matrices, based on coords and on labels"""
+    mats = np.random.rand(3, nb_ROI, nb_ROI)
+
+    ref_mats, possible_edge_mats = return_corres_correl_mat_stack(
+        mats, nb_ref_ROI, coords=coords, corres_coords=ref_coords)
+
+    assert ref_mats.shape == (3, nb_ref_ROI, nb_ref_ROI)
+
+    for mat, ref_mat, possible_edge_mat in zip(mats, ref_mats,
+                                               possible_edge_mats):
+        corres_mat, possible_edge = return_corres_correl_mat(
+            mat, coords, ref_coords)
+        assert np.all(ref_mat == corres_mat)
+        assert np.all(possible_edge_mat == possible_edge)
+
+    # one list of labels per matrix
+    ref_mats, _ = return_corres_correl_mat_stack(
+        mats, nb_ref_ROI, labels=[labels]*3,
+        corres_labels=np_ref_labels.tolist())
+
+    for mat, ref_mat in zip(mats, ref_mats):
+        corres_mat, _ = return_corres_correl_mat_labels(
+            mat, labels, np_ref_labels.tolist())
+        assert np.all(ref_mat == corres_mat)
+
+
+def test_stream_group_cormats():
+    """test streaming mean/variance over a group of matrices, written in a
+    memory-mapped file"""
+    tmp_dir = _make_tmp_dir()
+
+    nb_mats = 5
+    mats = np.random.rand(nb_mats, nb_ROI, nb_ROI)
+    possible_edge_mats = np.random.randint(2, size=(nb_mats, nb_ROI, nb_ROI))
+
+    group_cormat_file = os.path.join(tmp_dir, "group_cormat.npy")
+
+    group_cormat, sum_cormat, count_mat, mean_cormat, var_cormat = \
+        stream_group_cormats(zip(range(nb_mats), mats, possible_edge_mats),
+                             nb_mats, nb_ROI,
+                             group_cormat_file=group_cormat_file)
+
+    assert np.all(np.load(group_cormat_file) == mats)
+    assert np.allclose(sum_cormat, np.sum(mats*possible_edge_mats, axis=0))
+    assert np.all(count_mat == np.sum(possible_edge_mats, axis=0))
+
+    masked_mats = np.ma.masked_array(mats, mask=possible_edge_mats == 0)
+    assert np.allclose(mean_cormat,
+                       np.ma.filled(masked_mats.mean(axis=0), 0))
+    assert np.allclose(var_cormat,
+                       np.ma.filled(masked_mats.var(axis=0, ddof=1), 0))
+
+    # NaN values are skipped, edge by edge
+    mats[2, 0, 1] = np.nan
+
+    _, sum_cormat, count_mat, mean_cormat, var_cormat = \
+        stream_group_cormats(zip(range(nb_mats), mats, [None] * nb_mats),
+                             nb_mats, nb_ROI)
+
+    assert count_mat[0, 1] == nb_mats - 1 and count_mat[1, 0] == nb_mats
+    assert np.isclose(mean_cormat[0, 1], np.nanmean(mats[:, 0, 1]))
+    assert np.isclose(var_cormat[0, 1], np.nanvar(mats[:, 0, 1], ddof=1))
+    assert np.allclose(mean_cormat[1:], mats[:, 1:].mean(axis=0))
+
+
+def test_permut_group_mean_cormats():
+    """test group means of many permutations at once"""
+    stack_edges = np.random.rand(10, 45)
+
+    permut_means, subj_indexes = permut_group_mean_cormats(
+        stack_edges, [4, 6], nb_permuts=20, seed=0, chunk_size=10)
+
+    assert permut_means.shape == (20, 2, 45)
+    assert subj_indexes.shape == (20, 10)
+
+    for k in [0, 19]:
+        assert sorted(subj_indexes[k]) == list(range(10))
+        assert np.allclose(permut_means[k, 0],
+                           stack_edges[subj_indexes[k, :4]].mean(axis=0))
+        assert np.allclose(permut_means[k, 1],
+                           stack_edges[subj_indexes[k, 4:]].mean(axis=0))
+
+    # same seed, same permutations
+    assert np.array_equal(permut_group_mean_cormats(
+        stack_edges, [4, 6], nb_permuts=20, seed=0)[1], subj_indexes)
+
+
+def test_label_group_mean_cormats():
+    """test group means from group labels (permutation plan)"""
+    stack_edges = np.random.rand(6, 10)
+    pooled_labels = np.array([[0, 0, 0, 1, 1, 1], [1, 0, 1, 0, 1, 1]])
+
+    permut_means = label_group_mean_cormats(stack_edges, pooled_labels, 2)
+
+    assert permut_means.shape == (2, 2, 10)
+    assert np.allclose(permut_means[0, 0], stack_edges[:3].mean(axis=0))
+    assert np.allclose(permut_means[1, 0], stack_edges[[1, 3]].mean(axis=0))
+    assert np.allclose(permut_means[1, 1],
+                       stack_edges[[0, 2, 4, 5]].mean(axis=0))
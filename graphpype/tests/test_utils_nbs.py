@@ -0,0 +1,65 @@
+import numpy as np
+
+from graphpype.utils_nbs import (threshold_edge_stats, compute_comp_measures,
+                                 compute_nbs)
+from graphpype.utils_stats import edge_components
+
+sample_size = 20
+nb_nodes = 15
+
+rng = np.random.default_rng(0)
+
+X = rng.standard_normal((2 * sample_size, nb_nodes, nb_nodes))
+X = (X + np.transpose(X, (0, 2, 1))) / 2.0
+
+# effect on a 4 nodes component (6 edges)
+X[:sample_size, :4, :4] += 3.0
+
+design = np.array([0] * sample_size + [1] * sample_size)
+
+
+def test_threshold_edge_stats():
+    """test thresholding of edge statistics and component measures"""
+    stat_edges = np.array([4.0, -5.0, 1.0, np.nan, 3.5])
+    s_i = np.array([0, 1, 0, 2, 3])
+    s_j = np.array([1, 2, 2, 3, 4])
+
+    supra_edges, excess_vals = threshold_edge_stats(stat_edges, 3.0)
+
+    assert (supra_edges == [True, True, False, False, True]).all()
+    assert np.allclose(excess_vals, [1.0, 2.0, 0.0, 0.0, 0.5])
+
+    supra_upper = threshold_edge_stats(stat_edges, 3.0, tail="upper")[0]
+    assert (supra_upper == [True, False, False, False, True]).all()
+
+    edge_comps, comp_sizes = edge_components(supra_edges, s_i, s_j, 5)
+
+    # 0-1-2 and 3-4
+    assert edge_comps[0] == edge_comps[1] != edge_comps[4]
+    assert edge_comps[2] == edge_comps[3] == -1
+
+    extent = compute_comp_measures(edge_comps, excess_vals, len(comp_sizes))
+    intensity = compute_comp_measures(edge_comps, excess_vals,
+                                      len(comp_sizes), measure="intensity")
+
+    assert extent[edge_comps[0]] == 2 and extent[edge_comps[4]] == 1
+    assert np.isclose(intensity[edge_comps[0]], 3.0)
+
+
+def test_compute_nbs():
+    """test if the planted component is found as the most significant"""
+    p_comps, comp_masks, stat_mat, null_dist = compute_nbs(
+        X, design, threshold=3.0, nb_permuts=200, seed=0)
+
+    assert null_dist.shape == (200,)
+    assert stat_mat.shape == (nb_nodes, nb_nodes)
+    assert comp_masks.shape == (len(p_comps), nb_nodes, nb_nodes)
+
+    assert p_comps[0] < 0.05
+    assert comp_masks[0][:4, :4][np.triu_indices(4, k=1)].all()
+
+    # same with intensity
+    p_comps = compute_nbs(X, design, threshold=3.0, nb_permuts=200,
+                          measure="intensity", seed=0)[0]
+
+    assert p_comps[0] < 0.05
@@ -5,7 +5,10 @@ import numpy as np
 from graphpype.utils_net import (return_net_list,
                                  read_Pajek_corres_nodes,
                                  read_Pajek_corres_nodes_and_sparse_matrix,
-                                 export_Louvain_net_from_list)
+                                 export_Louvain_net_from_list,
+                                 rewire_edges, shuffle_sym_mat,
+                                 rewire_sym_mat, return_null_model_mats,
+                                 rewire_net_list, return_null_net_lists)
 
 
 try:
@@ -61,3 +64,84 @@ def test_export_Louvain_net_from_list():
     export_Louvain_net_from_list(Z_Louvain_file, Z_list, coords)
 
     assert os.path.exists(Z_Louvain_file)
+
+
+def _random_sparse_sym_mat(nb_nodes=50, density=0.1, seed=0):
+    rng = np.random.default_rng(seed)
+    mat = np.triu(rng.random((nb_nodes, nb_nodes)) < density, k=1) * \
+        rng.random((nb_nodes, nb_nodes))
+    return mat + mat.T
+
+
+def test_rewire_edges():
+    """test degree preserving rewiring (no self-loops, no multi-edges)"""
+    mat = _random_sparse_sym_mat()
+    edge_i, edge_j = np.where(np.triu(mat, k=1) != 0)
+
+    new_i, new_j, nb_swaps = rewire_edges(edge_i, edge_j, mat.shape[0],
+                                          nb_swaps_per_edge=5,
+                                          rng=np.random.default_rng(1))
+
+    assert nb_swaps == 5 * len(edge_i) // 2
+    assert not np.any(new_i == new_j)
+    assert len(set(zip(new_i, new_j))) == len(edge_i)
+
+    degrees = np.bincount(np.concatenate((edge_i, edge_j)), minlength=50)
+    new_degrees = np.bincount(np.concatenate((new_i, new_j)), minlength=50)
+    assert np.array_equal(degrees, new_degrees)
+
+
+def test_null_model_mats():
+    """test shuffled / rewired matrices and reproducibility with seeds"""
+    mat = _random_sparse_sym_mat()
+    triu_i, triu_j = np.triu_indices(mat.shape[0], k=1)
+
+    shuffled_mat = shuffle_sym_mat(mat, np.random.default_rng(0))
+    assert (shuffled_mat == shuffled_mat.T).all()
+    assert np.array_equal(np.sort(shuffled_mat[triu_i, triu_j]),
+                          np.sort(mat[triu_i, triu_j]))
+
+    for weight_mode in ["keep", "rank"]:
+        rewired_mat = rewire_sym_mat(mat, np.random.default_rng(0),
+                                     weight_mode=weight_mode)
+
+        assert (rewired_mat == rewired_mat.T).all()
+        assert np.array_equal((rewired_mat != 0).sum(axis=0),
+                              (mat != 0).sum(axis=0))
+        assert np.array_equal(np.sort(rewired_mat[triu_i, triu_j]),
+                              np.sort(mat[triu_i, triu_j]))
+
+    null_mats = return_null_model_mats(mat, [-1, 1, 2],
+                                       null_model="edge_swap")
+
+    assert null_mats.shape == (3,) + mat.shape
+    assert np.array_equal(null_mats[0], mat)
+    assert np.array_equal(null_mats, return_null_model_mats(
+        mat, [-1, 1, 2], null_model="edge_swap"))
+
+
+def test_rewire_net_list():
+    """test degree preserving rewiring of a net list (both directions)"""
+    Z_list = np.loadtxt(Z_list_file, dtype=int)
+
+    new_Z_list = rewire_net_list(Z_list, rng=np.random.default_rng(0))
+
+    assert new_Z_list.shape[1] == 3
+    assert not np.any(new_Z_list[:, 0] == new_Z_list[:, 1])
+
+    # each edge in both directions, no multi-edges
+    edges = set(zip(new_Z_list[:, 0], new_Z_list[:, 1]))
+    assert len(edges) == new_Z_list.shape[0]
+    assert all((j, i) in edges for i, j in edges)
+
+    # same degrees (undirected)
+    def _degrees(net_list):
+        edges = set((min(i, j), max(i, j)) for i, j in net_list[:, :2])
+        return np.bincount(np.array(list(edges)).ravel())
+
+    assert np.array_equal(_degrees(Z_list), _degrees(new_Z_list))
+
+    null_net_lists = return_null_net_lists(Z_list, [-1, 0, 1],
+                                           weight_mode="rank")
+    assert len(null_net_lists) == 3
+    assert np.array_equal(null_net_lists[0], Z_list)
@@ -6,7 +6,14 @@ from graphpype.utils_stats import (_return_signif_code, _return_signif_code_Z,
                                    compute_pairwise_oneway_ttest_fdr,
                                    compute_pairwise_binom_fdr,
                                    compute_pairwise_mannwhitney_fdr,
-                                   compute_correl_behav)
+                                   compute_correl_behav,
+                                   edge_ttest_ind, edge_ttest_rel,
+                                   edge_ttest_1samp, edge_pearsonr,
+                                   compute_oneway_anova_fwe,
+                                   edge_mannwhitneyu, edge_binom_test,
+                                   compute_permut_fwe, return_permut_plan,
+                                   return_pooled_labels, group_edge_moments,
+                                   paired_edge_moments)
 
 
 # building objects for testing
@@ -143,6 +150,41 @@ def test_compute_pairwise_mannwhitney_fdr():
     assert res.shape == new_sample_X.shape[1:]
 
 
+def test_edge_mannwhitneyu():
+    """
+    test if vectorized Mann-Whitney gives the same results as scipy.stats
+    (with ties and NaN values)
+    """
+    X_edges = np.round(new_sample_X.reshape(sample_size, -1), 1)
+    Y_edges = np.round(new_sample_Y.reshape(sample_size, -1), 1)
+
+    X_edges[0, :10] = np.nan
+
+    U_stat, p_val = edge_mannwhitneyu(X_edges, Y_edges)[:2]
+
+    for i in range(X_edges.shape[1]):
+        x_val = X_edges[~np.isnan(X_edges[:, i]), i]
+
+        res = stat.mannwhitneyu(x_val, Y_edges[:, i], use_continuity=False,
+                                alternative="two-sided", method="asymptotic")
+
+        assert np.allclose((U_stat[i], p_val[i]), (res[0], res[1]))
+
+    # exact distribution for small samples without ties
+    rng = np.random.default_rng(0)
+    X_edges = rng.random((5, 40))
+    Y_edges = rng.random((7, 40)) + 0.5 * rng.random(40)
+    Y_edges[0, :5] = X_edges[0, :5]
+
+    p_val = edge_mannwhitneyu(X_edges, Y_edges)[1]
+
+    for i in range(X_edges.shape[1]):
+        res = stat.mannwhitneyu(X_edges[:, i], Y_edges[:, i],
+                                use_continuity=False, alternative="two-sided")
+
+        assert np.isclose(p_val[i], res[1])
+
+
 def test_compute_correl_behav():
     """
     test if pairwise correlation with a behavioural vector is correct
@@ -155,6 +197,64 @@ def test_compute_correl_behav():
     assert res[2].shape == new_sample_X.shape[1:]
 
 
+def test_edge_stats():
+    """
+    test if vectorized edge statistics are the same as scipy.stats
+    applied edge by edge, with NaN values
+    """
+    X_edges = new_sample_X.reshape(sample_size, -1).copy()
+    Y_edges = new_sample_Y.reshape(sample_size, -1).copy()
+
+    X_edges[0, :10] = np.nan
+    Y_edges[1, 5:15] = np.nan
+
+    t_ind, p_ind = edge_ttest_ind(X_edges, Y_edges)[:2]
+    t_rel, p_rel = edge_ttest_rel(X_edges, Y_edges)[:2]
+    t_1samp, p_1samp = edge_ttest_1samp(X_edges)[:2]
+    r_stat, p_r = edge_pearsonr(X_edges, random_reg)[:2]
+
+    for i in range(X_edges.shape[1]):
+        x_val = X_edges[:, i]
+        y_val = Y_edges[:, i]
+
+        x_nonan = x_val[~np.isnan(x_val)]
+        y_nonan = y_val[~np.isnan(y_val)]
+        both = ~np.isnan(x_val) & ~np.isnan(y_val)
+
+        assert np.allclose((t_ind[i], p_ind[i]),
+                           stat.ttest_ind(x_nonan, y_nonan))
+        assert np.allclose((t_rel[i], p_rel[i]),
+                           stat.ttest_rel(x_val[both], y_val[both]))
+        assert np.allclose((t_1samp[i], p_1samp[i]),
+                           stat.ttest_1samp(x_nonan, 0.0))
+        assert np.allclose(
+            (r_stat[i], p_r[i]),
+            stat.pearsonr(x_nonan, random_reg[~np.isnan(x_val)]))
+
+
+def test_compute_oneway_anova_fwe():
+    """
+    test if vectorized one-way ANOVA gives the same results as stat.f_oneway
+    """
+    new_sample_Z = np.random.rand(sample_size - 5, array_size, array_size)
+
+    list_of_list_matrices = [new_sample_X, new_sample_Y, new_sample_Z]
+
+    res = compute_oneway_anova_fwe(
+        list_of_list_matrices, cor_alpha=cor_alpha, uncor_alpha=uncor_alpha)
+
+    for mat in res:
+        assert mat.shape == new_sample_X.shape[1:]
+        assert (mat == mat.T).all()
+
+    for i, j in [(0, 1), (2, 5), (7, 9)]:
+        F_stat, p_val = stat.f_oneway(*[group_mat[:, i, j] for group_mat
+                                        in list_of_list_matrices])
+
+        assert np.isclose(res[1][i, j], p_val)
+        assert np.isclose(res[2][i, j], F_stat)
+
+
 # test binomial
 # Generating random binomial distribution
 new_binom_X = np.random.choice(
@@ -171,3 +271,110 @@ def test_compute_pairwise_binom_fdr():
         cor_alpha=cor_alpha, old_order=False)
 
     assert res.shape == new_binom_X.shape[1:]
+
+    res_exact = compute_pairwise_binom_fdr(
+        new_binom_X, new_binom_Y, uncor_alpha=uncor_alpha,
+        cor_alpha=cor_alpha, old_order=False, method="exact")
+
+    assert res_exact.shape == new_binom_X.shape[1:]
+    assert (res_exact == res_exact.T).all()
+
+
+def test_edge_binom_test():
+    """test if exact binomial test is the same as Fisher exact test"""
+    count_X = np.arange(21)
+    count_Y = np.arange(21)[::-1] // 2
+
+    p_val, sign_diff = edge_binom_test(count_X, 20, count_Y, 15,
+                                       method="exact")
+
+    for i in range(len(count_X)):
+        table = [[count_X[i], 20 - count_X[i]], [count_Y[i], 15 - count_Y[i]]]
+
+        assert np.isclose(p_val[i], stat.fisher_exact(table)[1])
+
+
+def test_compute_permut_fwe():
+    """
+    test max-T permutation test: observed T values, reproducibility with
+    n_jobs, and detection of a strong effect
+    """
+    rng = np.random.default_rng(0)
+    shape = (2 * sample_size, array_size, array_size)
+
+    X = rng.random(shape) * rng.choice([-1, 1], size=shape)
+    X[:sample_size, :5, :5] += 5.0
+
+    design = np.array([0] * sample_size + [1] * sample_size)
+
+    stat_mat, p_fwe_mat, p_comp_mat, null_dists = compute_permut_fwe(
+        X, design, test="ttest_ind", nb_permuts=200, cluster_threshold=4.0,
+        seed=0)
+
+    T_stat_mat = compute_pairwise_ttest_fdr(
+        X[:sample_size], X[sample_size:], cor_alpha=cor_alpha,
+        uncor_alpha=uncor_alpha, paired=False, old_order=False)[2]
+
+    assert np.allclose(stat_mat, T_stat_mat)
+    assert null_dists["max_stat"].shape == (200,)
+    assert null_dists["max_comp_size"].shape == (200,)
+
+    assert (p_fwe_mat[:5, :5][np.triu_indices(5, k=1)] < 0.01).all()
+    assert (p_comp_mat[:5, :5][np.triu_indices(5, k=1)] < 0.01).all()
+
+    res = compute_permut_fwe(X, design, test="ttest_ind", nb_permuts=200,
+                             cluster_threshold=4.0, seed=0, n_jobs=2)
+
+    assert np.array_equal(res[1], p_fwe_mat)
+    assert np.array_equal(res[2], p_comp_mat)
+
+
+def test_permut_plan():
+    """test permutation plan (unbalanced and balanced)"""
+    seeds = [-1, 0, 1]
+
+    labels = return_permut_plan([3, 4], seeds, unbalanced=True)
+
+    assert labels.dtype == np.int8 and labels.shape == (3, 7)
+    assert (labels[0] == [0, 0, 0, 1, 1, 1, 1]).all()
+
+    # balanced by default, as in ComputePermutPlan
+    shifts = return_permut_plan([4, 4], seeds)
+    assert shifts.shape == (3, 4) and (shifts[0] == 0).all()
+    assert np.array_equal(shifts, return_permut_plan([4, 4], seeds,
+                                                     unbalanced=False))
+
+    pooled_labels = return_pooled_labels(
+        {"labels": shifts, "group_sizes": [4, 4], "unbalanced": False})
+
+    # in each permutation, each subject is in each group once
+    assert pooled_labels.shape == (3, 8)
+    assert (pooled_labels[:, :4] + pooled_labels[:, 4:] == 1).all()
+
+
+def test_group_edge_moments():
+    """test grouped moments (by chunks) against per group computation"""
+    stack = np.random.rand(12, 5, 5)
+    stack[2, 1, 3] = np.nan
+    group_labels = np.array([0, 1, 2, -1] * 3)
+
+    nb_vals, mean_vals, var_vals = group_edge_moments(stack, group_labels,
+                                                      chunk_size=7)
+
+    assert nb_vals.shape == (3, 5, 5)
+
+    for group in range(3):
+        group_stack = stack[group_labels == group]
+
+        assert np.array_equal(nb_vals[group],
+                              np.sum(~np.isnan(group_stack), axis=0))
+        assert np.allclose(mean_vals[group], np.nanmean(group_stack, axis=0))
+        assert np.allclose(var_vals[group],
+                           np.nanvar(group_stack, axis=0, ddof=1))
+
+    nb_diff, mean_diff, var_diff = paired_edge_moments(
+        stack, [0, 4, 8], [1, 5, 9], chunk_size=7)
+
+    diff = stack[[0, 4, 8]] - stack[[1, 5, 9]]
+    assert np.allclose(mean_diff, diff.mean(axis=0))
+    assert np.allclose(var_diff, diff.var(axis=0, ddof=1))
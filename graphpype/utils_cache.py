@@ -0,0 +1,174 @@
+"""
+Content-addressed on-disk cache for derived atlas artefacts (relabelled or
+filtered masks, ROI coords, labels...), shared between subjects and runs
+
+Each entry is a directory of cache_dir, named after a key computed from the
+content of the input files and the parameters (see cache_key). Entries are
+written atomically, and the least recently used ones are removed when the
+cache grows above max_size (in bytes)
+"""
+import os
+import shutil
+import hashlib
+import tempfile
+
+default_max_size = 2 ** 30
+
+# file hashes, valid while path, size and modification time are unchanged
+_file_hash_cache = {}
+
+
+def file_hash(file_name, block_size=2 ** 20):
+    """md5 of the content of a file (computed once per version of the file)"""
+    file_name = os.path.abspath(file_name)
+    stat = os.stat(file_name)
+
+    key = (file_name, stat.st_size, stat.st_mtime_ns)
+
+    if key not in _file_hash_cache:
+        md5 = hashlib.md5()
+
+        with open(file_name, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                md5.update(block)
+
+        _file_hash_cache[key] = md5.hexdigest()
+
+    return _file_hash_cache[key]
+
+
+def cache_key(input_files, params=None):
+    """
+    key from the content of input_files (None are skipped, file names are
+    not used) and from params (dict, compared through their repr)
+    """
+    md5 = hashlib.md5()
+
+    for input_file in input_files:
+        md5.update(b"None" if input_file is None
+                   else file_hash(input_file).encode())
+
+    if params is not None:
+        md5.update(repr(sorted(params.items())).encode())
+
+    return md5.hexdigest()
+
+
+def _entry_size(entry_dir):
+    return sum(entry.stat().st_size for entry in os.scandir(entry_dir)
+               if entry.is_file())
+
+
+def cache_lookup(cache_dir, key, file_names):
+    """
+    paths of file_names in the cache entry key (None if the entry, or any of
+    the files, is missing); the entry is marked as used
+    """
+    entry_dir = os.path.join(cache_dir, key)
+
+    cached_files = [os.path.join(entry_dir, file_name)
+                    for file_name in file_names]
+
+    if not all(os.path.exists(cached_file) for cached_file in cached_files):
+        return None
+
+    try:
+        os.utime(entry_dir)
+
+    except OSError:
+        # evicted meanwhile
+        return None
+
+    return cached_files
+
+
+def cache_store(cache_dir, key, files, max_size=default_max_size):
+    """
+    copy files (kept with their base names) in the cache entry key, then
+    evict least recently used entries above max_size
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+
+    entry_dir = os.path.join(cache_dir, key)
+
+    if not os.path.exists(entry_dir):
+        tmp_dir = tempfile.mkdtemp(dir=cache_dir, prefix=".tmp_")
+
+        for cur_file in files:
+            shutil.copyfile(cur_file, os.path.join(
+                tmp_dir, os.path.basename(cur_file)))
+
+        try:
+            os.rename(tmp_dir, entry_dir)
+
+        except OSError:
+            # same entry stored concurrently
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    evict_cache(cache_dir, max_size, keep=[key])
+
+
+def evict_cache(cache_dir, max_size=default_max_size, keep=[]):
+    """remove least recently used entries until the cache size is below
+    max_size (entries in keep are not removed)"""
+    entries = []
+
+    for entry in os.scandir(cache_dir):
+        if entry.is_dir() and not entry.name.startswith("."):
+            try:
+                entries.append((entry.stat().st_mtime, entry.name,
+                                _entry_size(entry.path)))
+            except OSError:
+                continue
+
+    cache_size = sum(entry[2] for entry in entries)
+
+    for mtime, name, size in sorted(entries):
+        if cache_size <= max_size:
+            break
+
+        if name in keep:
+            continue
+
+        print("Removing cache entry {} ({} bytes)".format(name, size))
+        shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+        cache_size -= size
+
+    return cache_size
+
+
+def cached_call(cache_dir, input_files, params, out_files, compute_func,
+                max_size=default_max_size):
+    """
+    Produce out_files (paths, distinct base names) either from the cache, or
+    by calling compute_func() (which should write all out_files), that are
+    then stored in the cache
+
+    If cache_dir is None or empty, compute_func is simply called
+
+    Returns True if out_files were taken from the cache
+    """
+    if not cache_dir:
+        compute_func()
+        return False
+
+    out_names = [os.path.basename(out_file) for out_file in out_files]
+
+    key = cache_key(input_files, dict(params or {}, out_files=out_names))
+
+    cached_files = cache_lookup(cache_dir, key, out_names)
+
+    if cached_files is not None:
+        print("Using cache entry {}".format(key))
+
+        for cached_file, out_file in zip(cached_files, out_files):
+            shutil.copyfile(cached_file, out_file)
+
+        return True
+
+    compute_func()
+
+    cache_store(cache_dir, key, out_files, max_size=max_size)
+
+    return False
@@ -0,0 +1,390 @@
+"""
+Support functions for condensed storage of symmetric matrices
+(upper triangle only), with shape and labels metadata
+
+Condensed matrices are saved in .npz format, with the following fields:
+- values: upper triangle values (1D for one matrix, 2D (nb_mats, nb_edges)
+for a stack of matrices)
+- size: number of nodes
+- k: diagonal offset (1 -> diagonal excluded, 0 -> diagonal included)
+- labels: node labels (possibly empty)
+- sym: True if the matrix is symmetric, False if it is upper triangular
+(lower triangle is zero)
+
+Dense matrices (in .npy format) and condensed matrices can be read the same
+way with load_sym_mat
+
+Stacks of condensed matrices (e.g. one row per permutation) can also be kept
+in an edge store: a directory with the edge labels (edge_labels.txt), one
+line of info per row (rows.csv) and float32 values in chunks
+(values_00000.npy, ...), each append adding a new chunk
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+_triu_indices_cache = {}
+
+
+def triu_indices(size, k=1):
+    """np.triu_indices, computed only once for a given size and k
+    (returned arrays are read-only)"""
+    key = (int(size), int(k))
+
+    if key not in _triu_indices_cache:
+        triu_i, triu_j = np.triu_indices(key[0], k=key[1])
+        triu_i.setflags(write=False)
+        triu_j.setflags(write=False)
+        _triu_indices_cache[key] = (triu_i, triu_j)
+
+    return _triu_indices_cache[key]
+
+
+def nb_edges_from_size(size, k=1):
+    """number of values in the upper triangle of a (size, size) matrix"""
+    return size * (size - 1) // 2 + (size if k == 0 else 0)
+
+
+def size_from_nb_edges(nb_edges, k=1):
+    """inverse of nb_edges_from_size"""
+    if k == 1:
+        size = int(round((1 + np.sqrt(1 + 8 * nb_edges)) / 2))
+    else:
+        size = int(round((-1 + np.sqrt(1 + 8 * nb_edges)) / 2))
+
+    assert nb_edges_from_size(size, k) == nb_edges, \
+        ("Error, {} values can not be the upper triangle of a square \
+         matrix (k = {})".format(nb_edges, k))
+    return size
+
+
+def condense_sym_mat(mat, k=1, dtype=None):
+    """
+    upper triangle of a symmetric matrix (or of a stack of matrices,
+    with shape (nb_mats, size, size))
+    """
+    mat = np.asarray(mat)
+    assert mat.shape[-1] == mat.shape[-2], \
+        ("Error, matrix should be square {}".format(mat.shape))
+
+    triu_i, triu_j = triu_indices(mat.shape[-1], k=k)
+
+    values = mat[..., triu_i, triu_j]
+
+    if dtype is not None:
+        values = values.astype(dtype, copy=False)
+
+    return values
+
+
+def expand_condensed(values, size=None, k=1, diag_val=0.0, dtype=None,
+                     sym=True):
+    """
+    dense symmetric matrix (or stack of matrices) from the upper triangle
+    values (upper triangular matrix if sym is False)
+    """
+    values = np.asarray(values)
+
+    if size is None:
+        size = size_from_nb_edges(values.shape[-1], k=k)
+
+    if dtype is None:
+        dtype = values.dtype
+
+    mat = np.zeros(values.shape[:-1] + (size, size), dtype=dtype)
+
+    if k == 1:
+        mat[..., np.arange(size), np.arange(size)] = diag_val
+
+    triu_i, triu_j = triu_indices(size, k=k)
+
+    mat[..., triu_i, triu_j] = values
+
+    if sym:
+        mat[..., triu_j, triu_i] = values
+
+    return mat
+
+
+def is_upper_triangular(mat, k=1):
+    """check if the lower triangle (below diagonal k - 1) of a matrix (or of
+    all matrices of a stack) is zero, and the matrix is not symmetric"""
+    mat = np.asarray(mat)
+
+    triu_i, triu_j = triu_indices(mat.shape[-1], k=k)
+
+    lower_values = mat[..., triu_j, triu_i]
+    upper_values = mat[..., triu_i, triu_j]
+
+    return not np.any(lower_values) and np.any(upper_values)
+
+
+class CondensedSymMat(object):
+    """
+    Symmetric matrix (or stack of symmetric matrices) stored as upper
+    triangle values, with size and labels. The dense matrix is only built
+    when needed (to_dense, or any numpy function through __array__)
+
+    Upper triangular matrices (as returned by return_conf_cor_mat) are
+    stored with sym=False, and expanded as upper triangular
+    """
+
+    def __init__(self, values, size=None, k=1, labels=None, sym=True):
+
+        self.values = np.asarray(values)
+        self.k = int(k)
+        self.sym = bool(sym)
+
+        if size is None:
+            size = size_from_nb_edges(self.values.shape[-1], k=self.k)
+
+        self.size = int(size)
+
+        assert self.values.shape[-1] == nb_edges_from_size(self.size,
+                                                           self.k), \
+            ("Error, {} values for a matrix of size {}".format(
+                self.values.shape[-1], self.size))
+
+        if labels is None:
+            labels = []
+
+        self.labels = [str(label) for label in labels]
+
+        assert len(self.labels) in [0, self.size], \
+            ("Error, {} labels for a matrix of size {}".format(
+                len(self.labels), self.size))
+
+    @classmethod
+    def from_dense(cls, mat, k=1, dtype=None, labels=None):
+        """build from a dense symmetric (or upper triangular) matrix (or
+        stack of)"""
+        mat = np.asarray(mat)
+        return cls(condense_sym_mat(mat, k=k, dtype=dtype),
+                   size=mat.shape[-1], k=k, labels=labels,
+                   sym=not is_upper_triangular(mat, k=k))
+
+    @property
+    def shape(self):
+        """shape of the equivalent dense matrix (or stack of)"""
+        return self.values.shape[:-1] + (self.size, self.size)
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    @property
+    def triu_indices(self):
+        return triu_indices(self.size, k=self.k)
+
+    def to_dense(self, diag_val=0.0, dtype=None):
+        """dense symmetric (or upper triangular) matrix (or stack of)"""
+        return expand_condensed(self.values, self.size, k=self.k,
+                                diag_val=diag_val, dtype=dtype, sym=self.sym)
+
+    def __array__(self, dtype=None, copy=None):
+        return self.to_dense(dtype=dtype)
+
+    def __len__(self):
+        return len(self.values) if self.values.ndim > 1 else self.size
+
+    def save(self, condensed_file):
+        """save in .npz format"""
+        np.savez(condensed_file, values=self.values, size=self.size,
+                 k=self.k, labels=np.array(self.labels, dtype='str'),
+                 sym=self.sym)
+
+    @classmethod
+    def load(cls, condensed_file):
+        """load from .npz format"""
+        with np.load(condensed_file) as data:
+            # files saved without sym are symmetric
+            sym = bool(data['sym']) if 'sym' in data.files else True
+
+            return cls(data['values'], size=int(data['size']),
+                       k=int(data['k']), labels=data['labels'].tolist(),
+                       sym=sym)
+
+
+def is_condensed_file(mat_file):
+    """check if a file was saved as condensed matrix (in .npz format)"""
+    if os.path.splitext(mat_file)[1] != ".npz":
+        return False
+
+    with np.load(mat_file) as data:
+        return "values" in data.files and "size" in data.files
+
+
+def save_sym_mat(condensed_file, mat, k=1, dtype=None, labels=None):
+    """save dense symmetric (or upper triangular) matrix (or stack of) in
+    condensed form, in the dtype of mat by default"""
+    sym_mat = CondensedSymMat.from_dense(mat, k=k, dtype=dtype,
+                                         labels=labels)
+    sym_mat.save(condensed_file)
+    return sym_mat
+
+
+def load_sym_mat(mat_file, dense=True, mmap_mode=None):
+    """
+    load a matrix, either dense (.npy format) or condensed (.npz format)
+
+    if dense is False, a CondensedSymMat is returned (the matrix is
+    condensed if needed, assuming symmetry)
+    """
+    if is_condensed_file(mat_file):
+        sym_mat = CondensedSymMat.load(mat_file)
+
+        if dense:
+            return sym_mat.to_dense()
+        return sym_mat
+
+    mat = np.load(mat_file, mmap_mode=mmap_mode)
+
+    if dense:
+        return mat
+    return CondensedSymMat.from_dense(mat)
+
+
+# chunked on-disk store for stacks of condensed matrices (rows x edges)
+def _edge_store_files(store_dir):
+    return (os.path.join(store_dir, "edge_labels.txt"),
+            os.path.join(store_dir, "rows.csv"))
+
+
+def _edge_store_chunk_file(store_dir, chunk):
+    return os.path.join(store_dir, "values_{:05d}.npy".format(chunk))
+
+
+def is_edge_store(store_dir):
+    """check if store_dir contains an edge store"""
+    return all(os.path.exists(store_file)
+               for store_file in _edge_store_files(store_dir))
+
+
+def read_edge_store_index(store_dir):
+    """
+    rows (DataFrame of row info, with the chunk of each row) and edge
+    labels of an edge store, without reading any value
+    """
+    labels_file, rows_file = _edge_store_files(store_dir)
+
+    with open(labels_file) as f:
+        edge_labels = [line.rstrip("\n") for line in f]
+
+    return pd.read_csv(rows_file), edge_labels
+
+
+def append_edge_store(store_dir, values, rows_info, edge_labels=None,
+                      dtype="float32"):
+    """
+    append values (nb_rows, nb_edges) to an edge store, as a new chunk
+
+    Existing chunks are not rewritten; rows_info is a DataFrame (or list of
+    dicts) with one row of info per line of values; edge_labels are only
+    needed when the store is created
+    """
+    values = np.asarray(values, dtype=dtype)
+    if values.ndim == 1:
+        values = values.reshape(1, -1)
+
+    rows_info = pd.DataFrame(rows_info)
+
+    assert rows_info.shape[0] == values.shape[0], \
+        ("Error, {} rows of info for {} rows of values".format(
+            rows_info.shape[0], values.shape[0]))
+
+    labels_file, rows_file = _edge_store_files(store_dir)
+
+    if is_edge_store(store_dir):
+        rows, store_labels = read_edge_store_index(store_dir)
+        chunk = int(rows['Chunk'].max()) + 1 if rows.shape[0] else 0
+
+        assert len(store_labels) == values.shape[1], \
+            ("Error, {} edges in values, {} in store".format(
+                values.shape[1], len(store_labels)))
+
+    else:
+        assert edge_labels is not None and \
+            len(edge_labels) == values.shape[1], \
+            "Error, edge_labels should be given when creating the store"
+
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+
+        with open(labels_file, "w") as f:
+            f.write("\n".join(edge_labels) + "\n")
+
+        chunk = 0
+
+    if values.shape[0] == 0:
+        if not os.path.exists(rows_file):
+            rows_info.assign(Chunk=0).iloc[:0].to_csv(rows_file, index=False)
+        return
+
+    np.save(_edge_store_chunk_file(store_dir, chunk), values)
+
+    # rows are written after values, an interrupted append is ignored
+    rows_info.assign(Chunk=chunk).to_csv(
+        rows_file, mode="a", header=not os.path.exists(rows_file),
+        index=False)
+
+
+def read_edge_store(store_dir, rows=None, edges=None, as_frame=True):
+    """
+    read values of an edge store, only loading the chunks (with memory
+    mapping) and columns needed
+
+    rows: index of rows (default all), edges: index or labels of edges
+    (default all)
+
+    returns a DataFrame with row info and one column per edge, or
+    (row info, values) if as_frame is False
+    """
+    rows_info, edge_labels = read_edge_store_index(store_dir)
+
+    if rows is None:
+        rows = np.arange(rows_info.shape[0])
+    else:
+        rows = np.arange(rows_info.shape[0])[rows]
+
+    if edges is None:
+        edges = np.arange(len(edge_labels))
+
+    elif len(edges) and isinstance(edges[0], str):
+        label_index = {label: i for i, label in enumerate(edge_labels)}
+        edges = np.array([label_index[label] for label in edges], dtype=int)
+
+    else:
+        edges = np.arange(len(edge_labels))[edges]
+
+    chunks = rows_info['Chunk'].values
+    sub_rows_info = rows_info.iloc[rows].drop('Chunk', axis=1)
+    sub_rows_info.reset_index(drop=True, inplace=True)
+
+    values = None
+
+    for chunk in np.unique(chunks[rows]):
+
+        chunk_rows = np.where(chunks == chunk)[0]
+        chunk_values = np.load(_edge_store_chunk_file(store_dir, chunk),
+                               mmap_mode="r")
+
+        if values is None:
+            values = np.empty((len(rows), len(edges)),
+                              dtype=chunk_values.dtype)
+
+        out = np.where(chunks[rows] == chunk)[0]
+        in_chunk = np.searchsorted(chunk_rows, rows[out])
+
+        # only the requested (row, edge) values are read from the memmap
+        values[out] = chunk_values[np.ix_(in_chunk, edges)]
+
+    if values is None:
+        values = np.empty((0, len(edges)), dtype="float32")
+
+    if not as_frame:
+        return sub_rows_info, values
+
+    df_values = pd.DataFrame(values, columns=[edge_labels[i] for i in edges])
+
+    return pd.concat((sub_rows_info, df_values), axis=1)
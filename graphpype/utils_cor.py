@@ -2,7 +2,9 @@
 Support function for correl_mat.py mostly, some for gather_cormats
 """
 from scipy import stats
+import scipy.sparse as sp
 import numpy as np
+import nibabel as nib
 
 import pandas as pd
 
@@ -11,6 +13,7 @@ import itertools as it
 import scipy.signal as filt
 
 from .utils import check_np_shapes
+from .utils_cache import cached_call
 from .utils_dtype_coord import where_in_coords
 
 
@@ -40,69 +43,198 @@ def mean_select_mask_data(data_img, data_mask):
     return mean_mask_data_matrix
 
 
-def mean_select_indexed_mask_data(data_img, data_indexed_mask,
-                                  min_BOLD_intensity=50, percent_signal=0.5,
-                                  background_val=-1.0):
+def build_ROI_projection(indexed_data, background_val=-1.0, min_weight=0.0):
     """
-    extrating ts by averaging the time series of all voxels with the same
-    index
+    Sparse (CSR) projection operator from voxels to ROIs, of shape
+    (nb_ROIs, nb_voxels), voxels being in C order of the 3D volume
+
+    indexed_data: either 3D indexed mask (one ROI per value, background_val
+    and NaN excepted), or 4D weighted / probabilistic atlas (one volume per
+    ROI, weights above min_weight are kept)
+
+    The operator is not normalised (see project_ROI_ts), so that columns
+    can be zeroed (see mask_ROI_projection) without rebuilding it
+
+    Returns the operator and the index (value in indexed_data) of each ROI
+    """
+    indexed_data = np.asarray(indexed_data)
+
+    if indexed_data.ndim == 3:
+        flat_data = indexed_data.ravel()
+
+        vox = np.nonzero((flat_data != background_val) &
+                         ~np.isnan(flat_data))[0]
+
+        ROI_index, ROIs = np.unique(flat_data[vox], return_inverse=True)
+
+        weights = np.ones(len(vox))
+        nb_voxels = flat_data.shape[0]
+
+    elif indexed_data.ndim == 4:
+        flat_data = indexed_data.reshape(-1, indexed_data.shape[3])
+
+        vox, ROIs = np.nonzero(flat_data > min_weight)
+
+        weights = flat_data[vox, ROIs].astype(float)
+        ROI_index = np.arange(indexed_data.shape[3])
+        nb_voxels = flat_data.shape[0]
+
+    else:
+        raise ValueError("Error, indexed_data should be 3D or 4D, shape is \
+            {}".format(indexed_data.shape))
+
+    projection = sp.csr_matrix((weights, (ROIs, vox)),
+                               shape=(len(ROI_index), nb_voxels))
+
+    return projection, ROI_index
+
+
+def mask_ROI_projection(projection, voxel_mask):
+    """zero the columns of the projection operator of the voxels outside
+    voxel_mask (3D boolean, e.g. subject grey matter mask)"""
+    voxel_mask = np.asarray(voxel_mask, dtype=bool).ravel()
+
+    assert voxel_mask.shape[0] == projection.shape[1], \
+        ("Error, {} voxels in mask, {} in projection".format(
+            voxel_mask.shape[0], projection.shape[1]))
+
+    masked_projection = projection.multiply(voxel_mask).tocsr()
+    masked_projection.eliminate_zeros()
+
+    return masked_projection
+
+
+def save_ROI_projection(projection_file, projection, ROI_index,
+                        background_val=-1.0):
+    """save the projection operator in .npz format"""
+    projection = projection.tocsr()
+
+    np.savez(projection_file, data=projection.data,
+             indices=projection.indices, indptr=projection.indptr,
+             shape=projection.shape, ROI_index=ROI_index,
+             background_val=background_val)
+
+
+def load_ROI_projection(projection_file):
+    """load the projection operator and ROI index (see save_ROI_projection)"""
+    with np.load(projection_file) as data:
+        projection = sp.csr_matrix(
+            (data['data'], data['indices'], data['indptr']),
+            shape=tuple(data['shape']))
+
+        return projection, data['ROI_index']
+
+
+def return_ROI_projection(indexed_rois_file, projection_file,
+                          background_val=-1.0, cache_dir=None):
+    """
+    projection operator of an indexed mask file (see build_ROI_projection),
+    written in projection_file (.npz); if cache_dir is given, it is taken
+    from (or stored in) the atlas cache (see utils_cache), so it is only
+    built once for all subjects
+    """
+    def _compute_projection():
+        indexed_data = np.asanyarray(nib.load(indexed_rois_file).dataobj)
+
+        projection, ROI_index = build_ROI_projection(
+            indexed_data, background_val=background_val)
+
+        save_ROI_projection(projection_file, projection, ROI_index,
+                            background_val=background_val)
+
+    cached_call(cache_dir, [indexed_rois_file],
+                {"background_val": float(background_val)}, [projection_file],
+                _compute_projection)
+
+    return load_ROI_projection(projection_file)
+
+
+def project_ROI_ts(projection, data_img, min_BOLD_intensity=50,
+                   percent_signal=0.5, ROI_index=None):
+    """
+    extrating ts by averaging (weighted by the projection operator) the time
+    series of the voxels of each ROI, with a single sparse-dense product;
+    NaN are ignored
+
+    Only ROIs with more than percent_signal (weighted fraction) of the
+    voxels with values always higher than min_BOLD_intensity are kept
     """
     assert len(data_img.shape) == 4, \
         ("Error, data_img should be a 4Dfile, shape is {}".format(
             data_img.shape))
 
-    assert check_np_shapes(data_img.shape[:3], data_indexed_mask.shape), \
-        ("Error, Image and mask are incompatible {} {}".format(
-            data_img.shape[:3], data_indexed_mask.shape))
+    assert projection.shape[1] == np.prod(data_img.shape[:3]), \
+        ("Error, Image {} and projection {} are incompatible".format(
+            data_img.shape[:3], projection.shape))
 
-    # sequence_roi_index
-    sequence_roi_index = np.unique(data_indexed_mask)
+    # only voxels in ROIs are read
+    vox = np.unique(projection.indices)
 
-    if sequence_roi_index[0] == background_val:
-        sequence_roi_index = sequence_roi_index[1:]
+    vox_ts = np.asarray(data_img[np.unravel_index(vox, data_img.shape[:3])],
+                        dtype=float)
 
-    # mean_masked_ts
-    mean_masked_ts = []
-    keep_rois = np.zeros(shape=(sequence_roi_index.shape[0]), dtype=bool)
+    sub_projection = projection[:, vox]
 
-    for i, roi_index in enumerate(sequence_roi_index):
+    weights = np.asarray(sub_projection.sum(axis=1)).ravel()
 
-        roi_x, roi_y, roi_z = np.where(data_indexed_mask == roi_index)
+    # testing if at least 50% of the voxels in the ROIs have values
+    # always higher than min bold intensity
+    signal_voxels = np.all(vox_ts > min_BOLD_intensity, axis=1)
 
-        all_voxel_roi_ts = data_img[roi_x, roi_y, roi_z, :]
-        nb_voxels, nb_volumes = all_voxel_roi_ts.shape
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percent_voxel_signal = sub_projection.dot(
+            signal_voxels.astype(float)) / weights
 
-        # testing if at least 50% of the voxels in the ROIs have values
-        # always higher than min bold intensity
-        nb_signal_voxels = np.sum(np.sum(
-            all_voxel_roi_ts > min_BOLD_intensity, axis=1) == nb_volumes)
+        nan_ts = np.isnan(vox_ts)
 
-        percent_voxel_signal = nb_signal_voxels/float(nb_voxels)
+        if np.any(nan_ts):
+            vox_ts[nan_ts] = 0.0
+            mean_masked_ts = sub_projection.dot(vox_ts) / \
+                sub_projection.dot((~nan_ts).astype(float))
 
-        if percent_voxel_signal > percent_signal:
-            keep_rois[i] = True
+        else:
+            mean_masked_ts = sub_projection.dot(vox_ts) / weights[:, None]
 
-            try:
-                mean_all_voxel_roi_ts = np.nanmean(all_voxel_roi_ts, axis=0)
+    keep_rois = percent_voxel_signal > percent_signal
 
-            except AttributeError:
-                print("Warning, no nanmean (version of numpy is too old),\
-                      using mean only")
-                mean_all_voxel_roi_ts = np.mean(all_voxel_roi_ts, axis=0)
+    if ROI_index is None:
+        ROI_index = np.arange(projection.shape[0])
 
-            mean_masked_ts.append(mean_all_voxel_roi_ts)
-        else:
-            print("ROI {} was not selected : {} {} ".format(
-                roi_index, nb_signal_voxels, round(percent_voxel_signal, 2)))
+    for roi_index, percent in zip(ROI_index[~keep_rois],
+                                  percent_voxel_signal[~keep_rois]):
+        print("ROI {} was not selected : {} ".format(
+            roi_index, np.round(percent, 2)))
 
-    assert len(mean_masked_ts) != 0, "min_BOLD_intensity {} and \
+    assert np.any(keep_rois), "min_BOLD_intensity {} and \
         percent_signal {} are to restrictive".format(min_BOLD_intensity,
                                                      percent_signal)
 
-    mean_masked_ts = np.array(mean_masked_ts, dtype='f')
+    mean_masked_ts = np.array(mean_masked_ts[keep_rois], dtype='f')
     return mean_masked_ts, keep_rois
 
 
+def mean_select_indexed_mask_data(data_img, data_indexed_mask,
+                                  min_BOLD_intensity=50, percent_signal=0.5,
+                                  background_val=-1.0):
+    """
+    extrating ts by averaging the time series of all voxels with the same
+    index
+    """
+    assert len(data_img.shape) == 4, \
+        ("Error, data_img should be a 4Dfile, shape is {}".format(
+            data_img.shape))
+
+    assert check_np_shapes(data_img.shape[:3], data_indexed_mask.shape), \
+        ("Error, Image and mask are incompatible {} {}".format(
+            data_img.shape[:3], data_indexed_mask.shape))
+
+    projection, ROI_index = build_ROI_projection(
+        data_indexed_mask, background_val=background_val)
+
+    return project_ROI_ts(projection, data_img, min_BOLD_intensity,
+                          percent_signal=percent_signal, ROI_index=ROI_index)
+
+
 def regress_parameters(data_matrix, covariates):
     """covariate regression"""
 
@@ -212,6 +344,43 @@ def where_in_labels(labels, corres_labels):
     return np.array(label_indexes, dtype='int64')
 
 
+def _scatter_corres_mat(mat, where_in_corres, corres_size, sym=True,
+                        corres_mat=None, possible_edge_mat=None):
+    """
+    scatter mat (in subject space) into corres_mat (in reference space) in one
+    block assignment
+
+    if sym, only the upper triangle of mat is used (and copied in the lower
+    triangle), and the diagonal is set to 0
+    corres_mat and possible_edge_mat can be given (e.g. slices of a
+    memory-mapped stack), they are supposed to be filled with zeros
+    """
+    if corres_mat is None:
+        corres_mat = np.zeros((corres_size, corres_size), dtype=float)
+
+    if possible_edge_mat is None:
+        possible_edge_mat = np.zeros((corres_size, corres_size), dtype=int)
+
+    block = np.ix_(where_in_corres, where_in_corres)
+
+    if sym:
+        corres_mat[block] = _sym_triu(mat)
+        possible_edge_mat[block] = 1 - np.eye(mat.shape[0], dtype=int)
+
+    else:
+        corres_mat[block] = mat
+        possible_edge_mat[block] = 1
+
+    return corres_mat, possible_edge_mat
+
+
+def _sym_triu(mats):
+    """symmetric matrices (or stack of) built from upper triangle only
+    (diagonal set to 0)"""
+    triu_mats = np.triu(mats, k=1)
+    return triu_mats + np.swapaxes(triu_mats, -1, -2)
+
+
 def return_corres_correl_mat(mat, coords, corres_coords):
     """computing corres matrix using reference (corres_coords) and coords"""
     assert mat.shape[0] == mat.shape[1], \
@@ -221,25 +390,16 @@ def return_corres_correl_mat(mat, coords, corres_coords):
 
     where_in_corres = where_in_coords(coords, corres_coords)
 
-    print(where_in_corres)
     corres_size = corres_coords.shape[0]
 
     print(np.min(where_in_corres), np.max(where_in_corres),
           where_in_corres.shape)
 
-    corres_mat = np.zeros((corres_size, corres_size), dtype=float)
-    possible_edge_mat = np.zeros((corres_size, corres_size), dtype=int)
+    corres_mat, possible_edge_mat = _scatter_corres_mat(
+        mat, where_in_corres, corres_size, sym=True)
 
     print(corres_mat.shape)
 
-    for i, j in it.combinations(range(coords.shape[0]), 2):
-
-        corres_mat[where_in_corres[i], where_in_corres[j]] = mat[i, j]
-        corres_mat[where_in_corres[j], where_in_corres[i]] = mat[i, j]
-
-        possible_edge_mat[where_in_corres[i], where_in_corres[j]] = 1
-        possible_edge_mat[where_in_corres[j], where_in_corres[i]] = 1
-
     return corres_mat, possible_edge_mat
 
 
@@ -256,13 +416,297 @@ def return_corres_correl_mat_labels(mat, labels, corres_labels):
     print(np.min(where_in_corres), np.max(where_in_corres),
           where_in_corres.shape)
 
-    corres_mat = np.zeros((corres_size, corres_size), dtype=float)
-    possible_edge_mat = np.zeros((corres_size, corres_size), dtype=int)
-
-    for i, j in it.product(range(len(labels)), repeat=2):
-        corres_mat[where_in_corres[i], where_in_corres[j]] = mat[i, j]
-        possible_edge_mat[where_in_corres[i], where_in_corres[j]] = 1
+    corres_mat, possible_edge_mat = _scatter_corres_mat(
+        mat, where_in_corres, corres_size, sym=False)
 
     print(corres_mat.shape)
 
     return corres_mat, possible_edge_mat
+
+
+def return_corres_correl_mat_stack(mats, corres_size, coords=None,
+                                   corres_coords=None, labels=None,
+                                   corres_labels=None, corres_mats=None,
+                                   possible_edge_mats=None):
+    """
+    batched version of return_corres_correl_mat(_labels):
+    map a stack of matrices (nb_mats, n, n) in the reference space
+
+    coords (resp. labels) are either shared by all matrices (one array,
+    resp. one list), or given as a list with one element per matrix.
+    The mapping indexes are computed only once for all matrices sharing the
+    same coords (resp. labels).
+
+    corres_mats / possible_edge_mats are the (nb_mats, corres_size,
+    corres_size) outputs, and can be preallocated (e.g. memory-mapped)
+
+    return corres_mats, possible_edge_mats
+    """
+    nb_mats = len(mats)
+
+    if corres_mats is None:
+        corres_mats = np.zeros((nb_mats, corres_size, corres_size),
+                               dtype=float)
+
+    if possible_edge_mats is None:
+        possible_edge_mats = np.zeros((nb_mats, corres_size, corres_size),
+                                      dtype=int)
+
+    if coords is not None:
+        assert corres_coords is not None, \
+            "Error, corres_coords should be given with coords"
+
+        sym = True
+        if isinstance(coords, np.ndarray) and coords.ndim == 2:
+            where_in_corres = where_in_coords(coords, corres_coords)
+            list_where_in_corres = [where_in_corres] * nb_mats
+
+        else:
+            assert len(coords) == nb_mats, \
+                ("Error, {} coords for {} matrices".format(
+                    len(coords), nb_mats))
+            list_where_in_corres = [where_in_coords(np.asarray(coord),
+                                                    corres_coords)
+                                    for coord in coords]
+
+    elif labels is not None:
+        assert corres_labels is not None, \
+            "Error, corres_labels should be given with labels"
+
+        sym = False
+        if len(labels) and not isinstance(labels[0], (list, tuple,
+                                                      np.ndarray)):
+            where_in_corres = where_in_labels(list(labels),
+                                              list(corres_labels))
+            list_where_in_corres = [where_in_corres] * nb_mats
+
+        else:
+            assert len(labels) == nb_mats, \
+                ("Error, {} labels for {} matrices".format(
+                    len(labels), nb_mats))
+            list_where_in_corres = [where_in_labels(list(label),
+                                                    list(corres_labels))
+                                    for label in labels]
+    else:
+        raise ValueError("Error, either coords or labels should be given")
+
+    # all matrices share the same mapping: one single scatter
+    if all(where_in_corres is list_where_in_corres[0]
+           for where_in_corres in list_where_in_corres):
+
+        where_in_corres = list_where_in_corres[0]
+        mats = np.asarray(mats)
+
+        assert mats.shape[1:] == (where_in_corres.shape[0],) * 2, \
+            ("Error, matrices {} and mapping {} are incompatible".format(
+                mats.shape, where_in_corres.shape))
+
+        block = np.ix_(np.arange(nb_mats), where_in_corres, where_in_corres)
+
+        if sym:
+            corres_mats[block] = _sym_triu(mats)
+            possible_edge_mats[block] = 1 - np.eye(where_in_corres.shape[0],
+                                                   dtype=int)
+        else:
+            corres_mats[block] = mats
+            possible_edge_mats[block] = 1
+
+        return corres_mats, possible_edge_mats
+
+    for i, (mat, where_in_corres) in enumerate(zip(mats,
+                                                   list_where_in_corres)):
+
+        assert mat.shape == (where_in_corres.shape[0],) * 2, \
+            ("Error, matrix {} and mapping {} are incompatible".format(
+                mat.shape, where_in_corres.shape))
+
+        _scatter_corres_mat(mat, where_in_corres, corres_size, sym=sym,
+                            corres_mat=corres_mats[i],
+                            possible_edge_mat=possible_edge_mats[i])
+
+    return corres_mats, possible_edge_mats
+
+
+def stream_group_cormats(iter_cormats, nb_mats, mat_size,
+                         group_cormat_file=None, subject_major=True):
+    """
+    Streaming aggregation of (corres) correlation matrices of a group
+
+    iter_cormats yields (index, cormat, possible_edge_mat) for each matrix
+    (index being the position of the matrix in the group, possible_edge_mat
+    can be None if all edges are defined)
+
+    Each matrix is written as soon as it is received in group_cormat,
+    memory-mapped on group_cormat_file if given (in .npy format), with shape
+    (nb_mats, mat_size, mat_size) if subject_major (contiguous writes),
+    (mat_size, mat_size, nb_mats) otherwise.
+
+    Sum, number of possible edges, mean and sum of squared differences to the
+    mean (Welford's algorithm) are updated on the fly, only where edges are
+    defined (and not NaN), count_mat being the number of values of each edge
+
+    return group_cormat, sum_cormat, count_mat, mean_cormat, var_cormat
+    (var_cormat is the unbiased variance, 0 where less than 2 values)
+    """
+    if subject_major:
+        group_shape = (nb_mats, mat_size, mat_size)
+    else:
+        group_shape = (mat_size, mat_size, nb_mats)
+
+    if group_cormat_file is None:
+        group_cormat = np.zeros(group_shape, dtype=float)
+
+    else:
+        group_cormat = np.lib.format.open_memmap(
+            group_cormat_file, mode='w+', dtype=float, shape=group_shape)
+
+    sum_cormat = np.zeros((mat_size, mat_size), dtype=float)
+    count_mat = np.zeros((mat_size, mat_size), dtype=int)
+    mean_cormat = np.zeros((mat_size, mat_size), dtype=float)
+    M2_cormat = np.zeros((mat_size, mat_size), dtype=float)
+
+    for index, cormat, possible_edge_mat in iter_cormats:
+
+        assert cormat.shape == (mat_size, mat_size), \
+            ("Error, matrix {} should have shape {}".format(
+                cormat.shape, (mat_size, mat_size)))
+
+        if subject_major:
+            group_cormat[index] = cormat
+        else:
+            group_cormat[:, :, index] = cormat
+
+        # edges are updated only where defined and not NaN
+        valid_edges = ~np.isnan(cormat)
+
+        if possible_edge_mat is not None:
+            valid_edges &= np.asarray(possible_edge_mat) != 0
+
+        sum_cormat[valid_edges] += cormat[valid_edges]
+        count_mat += valid_edges
+
+        delta = np.where(valid_edges, cormat - mean_cormat, 0.0)
+        mean_cormat += delta / np.maximum(count_mat, 1)
+        M2_cormat += np.where(valid_edges, delta * (cormat - mean_cormat),
+                              0.0)
+
+    if group_cormat_file is not None:
+        group_cormat.flush()
+
+    var_cormat = np.zeros((mat_size, mat_size), dtype=float)
+    enough_val = count_mat > 1
+    var_cormat[enough_val] = M2_cormat[enough_val] / \
+        (count_mat[enough_val] - 1)
+
+    return group_cormat, sum_cormat, count_mat, mean_cormat, var_cormat
+
+
+def permut_group_mean_cormats(stack_edges, group_sizes, nb_permuts=1, seed=0,
+                              subj_indexes=None, permut_mean_file=None,
+                              chunk_size=100000):
+    """
+    Group means of a stack of (condensed) matrices for many permutations of
+    the subjects at once
+
+    stack_edges: (nb_subj, nb_edges) array (possibly memory-mapped)
+    group_sizes: how to split the groups after shuffling (sum = nb_subj)
+    subj_indexes: (nb_permuts, nb_subj) shuffled subject indexes; if None,
+    each permutation uses its own random stream (SeedSequence(seed).spawn)
+
+    Means are computed as the product of the (nb_permuts * nb_groups,
+    nb_subj) indicator matrix (1/group size for subjects of the group) with
+    the stack, by chunks of chunk_size edges
+
+    return permut_means (nb_permuts, nb_groups, nb_edges), memory-mapped on
+    permut_mean_file if given (in .npy format), and subj_indexes
+    """
+    nb_subj, nb_edges = stack_edges.shape
+
+    group_sizes = np.array(group_sizes, dtype=int)
+
+    assert group_sizes.sum() == nb_subj, \
+        ("Error, {} matrices != sum of group sizes {}".format(
+            nb_subj, group_sizes.sum()))
+
+    if subj_indexes is None:
+        subj_indexes = np.array([
+            np.random.default_rng(seed_seq).permutation(nb_subj)
+            for seed_seq in np.random.SeedSequence(seed).spawn(nb_permuts)])
+
+    subj_indexes = np.asarray(subj_indexes, dtype=int)
+    nb_permuts = subj_indexes.shape[0]
+    nb_groups = len(group_sizes)
+
+    # indicator matrix, position in shuffled order -> group
+    group_of_pos = np.repeat(np.arange(nb_groups), group_sizes)
+
+    indic = np.zeros((nb_permuts, nb_groups, nb_subj), dtype=float)
+    indic[np.arange(nb_permuts)[:, np.newaxis], group_of_pos[np.newaxis, :],
+          subj_indexes] = 1.0 / group_sizes[group_of_pos]
+
+    permut_means = _indicator_group_means(stack_edges, indic,
+                                          permut_mean_file, chunk_size)
+
+    return permut_means, subj_indexes
+
+
+def _indicator_group_means(stack_edges, indic, permut_mean_file=None,
+                           chunk_size=100000):
+    """
+    private function, product of indicator matrices
+    (nb_permuts, nb_groups, nb_subj) with the stack (nb_subj, nb_edges), by
+    chunks of edges, possibly memory-mapped on permut_mean_file
+    """
+    nb_permuts, nb_groups, nb_subj = indic.shape
+    nb_edges = stack_edges.shape[1]
+
+    indic = indic.reshape(nb_permuts * nb_groups, nb_subj)
+
+    if permut_mean_file is None:
+        permut_means = np.zeros((nb_permuts, nb_groups, nb_edges),
+                                dtype=float)
+    else:
+        permut_means = np.lib.format.open_memmap(
+            permut_mean_file, mode='w+', dtype=float,
+            shape=(nb_permuts, nb_groups, nb_edges))
+
+    for start in range(0, nb_edges, chunk_size):
+        stop = min(start + chunk_size, nb_edges)
+
+        permut_means[:, :, start:stop] = np.dot(
+            indic, stack_edges[:, start:stop]).reshape(
+                nb_permuts, nb_groups, stop - start)
+
+    if permut_mean_file is not None:
+        permut_means.flush()
+
+    return permut_means
+
+
+def label_group_mean_cormats(stack_edges, pooled_labels, nb_groups,
+                             permut_mean_file=None, chunk_size=100000):
+    """
+    Group means of a stack of (condensed) matrices for many label
+    assignments at once (e.g. from a permutation plan)
+
+    stack_edges: (nb_subj, nb_edges) array (possibly memory-mapped)
+    pooled_labels: (nb_permuts, nb_subj) group label of each subject
+
+    return permut_means (nb_permuts, nb_groups, nb_edges), NaN for empty
+    groups
+    """
+    pooled_labels = np.asarray(pooled_labels, dtype=int)
+    nb_permuts, nb_subj = pooled_labels.shape
+
+    assert stack_edges.shape[0] == nb_subj, \
+        ("Error, {} matrices != {} labels".format(
+            stack_edges.shape[0], nb_subj))
+
+    indic = (pooled_labels[:, np.newaxis, :] ==
+             np.arange(nb_groups)[np.newaxis, :, np.newaxis]).astype(float)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        indic /= indic.sum(axis=2, keepdims=True)
+
+    return _indicator_group_means(stack_edges, indic, permut_mean_file,
+                                  chunk_size)
@@ -0,0 +1,103 @@
+"""
+Network-based statistic (NBS, Zalesky et al., 2010)
+
+Edge statistics are thresholded, connected components of the
+supra-threshold graph are labelled (sparse connected components) and
+tested against the null distribution of the largest component, computed
+by compute_permut_fwe (utils_stats)
+"""
+import numpy as np
+
+from graphpype.utils_stats import (_return_edge_indexes, _fwe_p_values,
+                                   edge_components, compute_comp_measures,
+                                   compute_permut_fwe)
+
+
+def threshold_edge_stats(stat_edges, threshold, tail="both"):
+    """
+    supra-threshold edges, and their values above threshold (0 otherwise)
+
+    tail = "both" (|stat| > threshold), "upper" (stat > threshold) or
+    "lower" (stat < - threshold)
+    """
+    if tail == "both":
+        signed_stats = np.abs(stat_edges)
+    elif tail == "upper":
+        signed_stats = stat_edges
+    elif tail == "lower":
+        signed_stats = - stat_edges
+    else:
+        raise ValueError("Unknown tail {} (should be both, upper or \
+            lower)".format(tail))
+
+    # NaN (not enough values) are never supra-threshold
+    supra_edges = np.nan_to_num(signed_stats, nan=-np.inf) > threshold
+
+    excess_vals = np.where(supra_edges, signed_stats - threshold, 0.0)
+
+    return supra_edges, excess_vals
+
+
+def compute_nbs(X, design=None, test="ttest_ind", threshold=3.0,
+                nb_permuts=1000, measure="extent", tail="both",
+                batch_size=50, seed=None, n_jobs=1, old_order=False,
+                keep_intracon=False):
+    """
+    Network-based statistic over stacked matrices
+
+    X: stack of matrices (sample_size, n_nodes, n_nodes) in new order
+    design: group of each sample (ttest_ind, f_oneway); not used for
+    ttest_1samp (sign flipping, use X - Y for paired samples)
+
+    Returns:
+    - p-value of each component (sorted by decreasing measure)
+    - boolean edge mask (nb_comps, n_nodes, n_nodes) of each component
+    - matrix of the edge statistic
+    - null distribution of the max component measure
+    """
+    if test == "f_oneway":
+        assert tail == "upper", "Error, F-test is only upper tailed"
+
+    if tail not in ("both", "upper", "lower"):
+        raise ValueError("Unknown tail {} (should be both, upper or \
+            lower)".format(tail))
+
+    # lower tail: t statistics of - X are the opposite of those of X
+    sign = -1.0 if tail == "lower" else 1.0
+
+    stat_mat, _, _, null_dists = compute_permut_fwe(
+        sign * X, design=design, test=test, nb_permuts=nb_permuts,
+        cluster_threshold=threshold, batch_size=batch_size, seed=seed,
+        n_jobs=n_jobs, two_sided=(tail == "both"), old_order=old_order,
+        keep_intracon=keep_intracon, measure=measure)
+
+    stat_mat = sign * stat_mat
+    null_dist = null_dists["max_comp_size"]
+
+    # observed components
+    N = stat_mat.shape[0]
+
+    s_i, s_j = _return_edge_indexes(N, keep_intracon)
+
+    supra_edges, excess_vals = threshold_edge_stats(stat_mat[s_i, s_j],
+                                                    threshold, tail)
+
+    edge_comps, comp_sizes = edge_components(supra_edges, s_i, s_j, N)
+
+    comp_measures = compute_comp_measures(edge_comps, excess_vals,
+                                          len(comp_sizes), measure)
+
+    # keeping components with edges, by decreasing measure
+    comp_order = np.argsort(-comp_measures, kind='mergesort')
+    comp_order = comp_order[comp_sizes[comp_order] > 0]
+
+    p_comps = _fwe_p_values(comp_measures[comp_order], null_dist)
+
+    comp_masks = np.zeros((len(comp_order), N, N), dtype=bool)
+
+    for k, comp in enumerate(comp_order):
+        in_comp = edge_comps == comp
+        comp_masks[k, s_i[in_comp], s_j[in_comp]] = True
+        comp_masks[k, s_j[in_comp], s_i[in_comp]] = True
+
+    return p_comps, comp_masks, stat_mat, null_dist
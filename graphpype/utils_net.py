@@ -126,3 +126,301 @@ def export_Louvain_net_from_list(Z_Louvain_file, Z_list, coords):
         f.write('1 1\n')
         f.write('>\n')
         np.savetxt(f, tab_edges, fmt='%d %d %d %d')
+
+
+# null models (randomisation of graphs)
+
+
+def _edge_keys(edge_i, edge_j, nb_nodes):
+    """unique int64 key of undirected edges (min * nb_nodes + max)"""
+    edge_i = np.asarray(edge_i, dtype='int64')
+    edge_j = np.asarray(edge_j, dtype='int64')
+
+    return np.minimum(edge_i, edge_j) * nb_nodes + np.maximum(edge_i, edge_j)
+
+
+def rewire_edges(edge_i, edge_j, nb_nodes, nb_swaps_per_edge=10, rng=None,
+                 max_rounds=None):
+    """
+    Degree preserving randomisation of an undirected graph
+    (Maslov-Sneppen edge swaps), edges being given as integer arrays
+
+    At each round, edges are randomly paired, and each pair (a, b) (c, d)
+    is swapped to (a, d) (c, b) or (a, c) (b, d); swaps creating
+    self-loops or multi-edges (checked on a set of hashed edges) are
+    rejected. Rounds are repeated until nb_swaps_per_edge * nb_edges / 2
+    swaps have been accepted (i.e. each edge was swapped nb_swaps_per_edge
+    times on average), or max_rounds is reached
+
+    Returns the new edge_i, edge_j (edge_i < edge_j; the order of edges
+    is kept, so edge attributes e.g. weights stay with their edge) and the
+    number of accepted swaps
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+
+    edge_i = np.array(edge_i, dtype='int64')
+    edge_j = np.array(edge_j, dtype='int64')
+
+    nb_edges = len(edge_i)
+    half = nb_edges // 2
+
+    keys = _edge_keys(edge_i, edge_j, nb_nodes)
+
+    assert len(np.unique(keys)) == nb_edges and \
+        not np.any(edge_i == edge_j), \
+        "Error, graph should not have multi-edges or self-loops"
+
+    nb_target = nb_swaps_per_edge * nb_edges // 2
+
+    if nb_edges == nb_nodes * (nb_nodes - 1) // 2:
+        print("Warning, complete graph, no swap is possible")
+        nb_target = 0
+
+    if max_rounds is None:
+        max_rounds = 100 * max(nb_swaps_per_edge, 1)
+
+    nb_swaps = 0
+    nb_rounds = 0
+
+    while nb_swaps < nb_target and nb_rounds < max_rounds and half > 0:
+
+        nb_rounds += 1
+
+        perm = rng.permutation(nb_edges)
+        a = perm[:half]
+        b = perm[half:2*half]
+
+        u1, v1 = edge_i[a], edge_j[a]
+        u2, v2 = edge_i[b], edge_j[b]
+
+        flip = rng.random(half) < 0.5
+
+        new_a_j = np.where(flip, u2, v2)
+        new_b_i = np.where(flip, v1, u2)
+        new_b_j = np.where(flip, v2, v1)
+
+        key_a = _edge_keys(u1, new_a_j, nb_nodes)
+        key_b = _edge_keys(new_b_i, new_b_j, nb_nodes)
+
+        # no self-loop, no existing edge, no double edge in the pair
+        ok = (u1 != new_a_j) & (new_b_i != new_b_j) & (key_a != key_b) & \
+            ~np.isin(key_a, keys) & ~np.isin(key_b, keys)
+
+        # no same new edge proposed by two different pairs
+        ok_index = np.where(ok)[0]
+
+        _, inverse, counts = np.unique(
+            np.concatenate((key_a[ok_index], key_b[ok_index])),
+            return_inverse=True, return_counts=True)
+
+        dup = (counts[inverse] > 1).reshape(2, -1).any(axis=0)
+        ok[ok_index[dup]] = False
+
+        # accepted swaps
+        ok_index = np.where(ok)[0][:nb_target - nb_swaps]
+
+        edge_j[a[ok_index]] = new_a_j[ok_index]
+        edge_i[b[ok_index]] = new_b_i[ok_index]
+        edge_j[b[ok_index]] = new_b_j[ok_index]
+
+        keys[a[ok_index]] = key_a[ok_index]
+        keys[b[ok_index]] = key_b[ok_index]
+
+        nb_swaps += len(ok_index)
+
+    if nb_swaps < nb_target:
+        print("Warning, only {} swaps out of {} after {} rounds".format(
+            nb_swaps, nb_target, nb_rounds))
+
+    return np.minimum(edge_i, edge_j), np.maximum(edge_i, edge_j), nb_swaps
+
+
+def rank_match_weights(edge_i, edge_j, weights, strengths):
+    """
+    Weight-rank preserving assignment: original weights are reassigned to
+    the (rewired) edges following the rank of the product of node strengths
+    (approximately preserving node strengths)
+    """
+    weights = np.asarray(weights)
+
+    expected = strengths[edge_i] * strengths[edge_j]
+
+    new_weights = np.empty_like(weights)
+    new_weights[np.argsort(expected, kind='mergesort')] = np.sort(weights)
+
+    return new_weights
+
+
+def shuffle_sym_mat(mat, rng=None):
+    """
+    random permutation of the values of the upper triangle of a symmetric
+    matrix (diagonal is set to 0)
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+
+    triu_i, triu_j = np.triu_indices(mat.shape[0], k=1)
+
+    shuffled_values = rng.permutation(mat[triu_i, triu_j])
+
+    shuffled_mat = np.zeros(mat.shape, dtype=mat.dtype)
+    shuffled_mat[triu_i, triu_j] = shuffled_values
+    shuffled_mat[triu_j, triu_i] = shuffled_values
+
+    return shuffled_mat
+
+
+def rewire_sym_mat(mat, rng=None, nb_swaps_per_edge=10, weight_mode="keep"):
+    """
+    degree preserving randomisation of the (non-zero) edges of a symmetric
+    matrix (diagonal is set to 0)
+
+    weight_mode = "keep": weights stay with their (rewired) edge
+    weight_mode = "rank": weights are reassigned by rank of the product of
+    the original node strengths (see rank_match_weights)
+    """
+    nb_nodes = mat.shape[0]
+
+    edge_i, edge_j = np.where(np.triu(mat, k=1) != 0)
+    weights = mat[edge_i, edge_j]
+
+    new_i, new_j, nb_swaps = rewire_edges(
+        edge_i, edge_j, nb_nodes, nb_swaps_per_edge=nb_swaps_per_edge,
+        rng=rng)
+
+    if weight_mode == "rank":
+        strengths = np.bincount(
+            np.concatenate((edge_i, edge_j)),
+            weights=np.concatenate((weights, weights)), minlength=nb_nodes)
+
+        weights = rank_match_weights(new_i, new_j, weights, strengths)
+
+    elif weight_mode != "keep":
+        raise ValueError("Unknown weight_mode {} (should be keep or \
+            rank)".format(weight_mode))
+
+    rewired_mat = np.zeros(mat.shape, dtype=mat.dtype)
+    rewired_mat[new_i, new_j] = weights
+    rewired_mat[new_j, new_i] = weights
+
+    return rewired_mat
+
+
+def return_null_model_mats(mat, seeds, null_model="values",
+                           nb_swaps_per_edge=10):
+    """
+    randomised versions of a symmetric matrix, one per seed (each with
+    its own numpy Generator); seed = -1 keeps the original matrix
+
+    null_model = "values" (shuffle_sym_mat), "edge_swap" (rewire_sym_mat,
+    weights kept with edges) or "edge_swap_rank" (rewire_sym_mat, weights
+    reassigned by rank)
+
+    Returns a (nb_seeds, nb_nodes, nb_nodes) array
+    """
+    null_mats = np.zeros((len(seeds),) + mat.shape, dtype=mat.dtype)
+
+    for k, seed in enumerate(seeds):
+
+        if seed == -1:
+            null_mats[k] = mat
+            continue
+
+        rng = np.random.default_rng(seed)
+
+        if null_model == "values":
+            null_mats[k] = shuffle_sym_mat(mat, rng)
+
+        elif null_model == "edge_swap":
+            null_mats[k] = rewire_sym_mat(
+                mat, rng, nb_swaps_per_edge=nb_swaps_per_edge)
+
+        elif null_model == "edge_swap_rank":
+            null_mats[k] = rewire_sym_mat(
+                mat, rng, nb_swaps_per_edge=nb_swaps_per_edge,
+                weight_mode="rank")
+
+        else:
+            raise ValueError("Unknown null_model {}".format(null_model))
+
+    return null_mats
+
+
+def rewire_net_list(net_list, rng=None, nb_swaps_per_edge=10,
+                    weight_mode="keep"):
+    """
+    degree preserving randomisation of a net list (i j weight, 1-based
+    indexes, as in return_net_list)
+
+    Each undirected edge is rewired once (see rewire_edges), even if the
+    net list contains both directions (i j and j i), in which case both
+    directions are written in the returned list. Self-loops are kept as is
+
+    weight_mode = "keep": weights stay with their (rewired) edge
+    weight_mode = "rank": weights are reassigned by rank of the product of
+    the original node strengths (see rank_match_weights)
+    """
+    net_list = np.asarray(net_list, dtype='int64')
+
+    nb_nodes = int(net_list[:, :2].max())
+
+    node_i = net_list[:, 0] - 1
+    node_j = net_list[:, 1] - 1
+
+    self_loops = node_i == node_j
+
+    # undirected edges (unique hashed keys)
+    keys = _edge_keys(node_i[~self_loops], node_j[~self_loops], nb_nodes)
+    uniq_keys, uniq_index = np.unique(keys, return_index=True)
+
+    both_dirs = len(uniq_keys) < len(keys)
+
+    edge_i = uniq_keys // nb_nodes
+    edge_j = uniq_keys % nb_nodes
+    weights = net_list[~self_loops, 2][uniq_index]
+
+    new_i, new_j, nb_swaps = rewire_edges(
+        edge_i, edge_j, nb_nodes, nb_swaps_per_edge=nb_swaps_per_edge,
+        rng=rng)
+
+    if weight_mode == "rank":
+        strengths = np.bincount(
+            np.concatenate((edge_i, edge_j)),
+            weights=np.concatenate((weights, weights)), minlength=nb_nodes)
+
+        weights = rank_match_weights(new_i, new_j, weights, strengths)
+
+    elif weight_mode != "keep":
+        raise ValueError("Unknown weight_mode {} (should be keep or \
+            rank)".format(weight_mode))
+
+    new_net_list = [np.column_stack((new_i + 1, new_j + 1, weights))]
+
+    if both_dirs:
+        new_net_list.append(np.column_stack((new_j + 1, new_i + 1, weights)))
+
+    new_net_list.append(net_list[self_loops])
+
+    return np.concatenate(new_net_list, axis=0).astype('int64')
+
+
+def return_null_net_lists(net_list, seeds, nb_swaps_per_edge=10,
+                          weight_mode="keep"):
+    """
+    randomised versions of a net list, one per seed (each with its own
+    numpy Generator); seed = -1 keeps the original net list
+    """
+    null_net_lists = []
+
+    for seed in seeds:
+
+        if seed == -1:
+            null_net_lists.append(np.asarray(net_list, dtype='int64'))
+            continue
+
+        null_net_lists.append(rewire_net_list(
+            net_list, rng=np.random.default_rng(seed),
+            nb_swaps_per_edge=nb_swaps_per_edge, weight_mode=weight_mode))
+
+    return null_net_lists
@@ -1,6 +1,11 @@
 import scipy.stats as stat
+import scipy.sparse as sp
 import numpy as np
-import itertools as it
+
+from concurrent.futures import ThreadPoolExecutor
+from scipy.sparse.csgraph import connected_components
+
+from graphpype.utils_condensed import triu_indices
 """
 Functions for computing statistics over symetrical matrices (pairwise)
 
@@ -101,6 +106,512 @@ def _return_signif_code_Z(Z_values, uncor_alpha=0.001, fdr_alpha=0.05,
     return signif_code
 
 
+def _return_edge_indexes(N, keep_intracon=False):
+    """private function returning (i, j) indexes of the tested edges"""
+    if keep_intracon:
+        return triu_indices(N, k=0)
+    return triu_indices(N, k=1)
+
+
+def _nan_mean_var(X_edges):
+    """private function, NaN-aware number of values, mean and (unbiased)
+    variance along the first axis (samples)"""
+    valid = ~np.isnan(X_edges)
+    nb_vals = valid.sum(axis=0)
+
+    X_zeros = np.where(valid, X_edges, 0.0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_vals = X_zeros.sum(axis=0) / nb_vals
+        dev = np.where(valid, X_edges - mean_vals, 0.0)
+        var_vals = (dev ** 2).sum(axis=0) / (nb_vals - 1)
+
+    return nb_vals, mean_vals, var_vals
+
+
+def group_edge_moments(stack, group_labels, nb_groups=None,
+                       chunk_size=100000):
+    """
+    NaN-aware number of values, mean and (unbiased) variance of each group
+    of samples, for all edges at once (one product with the group indicator
+    matrix per chunk of edges, without copying the group sub-stacks)
+
+    stack: (nb_samples, ...) array (e.g. (nb_samples, N, N) matrices),
+    possibly memory-mapped
+    group_labels: group index of each sample (-1 if in no group)
+
+    Returns nb_vals, mean_vals, var_vals, with shape (nb_groups, ...)
+    """
+    group_labels = np.asarray(group_labels, dtype=int)
+    nb_samples = stack.shape[0]
+
+    assert group_labels.shape == (nb_samples,), \
+        ("Error, {} labels for {} samples".format(len(group_labels),
+                                                  nb_samples))
+
+    if nb_groups is None:
+        nb_groups = group_labels.max() + 1
+
+    indic = (group_labels[np.newaxis, :] ==
+             np.arange(nb_groups)[:, np.newaxis]).astype(float)
+
+    stack_2d = stack.reshape(nb_samples, -1)
+    nb_edges = stack_2d.shape[1]
+
+    nb_vals = np.zeros((nb_groups, nb_edges), dtype=int)
+    mean_vals = np.zeros((nb_groups, nb_edges), dtype=float)
+    var_vals = np.zeros((nb_groups, nb_edges), dtype=float)
+
+    for start in range(0, nb_edges, chunk_size):
+        stop = min(start + chunk_size, nb_edges)
+
+        X = np.asarray(stack_2d[:, start:stop], dtype=float)
+        valid = ~np.isnan(X)
+
+        # values are centered on the mean over all samples (numerical
+        # stability of the sum of squares)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            shift = np.where(valid, X, 0.0).sum(axis=0) / valid.sum(axis=0)
+        shift[np.isnan(shift)] = 0.0
+
+        X_zeros = np.where(valid, X - shift, 0.0)
+
+        count = np.dot(indic, valid.astype(float))
+        sum_vals = np.dot(indic, X_zeros)
+        sum_sq = np.dot(indic, X_zeros ** 2)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_chunk = sum_vals / count
+            var_chunk = np.maximum(sum_sq - sum_vals * mean_chunk, 0.0) / \
+                (count - 1)
+
+        nb_vals[:, start:stop] = count
+        mean_vals[:, start:stop] = mean_chunk + shift
+        var_vals[:, start:stop] = var_chunk
+
+    out_shape = (nb_groups,) + stack.shape[1:]
+
+    return (nb_vals.reshape(out_shape), mean_vals.reshape(out_shape),
+            var_vals.reshape(out_shape))
+
+
+def paired_edge_moments(stack, index_X, index_Y, chunk_size=100000):
+    """
+    NaN-aware number of values, mean and (unbiased) variance of the paired
+    differences stack[index_X] - stack[index_Y], by chunks of edges
+
+    Returns nb_vals, mean_vals, var_vals, with shape stack.shape[1:]
+    """
+    assert len(index_X) == len(index_Y), ("Error, X and Y are paired but \
+        do not have the same number of samples {} {}".format(len(index_X),
+                                                             len(index_Y)))
+
+    nb_samples = stack.shape[0]
+    stack_2d = stack.reshape(nb_samples, -1)
+    nb_edges = stack_2d.shape[1]
+
+    moments = [np.zeros(nb_edges, dtype=dtype)
+               for dtype in [int, float, float]]
+
+    for start in range(0, nb_edges, chunk_size):
+        stop = min(start + chunk_size, nb_edges)
+
+        diff = np.asarray(stack_2d[index_X, start:stop], dtype=float) - \
+            np.asarray(stack_2d[index_Y, start:stop], dtype=float)
+
+        for moment, chunk_moment in zip(moments, _nan_mean_var(diff)):
+            moment[start:stop] = chunk_moment
+
+    return tuple(moment.reshape(stack.shape[1:]) for moment in moments)
+
+
+def _t_p_values(t_stat, df):
+    """private function, two-sided p-values from t statistics"""
+    with np.errstate(invalid='ignore'):
+        return 2 * stat.t.sf(np.abs(t_stat), df)
+
+
+def edge_ttest_ind(X_edges, Y_edges):
+    """
+    Vectorized (NaN-aware) two-sample t-test, equal variances
+    (same as stat.ttest_ind applied to each column)
+
+    X_edges, Y_edges: (nb_samples, nb_edges) arrays
+
+    Returns t_stat, p_val, sign of the difference (X - Y) and the number of
+    valid (non NaN) values in X and Y for each edge
+    """
+    nX, mX, vX = _nan_mean_var(X_edges)
+    nY, mY, vY = _nan_mean_var(Y_edges)
+
+    t_stat, p_val, sign_diff = edge_ttest_ind_from_moments(nX, mX, vX,
+                                                           nY, mY, vY)
+
+    return t_stat, p_val, sign_diff, nX, nY
+
+
+def edge_ttest_ind_from_moments(nX, mX, vX, nY, mY, vY):
+    """
+    two-sample t-test (equal variances) from the number of values, mean and
+    unbiased variance of each sample (e.g. from group_edge_moments)
+
+    Returns t_stat, p_val and sign of the difference (X - Y)
+    """
+    df = nX + nY - 2
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pooled_var = ((nX - 1) * vX + (nY - 1) * vY) / df
+        t_stat = (mX - mY) / np.sqrt(pooled_var * (1.0 / nX + 1.0 / nY))
+
+    return t_stat, _t_p_values(t_stat, df), np.sign(mX - mY)
+
+
+def edge_ttest_1samp(X_edges, popmean=0.0):
+    """
+    Vectorized (NaN-aware) one-sample t-test
+    (same as stat.ttest_1samp applied to each column)
+
+    X_edges: (nb_samples, nb_edges) array
+
+    Returns t_stat, p_val, sign of (mean - popmean) and the number of valid
+    (non NaN) values for each edge
+    """
+    nX, mX, vX = _nan_mean_var(X_edges)
+
+    t_stat, p_val, sign_diff = edge_ttest_1samp_from_moments(nX, mX, vX,
+                                                             popmean)
+
+    return t_stat, p_val, sign_diff, nX
+
+
+def edge_ttest_1samp_from_moments(nX, mX, vX, popmean=0.0):
+    """
+    one-sample t-test from the number of values, mean and unbiased
+    variance of the sample
+
+    Returns t_stat, p_val and sign of (mean - popmean)
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t_stat = (mX - popmean) / np.sqrt(vX / nX)
+
+    return t_stat, _t_p_values(t_stat, nX - 1), np.sign(mX - popmean)
+
+
+def edge_ttest_rel(X_edges, Y_edges):
+    """
+    Vectorized (NaN-aware) paired t-test
+    (same as stat.ttest_rel applied to each column); samples with a NaN in
+    X or Y are removed pairwise
+
+    X_edges, Y_edges: (nb_samples, nb_edges) arrays
+
+    Returns t_stat, p_val, sign of the difference (X - Y) and the number of
+    valid pairs for each edge
+    """
+    assert X_edges.shape == Y_edges.shape, ("Error, X {} and Y {} should \
+        have the same shape for paired test".format(X_edges.shape,
+                                                    Y_edges.shape))
+
+    return edge_ttest_1samp(X_edges - Y_edges, popmean=0.0)
+
+
+def edge_pearsonr(X_edges, reg_interest):
+    """
+    Vectorized (NaN-aware) Pearson correlation of each column with a
+    regressor (same as stat.pearsonr applied to each column)
+
+    X_edges: (nb_samples, nb_edges) array
+    reg_interest: (nb_samples,) vector
+
+    Returns r_stat, p_val and the number of valid values for each edge
+    """
+    reg_interest = np.asarray(reg_interest, dtype='float')
+
+    assert X_edges.shape[0] == reg_interest.shape[0], ("Incompatible \
+        number of samples {} and regressor length {}".format(
+            X_edges.shape[0], reg_interest.shape[0]))
+
+    valid = ~np.isnan(X_edges) & ~np.isnan(reg_interest)[:, np.newaxis]
+    nb_vals = valid.sum(axis=0)
+
+    X_zeros = np.where(valid, X_edges, 0.0)
+    reg_zeros = np.where(valid, reg_interest[:, np.newaxis], 0.0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        X_dev = np.where(valid, X_zeros - X_zeros.sum(axis=0) / nb_vals, 0.0)
+        reg_dev = np.where(valid,
+                           reg_zeros - reg_zeros.sum(axis=0) / nb_vals, 0.0)
+
+        r_stat = (X_dev * reg_dev).sum(axis=0) / np.sqrt(
+            (X_dev ** 2).sum(axis=0) * (reg_dev ** 2).sum(axis=0))
+        r_stat = np.clip(r_stat, -1.0, 1.0)
+
+        df = nb_vals - 2
+        t_stat = r_stat * np.sqrt(df / (1.0 - r_stat ** 2))
+
+    p_val = _t_p_values(t_stat, df)
+
+    # same as stat.pearsonr for 2 values
+    p_val[nb_vals == 2] = 1.0
+
+    return r_stat, p_val, nb_vals
+
+
+def edge_f_oneway(list_X_edges):
+    """
+    Vectorized (NaN-aware) one-way ANOVA (same as stat.f_oneway applied to
+    each column), between and within sums of squares are computed per edge
+
+    list_X_edges: list of (nb_samples_group, nb_edges) arrays, one per group
+
+    Returns F_stat, p_val and the number of valid values
+    (nb_groups, nb_edges) for each group and each edge
+    """
+    assert len(list_X_edges) > 1, "Error, at least 2 groups are needed"
+
+    nb_vals, mean_vals, var_vals = zip(
+        *[_nan_mean_var(X_edges) for X_edges in list_X_edges])
+
+    nb_vals = np.array(nb_vals)
+
+    F_stat, p_val = edge_f_oneway_from_moments(nb_vals, np.array(mean_vals),
+                                               np.array(var_vals))
+
+    return F_stat, p_val, nb_vals
+
+
+def edge_f_oneway_from_moments(nb_vals, mean_vals, var_vals):
+    """
+    one-way ANOVA from the number of values, mean and unbiased variance of
+    each group, (nb_groups, nb_edges) arrays (e.g. from group_edge_moments)
+
+    Returns F_stat and p_val
+    """
+    nb_tot = nb_vals.sum(axis=0)
+    nb_groups = (nb_vals > 0).sum(axis=0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_zeros = np.where(nb_vals > 0, mean_vals, 0.0)
+        grand_mean = (nb_vals * mean_zeros).sum(axis=0) / nb_tot
+
+        ss_between = (nb_vals * (mean_zeros - grand_mean) ** 2).sum(axis=0)
+        ss_within = np.where(nb_vals > 1, (nb_vals - 1) * var_vals,
+                             0.0).sum(axis=0)
+
+        df_between = nb_groups - 1
+        df_within = nb_tot - nb_groups
+
+        F_stat = (ss_between / df_between) / (ss_within / df_within)
+        p_val = stat.f.sf(F_stat, df_between, df_within)
+
+    return F_stat, p_val
+
+
+def _rank_along_samples(Z_edges):
+    """
+    private function, average ranks (1-based) along the first axis
+    (samples) computed with a single sort; NaN are sorted last and get a NaN
+    rank
+
+    Returns ranks and the tie term sum(t^3 - t) of each column
+    """
+    nb_samples, nb_edges = Z_edges.shape
+
+    order = np.argsort(Z_edges, axis=0, kind='mergesort')
+    sorted_Z = np.take_along_axis(Z_edges, order, axis=0)
+
+    # groups of equal values, numbered column after column
+    new_val = np.ones(Z_edges.shape, dtype=bool)
+    new_val[1:] = sorted_Z[1:] != sorted_Z[:-1]
+    group_id = (np.cumsum(new_val.T) - 1).reshape(nb_edges, nb_samples).T
+
+    # average rank of each group
+    pos = np.repeat(np.arange(1.0, nb_samples + 1), nb_edges).reshape(
+        nb_samples, nb_edges)
+    group_size = np.bincount(group_id.ravel())
+    group_rank = np.bincount(group_id.ravel(),
+                             weights=pos.ravel()) / group_size
+
+    sorted_ranks = group_rank[group_id]
+    sorted_ranks[np.isnan(sorted_Z)] = np.nan
+
+    ranks = np.empty(Z_edges.shape, dtype=float)
+    np.put_along_axis(ranks, order, sorted_ranks, axis=0)
+
+    # NaN are never equal, so they do not count as ties
+    group_col = np.repeat(np.arange(nb_edges), new_val.sum(axis=0))
+    tie_term = np.bincount(group_col, weights=group_size ** 3 - group_size,
+                           minlength=nb_edges)
+
+    return ranks, tie_term
+
+
+def _mannwhitneyu_exact_sf(nX, nY):
+    """
+    private function, survival function P(U >= u) (u = 0 .. nX * nY) of the
+    exact null distribution of the Mann-Whitney U statistic, from the
+    coefficients of the Gaussian binomial coefficient [nX + nY, nX]
+    """
+    n_min, n_max = min(nX, nY), max(nX, nY)
+
+    counts = np.zeros(n_min * n_max + 1)
+    counts[0] = 1.0
+
+    # prod_i (1 - q^(n_max + i)) / (1 - q^i), for i = 1 .. n_min
+    for i in range(1, n_min + 1):
+        counts[n_max + i:] -= counts[:-(n_max + i)].copy()
+
+        for k in range(i, len(counts)):
+            counts[k] += counts[k - i]
+
+    return np.cumsum(counts[::-1])[::-1] / counts.sum()
+
+
+def edge_mannwhitneyu(X_edges, Y_edges):
+    """
+    Vectorized (NaN-aware) two-sided Mann-Whitney U test, without continuity
+    correction (same as stat.mannwhitneyu(use_continuity=False) applied to
+    each column): exact distribution if one of the samples has at most 8
+    values and there are no ties, normal approximation with tie correction
+    otherwise
+
+    X_edges, Y_edges: (nb_samples, nb_edges) arrays
+
+    Returns U_stat (for X), p_val, sign of the difference of means (X - Y)
+    and the number of valid values in X and Y for each edge
+    """
+    ranks, tie_term = _rank_along_samples(
+        np.concatenate((X_edges, Y_edges), axis=0))
+
+    X_ranks = ranks[:X_edges.shape[0]]
+
+    nX = (~np.isnan(X_edges)).sum(axis=0)
+    nY = (~np.isnan(Y_edges)).sum(axis=0)
+    n_tot = nX + nY
+
+    U_stat = np.nansum(X_ranks, axis=0) - nX * (nX + 1) / 2.0
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mu = nX * nY / 2.0
+        sigma = np.sqrt(nX * nY / 12.0 * (
+            (n_tot + 1) - tie_term / (n_tot * (n_tot - 1))))
+
+        Z_val = np.abs(U_stat - mu) / sigma
+        p_val = np.clip(2 * stat.norm.sf(Z_val), 0, 1)
+
+        sign_diff = np.sign(np.nanmean(X_edges, axis=0) -
+                            np.nanmean(Y_edges, axis=0))
+
+    # exact p-values for small samples without ties, one (nX, nY) at a time
+    exact = (np.minimum(nX, nY) <= 8) & (np.minimum(nX, nY) > 0) & \
+        (tie_term == 0)
+
+    if np.any(exact):
+        U_max = np.maximum(U_stat, nX * nY - U_stat)
+
+        sizes = np.stack((nX, nY))[:, exact]
+
+        for size_X, size_Y in np.unique(sizes, axis=1).T:
+            cur_edges = np.where(exact)[0][
+                (sizes[0] == size_X) & (sizes[1] == size_Y)]
+
+            exact_sf = _mannwhitneyu_exact_sf(size_X, size_Y)
+
+            p_val[cur_edges] = np.clip(
+                2 * exact_sf[np.rint(U_max[cur_edges]).astype(int)], 0, 1)
+
+    return U_stat, p_val, sign_diff, nX, nY
+
+
+def edge_binom_test(count_X, nX, count_Y, nY, method="normal"):
+    """
+    Vectorized comparison of two proportions (count_X/nX vs count_Y/nY),
+    for arrays of counts of any shape (e.g. coclass count matrices)
+
+    method = "normal": Z-score of the difference of proportions (unpooled
+    standard error)
+    method = "exact": two-sided Fisher exact test (hypergeometric), same as
+    stat.fisher_exact on each 2x2 table
+
+    Returns the Z values (normal) or p-values (exact), and the sign of the
+    difference (pX - pY)
+    """
+    count_X = np.asarray(count_X, dtype=float)
+    count_Y = np.asarray(count_Y, dtype=float)
+
+    pX = count_X / nX
+    pY = count_Y / nY
+
+    sign_diff = np.sign(pX - pY)
+
+    if method == "normal":
+        with np.errstate(invalid='ignore', divide='ignore'):
+            SE = np.sqrt(pX * (1 - pX) / nX + pY * (1 - pY) / nY)
+            Z_val = np.absolute(pX - pY) / SE
+
+        return Z_val, sign_diff
+
+    elif method == "exact":
+        # hypergeometric: nX draws among nX + nY, with count_X + count_Y
+        # successes; all possible counts in X are tested at once
+        nb_success = (count_X + count_Y).ravel()
+        possible_counts = np.arange(nX + 1)[:, np.newaxis]
+
+        all_pmf = stat.hypergeom.pmf(possible_counts, nX + nY, nb_success,
+                                     nX)
+        obs_pmf = stat.hypergeom.pmf(count_X.ravel(), nX + nY, nb_success,
+                                     nX)
+
+        # same relative tolerance as in stat.fisher_exact
+        p_val = np.where(all_pmf <= obs_pmf * (1 + 1e-7), all_pmf,
+                         0).sum(axis=0)
+
+        return np.clip(p_val, 0, 1).reshape(count_X.shape), sign_diff
+
+    else:
+        raise ValueError("Unknown method {} (should be normal or \
+            exact)".format(method))
+
+
+def _return_signif_mats(N, s_i, s_j, p_val, sign_diff, stat_val, cor_alpha,
+                        uncor_alpha):
+    """private function, computing signif codes and converting edge vectors to
+    signif, p-value and stat (symmetric) matrices"""
+    assert len(p_val) != 0, "Error, list_diff is empty"
+
+    signif_code = _return_signif_code(p_val, uncor_alpha=uncor_alpha,
+                                      fdr_alpha=cor_alpha,
+                                      bon_alpha=cor_alpha)
+
+    signif_sign = (sign_diff * signif_code).astype(int)
+
+    signif_mat = np.zeros((N, N), dtype='int')
+    p_val_mat = np.zeros((N, N), dtype='float')
+    stat_mat = np.zeros((N, N), dtype='float')
+
+    signif_mat[s_i, s_j] = signif_mat[s_j, s_i] = signif_sign
+    p_val_mat[s_i, s_j] = p_val_mat[s_j, s_i] = p_val
+    stat_mat[s_i, s_j] = stat_mat[s_j, s_i] = stat_val
+
+    return signif_mat, p_val_mat, stat_mat
+
+
+def _keep_enough_values(s_i, s_j, *nb_vals, **kwargs):
+    """private function, edges with at least min_vals (default 2) values in
+    each sample"""
+    min_vals = kwargs.get("min_vals", 2)
+
+    keep = np.ones(len(s_i), dtype=bool)
+    for nb in nb_vals:
+        keep &= (nb >= min_vals)
+
+    if not keep.all():
+        print("Not enough values for {} edges, skipping".format(
+            np.sum(~keep)))
+
+    return keep
+
+
 def compute_pairwise_ttest_fdr(X, Y, cor_alpha, uncor_alpha, paired=True,
                                old_order=True, keep_intracon=False):
     """Two-way pairwise T-test stats"""
@@ -130,66 +641,62 @@ def compute_pairwise_ttest_fdr(X, Y, cor_alpha, uncor_alpha, paired=True,
     N = X.shape[1]
 
     # tests are also done on the diagonal of the matrix
-    if keep_intracon:
-        iter_indexes = it.combinations_with_replacement(list(range(N)), 2)
-    else:
-        iter_indexes = it.combinations(list(range(N)), 2)
-
-    # computing signif t-tests for each relevant pair
-    list_diff = []
+    s_i, s_j = _return_edge_indexes(N, keep_intracon)
 
-    for i, j in iter_indexes:
+    # computing t-tests for all edges at once (samples * edges)
+    X_edges = X[:, s_i, s_j]
+    Y_edges = Y[:, s_i, s_j]
 
-        # removing the nan
-        X_nonan = X[np.logical_not(np.isnan(X[:, i, j])), i, j]
-        Y_nonan = Y[np.logical_not(np.isnan(Y[:, i, j])), i, j]
-
-        if len(X_nonan) < 2 or len(Y_nonan) < 2:
-            print("Not enough values for sample {} {}, len = {} and {},\
-                    skipping".format(i, j, len(X_nonan), len(Y_nonan)))
-            continue
-
-        if paired:
-            t_stat, p_val = stat.ttest_rel(X_nonan, Y_nonan)
-            if np.isnan(p_val):
-                print("Warning, unable to compute T-test: ")
+    if paired:
+        t_stat, p_val, sign_diff, nX = edge_ttest_rel(X_edges, Y_edges)
+        nY = nX
+    else:
+        t_stat, p_val, sign_diff, nX, nY = edge_ttest_ind(X_edges, Y_edges)
 
-            # TODO pas encore present (version scipy 0.18)
-            # t_stat,p_val = stat.ttest_rel(X[i,j,:],Y[i,j,:],
-            # nan_policy = 'omit')
+    keep = _keep_enough_values(s_i, s_j, nX, nY)
 
-        else:
-            t_stat, p_val = stat.ttest_ind(X_nonan, Y_nonan)
+    if np.isnan(p_val[keep]).any():
+        print("Warning, unable to compute T-test for {} edges".format(
+            np.sum(np.isnan(p_val[keep]))))
 
-        list_diff.append([i, j, p_val, np.sign(
-            np.mean(X_nonan)-np.mean(Y_nonan)), t_stat])
+    return _return_signif_mats(N, s_i[keep], s_j[keep], p_val[keep],
+                               sign_diff[keep], t_stat[keep], cor_alpha,
+                               uncor_alpha)
 
-    assert len(list_diff) != 0, "Error, list_diff is empty"
 
-    np_list_diff = np.array(list_diff)
+def compute_pairwise_ttest_fdr_from_moments(moments_X, moments_Y=None,
+                                            cor_alpha=0.05, uncor_alpha=0.01,
+                                            keep_intracon=False):
+    """
+    Two-way pairwise T-test stats, from (nb_vals, mean_vals, var_vals)
+    matrices (see group_edge_moments and paired_edge_moments)
 
-    signif_code = _return_signif_code(np_list_diff[:, 2],
-                                      uncor_alpha=uncor_alpha,
-                                      fdr_alpha=cor_alpha,
-                                      bon_alpha=cor_alpha)
+    if moments_Y is None, moments_X are the moments of paired differences
+    (paired T-test), otherwise an unpaired T-test is computed
+    """
+    N = moments_X[0].shape[-1]
 
-    np_list_diff[:, 3] *= signif_code
+    s_i, s_j = _return_edge_indexes(N, keep_intracon)
 
-    # formatting signif_mat, p_val_mat and T_stat_mat
-    signif_mat = np.zeros((N, N), dtype='int')
-    p_val_mat = np.zeros((N, N), dtype='float')
-    T_stat_mat = np.zeros((N, N), dtype='float')
+    nX, mX, vX = [moment[s_i, s_j] for moment in moments_X]
 
-    s_i = np.array(np_list_diff[:, 0], dtype=int)
-    s_j = np.array(np_list_diff[:, 1], dtype=int)
+    if moments_Y is None:
+        t_stat, p_val, sign_diff = edge_ttest_1samp_from_moments(nX, mX, vX)
+        nY = nX
+    else:
+        nY, mY, vY = [moment[s_i, s_j] for moment in moments_Y]
+        t_stat, p_val, sign_diff = edge_ttest_ind_from_moments(nX, mX, vX,
+                                                               nY, mY, vY)
 
-    signif_mat[s_i, s_j] = np_list_diff[:, 3].astype(int)
-    signif_mat[s_j, s_i] = np_list_diff[:, 3].astype(int)
+    keep = _keep_enough_values(s_i, s_j, nX, nY)
 
-    p_val_mat[s_i, s_j] = p_val_mat[s_j, s_i] = np_list_diff[:, 2]
-    T_stat_mat[s_i, s_j] = T_stat_mat[s_j, s_i] = np_list_diff[:, 4]
+    if np.isnan(p_val[keep]).any():
+        print("Warning, unable to compute T-test for {} edges".format(
+            np.sum(np.isnan(p_val[keep]))))
 
-    return signif_mat, p_val_mat, T_stat_mat
+    return _return_signif_mats(N, s_i[keep], s_j[keep], p_val[keep],
+                               sign_diff[keep], t_stat[keep], cor_alpha,
+                               uncor_alpha)
 
 
 def compute_pairwise_oneway_ttest_fdr(X, cor_alpha, uncor_alpha,
@@ -204,54 +711,19 @@ def compute_pairwise_oneway_ttest_fdr(X, cor_alpha, uncor_alpha,
 
     N = X.shape[1]
 
-    list_diff = []
-
-    for i, j in it.combinations(list(range(N)), 2):
-
-        X_nonan = X[np.logical_not(np.isnan(X[:, i, j])), i, j]
-
-        if len(X_nonan) < 2:
-            print("Not enough values for sample {} {}, len = {}, \
-                   skipping".format(i, j, len(X_nonan)))
-            continue
-
-        t_stat, p_val = stat.ttest_1samp(X_nonan, 0.0)  # 0.0 ?
-
-        if np.isnan(p_val):
-
-            print("Warning, unable to compute T-test: ")
-            print(t_stat, p_val, X_nonan)
-
-        list_diff.append([i, j, p_val, np.sign(np.mean(X_nonan)), t_stat])
-
-    print(list_diff)
-
-    assert len(list_diff) != 0, "Error, list_diff is empty"
-
-    np_list_diff = np.array(list_diff)
-
-    print(np_list_diff)
-
-    signif_code = _return_signif_code(np_list_diff[:, 2], uncor_alpha,
-                                      fdr_alpha=cor_alpha, bon_alpha=cor_alpha)
-
-    np_list_diff[:, 3] *= signif_code
-
-    signif_mat = np.zeros((N, N), dtype='int')
-    p_val_mat = np.zeros((N, N), dtype='float')
-    T_stat_mat = np.zeros((N, N), dtype='float')
+    s_i, s_j = _return_edge_indexes(N)
 
-    s_i = np.array(np_list_diff[:, 0], dtype=int)
-    s_j = np.array(np_list_diff[:, 1], dtype=int)
+    t_stat, p_val, sign_diff, nX = edge_ttest_1samp(X[:, s_i, s_j], 0.0)
 
-    signif_mat[s_i, s_j] = np_list_diff[:, 3].astype(int)
-    signif_mat[s_j, s_i] = np_list_diff[:, 3].astype(int)
-    p_val_mat[s_i, s_j] = p_val_mat[s_j, s_i] = np_list_diff[:, 2]
-    T_stat_mat[s_i, s_j] = T_stat_mat[s_j, s_i] = np_list_diff[:, 4]
+    keep = _keep_enough_values(s_i, s_j, nX)
 
-    print(T_stat_mat)
+    if np.isnan(p_val[keep]).any():
+        print("Warning, unable to compute T-test for {} edges".format(
+            np.sum(np.isnan(p_val[keep]))))
 
-    return signif_mat, p_val_mat, T_stat_mat
+    return _return_signif_mats(N, s_i[keep], s_j[keep], p_val[keep],
+                               sign_diff[keep], t_stat[keep], cor_alpha,
+                               uncor_alpha)
 
 
 def compute_pairwise_mannwhitney_fdr(X, Y, cor_alpha, uncor_alpha=0.01,
@@ -278,55 +750,26 @@ def compute_pairwise_mannwhitney_fdr(X, Y, cor_alpha, uncor_alpha=0.01,
     # number of nodes
     N = X.shape[1]
 
-    # compute pairwise test
-    list_diff = []
-
-    for i, j in it.combinations(list(range(N)), 2):
-
-        # TODO: handles nan correctly??
-        X_val = X[:, i, j]
-        Y_val = Y[:, i, j]
-        u_stat, p_val = stat.mannwhitneyu(X_val, Y_val, use_continuity=False,
-                                          alternative="two-sided")
+    # compute test for all edges at once
+    s_i, s_j = _return_edge_indexes(N)
 
-        sign_diff = np.sign(np.mean(X_val)-np.mean(Y_val))
+    U_stat, p_val, sign_diff, nX, nY = edge_mannwhitneyu(X[:, s_i, s_j],
+                                                         Y[:, s_i, s_j])
 
-        list_diff.append([i, j, p_val, sign_diff])
-
-    np_list_diff = np.array(list_diff)
-
-    signif_code = _return_signif_code(np_list_diff[:, 2],
-                                      uncor_alpha=uncor_alpha,
+    signif_code = _return_signif_code(p_val, uncor_alpha=uncor_alpha,
                                       fdr_alpha=cor_alpha, bon_alpha=cor_alpha)
 
-    np_list_diff[:, 3] = np_list_diff[:, 3] * signif_code
-
     signif_mat = np.zeros((N, N), dtype='int')
 
-    s_i = np.array(np_list_diff[:, 0], dtype=int)
-    s_j = np.array(np_list_diff[:, 1], dtype=int)
-    signif_sign = np.array(np_list_diff[:, 3], dtype=int)
+    signif_sign = np.array(sign_diff * signif_code, dtype=int)
 
     signif_mat[s_i, s_j] = signif_mat[s_j, s_i] = signif_sign
 
     return signif_mat
 
 
-def _info_CI(X, Y):
-    """ Compute binomial comparaison"""
-    nX = len(X) * 1.
-    nY = len(Y) * 1.
-
-    pX = np.sum(X == 1)/nX
-    pY = np.sum(Y == 1)/nY
-
-    SE = np.sqrt(pX * (1-pX)/nX + pY * (1-pY)/nY)
-
-    return np.absolute(pX-pY), SE, np.sign(pX-pY)
-
-
 def compute_pairwise_binom_fdr(X, Y, uncor_alpha=0.001, cor_alpha=0.05,
-                               old_order=True):
+                               old_order=True, method="normal"):
     """modified to be compatible with old_order = True
     (was only developed for old order) + assert"""
     # TODO : test if OK with moveaxis and 'new order'?
@@ -347,28 +790,27 @@ def compute_pairwise_binom_fdr(X, Y, uncor_alpha=0.001, cor_alpha=0.05,
     # number of nodes
     N = X.shape[1]
 
-    # Perform binomial test at each edge
-    list_diff = []
+    # Perform binomial test on count matrices (all edges at once)
+    s_i, s_j = _return_edge_indexes(N)
 
-    for i, j in it.combinations(list(range(N)), 2):
-        abs_diff, SE, sign_diff = _info_CI(X[:, i, j], Y[:, i, j])
-        list_diff.append([i, j, abs_diff/SE, sign_diff])
+    count_X = np.sum(X[:, s_i, s_j] == 1, axis=0)
+    count_Y = np.sum(Y[:, s_i, s_j] == 1, axis=0)
 
-    np_list_diff = np.array(list_diff)
+    res, sign_diff = edge_binom_test(count_X, X.shape[0], count_Y,
+                                     Y.shape[0], method=method)
 
-    signif_code = _return_signif_code_Z(np_list_diff[:, 2],
-                                        uncor_alpha=uncor_alpha,
-                                        fdr_alpha=cor_alpha,
-                                        bon_alpha=cor_alpha)
-
-    np_list_diff[:, 3] = np_list_diff[:, 3] * signif_code
+    if method == "normal":
+        signif_code = _return_signif_code_Z(res, uncor_alpha=uncor_alpha,
+                                            fdr_alpha=cor_alpha,
+                                            bon_alpha=cor_alpha)
+    else:
+        signif_code = _return_signif_code(res, uncor_alpha=uncor_alpha,
+                                          fdr_alpha=cor_alpha,
+                                          bon_alpha=cor_alpha)
 
     signif_mat = np.zeros((N, N), dtype='int')
 
-    s_i = np.array(np_list_diff[:, 0], dtype=int)
-    s_j = np.array(np_list_diff[:, 1], dtype=int)
-
-    signif_sign = np.array(np_list_diff[:, 3], dtype=int)
+    signif_sign = np.array(sign_diff * signif_code, dtype=int)
     signif_mat[s_i, s_j] = signif_mat[s_j, s_i] = signif_sign
 
     return signif_mat
@@ -377,123 +819,508 @@ def compute_pairwise_binom_fdr(X, Y, uncor_alpha=0.001, cor_alpha=0.05,
 def compute_oneway_anova_fwe(list_of_list_matrices, cor_alpha=0.05,
                              uncor_alpha=0.001, keep_intracon=False):
     """OneWay Anova (F-test)"""
-    # TODO : warning, this is very different than previous functions,
-    # needs tobe checked where it is called
-    assert False, ("Warning, very old function, check your call and report it \
-        to developer")
-
+    # list_of_list_matrices is a list of stacks of matrices (one per group),
+    # in the new order (sample_size, n_nodes, n_nodes)
     for group_mat in list_of_list_matrices:
         assert group_mat.shape[1] == group_mat.shape[2], ("warning, matrices \
             are not squared {} {}".format(group_mat.shape[1],
                                           group_mat.shape[2]))
 
-    N = group_mat.shape[2]
+    N = list_of_list_matrices[0].shape[2]
 
-    list_diff = []
+    for group_mat in list_of_list_matrices:
+        assert group_mat.shape[2] == N, ("Error, groups do not have the same \
+            number of nodes {} {}".format(group_mat.shape[2], N))
 
-    if keep_intracon:
-        iter_indexes = it.combinations_with_replacement(list(range(N)), 2)
+    s_i, s_j = _return_edge_indexes(N, keep_intracon)
 
-    else:
-        iter_indexes = it.combinations(list(range(N)), 2)
+    F_stat, p_val, nb_vals = edge_f_oneway(
+        [group_mat[:, s_i, s_j] for group_mat in list_of_list_matrices])
 
-    for i, j in iter_indexes:
+    keep = _keep_enough_values(s_i, s_j, *nb_vals)
 
-        list_val = [group_mat[:, i, j].tolist()
-                    for group_mat in list_of_list_matrices]
+    # F-test is not signed, signif code is 0 if F could not be computed
+    sign_diff = np.where(np.isnan(p_val[keep]), 0, 1)
 
-        F_stat, p_val = stat.f_oneway(*list_val)
+    return _return_signif_mats(N, s_i[keep], s_j[keep], p_val[keep],
+                               sign_diff, F_stat[keep], cor_alpha,
+                               uncor_alpha)
 
-        list_diff.append([i, j, p_val, F_stat])
 
-    # computing significance code
-    np_list_diff = np.array(list_diff)
+def compute_oneway_anova_fwe_from_moments(nb_vals, mean_vals, var_vals,
+                                          cor_alpha=0.05, uncor_alpha=0.001,
+                                          keep_intracon=False):
+    """OneWay Anova (F-test), from the moments of each group, with shape
+    (nb_groups, n_nodes, n_nodes) (see group_edge_moments)"""
+    N = nb_vals.shape[-1]
 
-    signif_code = _return_signif_code(np_list_diff[:, 2],
-                                      uncor_alpha=uncor_alpha,
-                                      fdr_alpha=cor_alpha,
-                                      bon_alpha=cor_alpha)
+    s_i, s_j = _return_edge_indexes(N, keep_intracon)
 
-    signif_code[np.isnan(np_list_diff[:, 2])] = 0
+    nb_edge_vals = nb_vals[:, s_i, s_j]
 
-    # converting to matrix
-    signif_adj_mat = np.zeros((N, N), dtype='int')
-    p_val_mat = np.zeros((N, N), dtype='float')
-    F_stat_mat = np.zeros((N, N), dtype='float')
+    F_stat, p_val = edge_f_oneway_from_moments(
+        nb_edge_vals, mean_vals[:, s_i, s_j], var_vals[:, s_i, s_j])
 
-    s_i = np.array(np_list_diff[:, 0], dtype=int)
-    s_j = np.array(np_list_diff[:, 1], dtype=int)
+    keep = _keep_enough_values(s_i, s_j, *nb_edge_vals)
 
-    signif_adj_mat[s_i, s_j] = signif_adj_mat[s_j, s_i] = signif_code
-    p_val_mat[s_i, s_j] = p_val_mat[s_i, s_j] = np_list_diff[:, 2]
-    F_stat_mat[s_i, s_j] = F_stat_mat[s_i, s_j] = np_list_diff[:, 3]
+    # F-test is not signed, signif code is 0 if F could not be computed
+    sign_diff = np.where(np.isnan(p_val[keep]), 0, 1)
 
-    return signif_adj_mat, p_val_mat, F_stat_mat
+    return _return_signif_mats(N, s_i[keep], s_j[keep], p_val[keep],
+                               sign_diff, F_stat[keep], cor_alpha,
+                               uncor_alpha)
 
 
 def compute_correl_behav(X, reg_interest, uncor_alpha=0.001, cor_alpha=0.05,
                          old_order=False, keep_intracon=False):
     """correlation with behaviour (1D vector)"""
     if old_order:
-        X = X.moveaxis(X, 0, 2)
+        X = np.moveaxis(X, 2, 0)
+
+    # number of nodes
+    assert X.shape[1] == X.shape[2], ("Error, X {}{} is not squared".format(
+        X.shape[1], X.shape[2]))
+
+    assert X.shape[0] == reg_interest.shape[0], ("Incompatible number of \
+        fields in dataframe and nb matrices")
 
     N = X.shape[1]
 
-    print(reg_interest)
-    print(reg_interest.dtype)
+    s_i, s_j = _return_edge_indexes(N, keep_intracon)
 
-    if keep_intracon:
-        iter_indexes = it.combinations_with_replacement(list(range(N)), 2)
+    r_stat, p_val, nb_vals = edge_pearsonr(X[:, s_i, s_j], reg_interest)
+
+    keep = _keep_enough_values(s_i, s_j, nb_vals)
+
+    if np.isnan(p_val[keep]).any():
+        print("Warning, unable to compute correlation for {} edges".format(
+            np.sum(np.isnan(p_val[keep]))))
+
+    return _return_signif_mats(N, s_i[keep], s_j[keep], p_val[keep],
+                               np.sign(r_stat[keep]), r_stat[keep],
+                               cor_alpha, uncor_alpha)
+
+
+# Permutation tests (max-statistic, FWE correction)
+
+
+def _prepare_permut_data(X_edges):
+    """private function, quantities computed once for all permutations"""
+    valid = ~np.isnan(X_edges)
+
+    X_zeros = np.where(valid, X_edges, 0.0)
+
+    return {"X": X_zeros, "X2": X_zeros ** 2,
+            "valid": valid.astype(float),
+            "sum": X_zeros.sum(axis=0), "sum2": (X_zeros ** 2).sum(axis=0),
+            "nb_vals": valid.sum(axis=0)}
+
+
+def _batch_group_sums(data, indic):
+    """private function, number of values, sum and sum of squares for each
+    row of indicator matrix (batch, nb_samples)"""
+    return (np.dot(indic, data["valid"]), np.dot(indic, data["X"]),
+            np.dot(indic, data["X2"]))
+
+
+def _batch_edge_stats(data, perm_design, test):
+    """
+    private function, edge statistics for a batch of permuted designs
+    (batch, nb_samples), all edges at once (batch, nb_edges)
+
+    - ttest_ind: design are group indexes (0 or 1), t values (group 0 -
+    group 1)
+    - f_oneway: design are group indexes (0 to k-1), F values
+    - ttest_1samp: design are signs (-1 or 1), t values vs 0
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if test == "ttest_ind":
+            n0, s0, q0 = _batch_group_sums(data, (perm_design == 0) * 1.0)
+            n1 = data["nb_vals"] - n0
+            s1 = data["sum"] - s0
+            q1 = data["sum2"] - q0
+
+            ss0 = q0 - s0 ** 2 / n0
+            ss1 = q1 - s1 ** 2 / n1
+
+            pooled_var = (ss0 + ss1) / (n0 + n1 - 2)
+
+            return (s0 / n0 - s1 / n1) / np.sqrt(
+                pooled_var * (1.0 / n0 + 1.0 / n1))
+
+        elif test == "f_oneway":
+            nb_groups = int(perm_design.max()) + 1
+
+            ss_between = - data["sum"] ** 2 / data["nb_vals"]
+            ss_within = data["sum2"].copy()
+            nb_valid_groups = 0
+
+            for group in range(nb_groups):
+                n_g, s_g, q_g = _batch_group_sums(
+                    data, (perm_design == group) * 1.0)
+
+                mean_term = np.where(n_g > 0, s_g ** 2 / n_g, 0.0)
+                ss_between = ss_between + mean_term
+                ss_within = ss_within - mean_term
+                nb_valid_groups = nb_valid_groups + (n_g > 0)
+
+            df_between = nb_valid_groups - 1
+            df_within = data["nb_vals"] - nb_valid_groups
+
+            return (ss_between / df_between) / (ss_within / df_within)
+
+        elif test == "ttest_1samp":
+            nb_vals = data["nb_vals"]
+            sum_vals = np.dot(perm_design, data["X"])
+
+            var_vals = (data["sum2"] - sum_vals ** 2 / nb_vals) / \
+                (nb_vals - 1)
+
+            return (sum_vals / nb_vals) / np.sqrt(var_vals / nb_vals)
+
+        else:
+            raise ValueError("Unknown test {} (should be ttest_ind, f_oneway \
+                or ttest_1samp)".format(test))
+
+
+def _return_permut_design(design, test, nb_samples):
+    """private function, design coded as integers (or signs for
+    ttest_1samp)"""
+    if test == "ttest_1samp":
+        return np.ones(nb_samples)
+
+    assert design is not None and len(design) == nb_samples, \
+        ("Error, design should have one value per sample ({})".format(
+            nb_samples))
+
+    groups, codes = np.unique(np.asarray(design), return_inverse=True)
+
+    if test == "ttest_ind":
+        assert len(groups) == 2, ("Error, ttest_ind requires 2 groups, \
+            found {}".format(groups))
     else:
-        iter_indexes = it.combinations(list(range(N)), 2)
+        assert len(groups) > 1, ("Error, f_oneway requires at least 2 \
+            groups, found {}".format(groups))
 
-    # number of nodes
-    assert X.shape[1] == X.shape[2] and "Error, X {}{} is not squared".format(
-        X.shape[1], X.shape[2])
+    return codes
 
-    assert X.shape[0] == reg_interest.shape[0], ("Incompatible number of \
-        fields in dataframe and nb matrices")
 
-    list_diff = []
+def _generate_permut_batch(code_design, test, batch_size, seed_seq):
+    """private function, a batch of permuted designs (batch, nb_samples)
+    with its own random generator"""
+    rng = np.random.default_rng(seed_seq)
 
-    for i, j in iter_indexes:
+    if test == "ttest_1samp":
+        return rng.choice([-1.0, 1.0], size=(batch_size, len(code_design)))
 
-        keep_val = (~np.isnan(X[:, i, j])) & (~np.isnan(reg_interest))
-        X_nonan = X[keep_val, i, j]
-        reg_nonan = reg_interest[keep_val]
-        r_stat, p_val = stat.pearsonr(X_nonan, reg_nonan)
+    # independent shuffle of each row (same as Generator.permuted, which
+    # requires numpy >= 1.20)
+    perm_indexes = np.argsort(rng.random((batch_size, len(code_design))),
+                              axis=1)
 
-        if np.isnan(p_val):
+    return np.asarray(code_design)[perm_indexes]
 
-            print("Warning, unable to compute T-test: ")
-            print(r_stat, p_val, X_nonan)
 
-        list_diff.append([i, j, p_val, np.sign(r_stat), r_stat])
+def _max_abs_stat(batch_stats):
+    """private function, max absolute statistic of each permutation (NaN
+    are skipped)"""
+    return np.max(np.where(np.isnan(batch_stats), -np.inf,
+                           np.abs(batch_stats)), axis=-1)
 
-    assert len(list_diff) != 0, "Error, list_diff is empty"
 
-    np_list_diff = np.array(list_diff)
+def permut_null_distributions(X_edges, design=None, test="ttest_ind",
+                              reduce_funcs=None, nb_permuts=1000,
+                              batch_size=50, seed=None, n_jobs=1):
+    """
+    Permutation engine over (samples x edges) arrays: permuted designs are
+    generated by batches, the edge statistics of each batch are computed at
+    once, and reduced to one value per permutation by each reduce_func
+    (e.g. max statistic, size of largest component; default: max absolute
+    statistic)
 
-    signif_code = _return_signif_code(np_list_diff[:, 2],
-                                      uncor_alpha=uncor_alpha,
-                                      fdr_alpha=cor_alpha,
-                                      bon_alpha=cor_alpha)
+    Each batch has its own random stream (SeedSequence.spawn), so results
+    only depend on seed, not on n_jobs. With n_jobs > 1, batches are
+    computed in a pool of threads (matrix products release the GIL)
 
-    np_list_diff[:, 3] *= signif_code
+    Memory used by each batch (and each thread) is about
+    15 * batch_size * nb_edges * 8 bytes
+
+    Returns a (nb_permuts, len(reduce_funcs)) array of null values
+    """
+    if reduce_funcs is None:
+        reduce_funcs = [_max_abs_stat]
+
+    X_edges = np.asarray(X_edges, dtype=float)
+
+    code_design = _return_permut_design(design, test, X_edges.shape[0])
+
+    data = _prepare_permut_data(X_edges)
+
+    batch_sizes = [batch_size] * (nb_permuts // batch_size)
+    if nb_permuts % batch_size:
+        batch_sizes.append(nb_permuts % batch_size)
+
+    seed_seqs = np.random.SeedSequence(seed).spawn(len(batch_sizes))
+
+    def _run_batch(batch_index):
+        perm_design = _generate_permut_batch(
+            code_design, test, batch_sizes[batch_index],
+            seed_seqs[batch_index])
+
+        batch_stats = _batch_edge_stats(data, perm_design, test)
+
+        return np.stack([reduce_func(batch_stats)
+                         for reduce_func in reduce_funcs], axis=1)
+
+    if n_jobs > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            all_null_vals = list(executor.map(_run_batch,
+                                              range(len(batch_sizes))))
+    else:
+        all_null_vals = [_run_batch(i) for i in range(len(batch_sizes))]
+
+    return np.concatenate(all_null_vals, axis=0)
+
+
+def permut_edge_stats(X_edges, design=None, test="ttest_ind"):
+    """
+    Edge statistics with the (non permuted) design, computed the same way as
+    in permut_null_distributions
+    """
+    X_edges = np.asarray(X_edges, dtype=float)
+
+    code_design = _return_permut_design(design, test, X_edges.shape[0])
+
+    return _batch_edge_stats(_prepare_permut_data(X_edges),
+                             code_design[np.newaxis, :], test)[0]
+
+
+def edge_components(supra_edges, s_i, s_j, N):
+    """
+    Connected components of the graph made of supra-threshold edges
+    (sparse CSR connected components)
+
+    Returns the component index of each edge (-1 for infra-threshold edges)
+    and the number of edges of each component
+    """
+    comp_i = s_i[supra_edges]
+    comp_j = s_j[supra_edges]
+
+    graph = sp.coo_matrix((np.ones(len(comp_i)), (comp_i, comp_j)),
+                          shape=(N, N)).tocsr()
+
+    nb_comps, node_comps = connected_components(graph, directed=False)
+
+    edge_comps = - np.ones(len(s_i), dtype=int)
+    edge_comps[supra_edges] = node_comps[comp_i]
+
+    # isolated nodes are components without edges, removed afterwards
+    comp_sizes = np.bincount(node_comps[comp_i], minlength=nb_comps)
+
+    return edge_comps, comp_sizes
+
+
+def compute_comp_measures(edge_comps, excess_vals, nb_comps,
+                          measure="extent"):
+    """
+    size of each component: number of edges (extent) or sum of the values
+    above threshold (intensity)
+    """
+    in_comp = edge_comps != -1
+
+    if measure == "extent":
+        return np.bincount(edge_comps[in_comp],
+                           minlength=nb_comps).astype(float)
+
+    elif measure == "intensity":
+        return np.bincount(edge_comps[in_comp],
+                           weights=excess_vals[in_comp], minlength=nb_comps)
+
+    else:
+        raise ValueError("Unknown measure {} (should be extent or \
+            intensity)".format(measure))
+
+
+def _fwe_p_values(obs_vals, null_vals):
+    """private function, p-values of observed values against the null
+    distribution of the max (including the observed as one permutation)"""
+    sorted_null = np.sort(null_vals)
+    nb_higher = len(sorted_null) - np.searchsorted(sorted_null, obs_vals,
+                                                   side='left')
+
+    return (nb_higher + 1.0) / (len(sorted_null) + 1.0)
+
+
+def compute_permut_fwe(X, design=None, test="ttest_ind", nb_permuts=1000,
+                       cluster_threshold=None, batch_size=50, seed=None,
+                       n_jobs=1, two_sided=True, old_order=False,
+                       keep_intracon=False, measure="extent"):
+    """
+    Permutation test over stacked matrices, with family-wise error (FWE)
+    correction over edges by the max-statistic (max-T) method, and
+    optionally at the component level (NBS-like: measure of the connected
+    components of edges with statistic > cluster_threshold, see
+    compute_comp_measures)
+
+    X: stack of matrices (sample_size, n_nodes, n_nodes) in new order
+    design: group of each sample (ttest_ind, f_oneway); for ttest_1samp,
+    signs are flipped (use X - Y for paired samples) and design is not used
+
+    Returns stat_mat, p_fwe_mat (max-T corrected p-values), p_comp_mat
+    (component p-value of each edge, None if no cluster_threshold) and the
+    null distributions (dict; "max_comp_size" is the max component measure)
+    """
+    if old_order:
+        X = np.moveaxis(X, 2, 0)
+
+    assert X.shape[1] == X.shape[2], ("Error, X {} {} is not \
+        squared".format(X.shape[1], X.shape[2]))
+
+    N = X.shape[1]
+
+    s_i, s_j = _return_edge_indexes(N, keep_intracon)
+
+    X_edges = np.asarray(X[:, s_i, s_j], dtype=float)
+
+    # NaN statistics (not enough values) are never the max nor supra-threshold
+    if two_sided and test != "f_oneway":
+        def _signed(stats):
+            return np.where(np.isnan(stats), -np.inf, np.abs(stats))
+    else:
+        def _signed(stats):
+            return np.where(np.isnan(stats), -np.inf, stats)
+
+    def _max_stat(batch_stats):
+        return np.max(_signed(batch_stats), axis=-1)
+
+    def _comp_measures(stats):
+        signed_stats = _signed(stats)
+        supra_edges = signed_stats > cluster_threshold
+
+        edge_comps, comp_sizes = edge_components(supra_edges, s_i, s_j, N)
+
+        comp_measures = compute_comp_measures(
+            edge_comps, np.where(supra_edges, signed_stats - cluster_threshold,
+                                 0.0), len(comp_sizes), measure)
+
+        return edge_comps, comp_measures
+
+    def _max_comp_size(batch_stats):
+        return np.array([np.max(_comp_measures(stats)[1], initial=0)
+                         for stats in batch_stats])
+
+    reduce_funcs = [_max_stat]
+    if cluster_threshold is not None:
+        reduce_funcs.append(_max_comp_size)
+
+    null_vals = permut_null_distributions(
+        X_edges, design=design, test=test, reduce_funcs=reduce_funcs,
+        nb_permuts=nb_permuts, batch_size=batch_size, seed=seed,
+        n_jobs=n_jobs)
+
+    null_dists = {"max_stat": null_vals[:, 0]}
+
+    # observed statistics (non permuted design)
+    obs_stats = permut_edge_stats(X_edges, design=design, test=test)
+
+    p_fwe = _fwe_p_values(_signed(obs_stats), null_dists["max_stat"])
+
+    stat_mat = np.zeros((N, N), dtype='float')
+    p_fwe_mat = np.ones((N, N), dtype='float')
+
+    stat_mat[s_i, s_j] = stat_mat[s_j, s_i] = obs_stats
+    p_fwe_mat[s_i, s_j] = p_fwe_mat[s_j, s_i] = p_fwe
+
+    p_comp_mat = None
+
+    if cluster_threshold is not None:
+        null_dists["max_comp_size"] = null_vals[:, 1]
+
+        edge_comps, comp_measures = _comp_measures(obs_stats)
+
+        p_comps = _fwe_p_values(comp_measures, null_dists["max_comp_size"])
+
+        p_edges = np.ones(len(s_i))
+        p_edges[edge_comps != -1] = p_comps[edge_comps[edge_comps != -1]]
+
+        p_comp_mat = np.ones((N, N), dtype='float')
+        p_comp_mat[s_i, s_j] = p_comp_mat[s_j, s_i] = p_edges
+
+    return stat_mat, p_fwe_mat, p_comp_mat, null_dists
+
+
+# Permutation plans (group labels for all seeds)
+
+
+def return_permut_plan(group_sizes, seeds, unbalanced=False):
+    """
+    Permutation plan: group labels of each seed, as compact int8 array
+    (nb_seeds, nb_units), each seed with its own numpy Generator
+
+    - unbalanced: units are all subjects pooled (group after group), each
+    subject is randomly assigned to a group
+    - balanced (paired design, all groups have the same subjects): units are
+    the subjects, label is the shift of group (permuted group j takes the
+    files of group (j + shift) % nb_groups)
+
+    seed = -1 keeps the original assignment
+    """
+    nb_groups = len(group_sizes)
+
+    assert nb_groups < 128, "Error, too many groups for int8 labels"
+
+    if unbalanced:
+        orig_labels = np.repeat(np.arange(nb_groups), group_sizes)
+    else:
+        assert all(size == group_sizes[0] for size in group_sizes), \
+            ("Error, groups should have the same size in balanced \
+             design {}".format(group_sizes))
+        orig_labels = np.zeros(group_sizes[0], dtype=int)
+
+    labels = np.zeros((len(seeds), len(orig_labels)), dtype='int8')
+
+    for k, seed in enumerate(seeds):
+        if seed == -1:
+            labels[k] = orig_labels
+        else:
+            labels[k] = np.random.default_rng(seed).integers(
+                nb_groups, size=len(orig_labels))
+
+    return labels
+
+
+def save_permut_plan(permut_plan_file, labels, seeds, group_sizes,
+                     unbalanced=False):
+    """save permutation plan in .npz format"""
+    np.savez(permut_plan_file, labels=np.asarray(labels, dtype='int8'),
+             seeds=np.asarray(seeds, dtype=int),
+             group_sizes=np.asarray(group_sizes, dtype=int),
+             unbalanced=unbalanced)
+
+
+def load_permut_plan(permut_plan_file):
+    """load permutation plan (dict with labels, seeds, group_sizes and
+    unbalanced)"""
+    with np.load(permut_plan_file) as data:
+        return {"labels": data["labels"], "seeds": data["seeds"].tolist(),
+                "group_sizes": data["group_sizes"].tolist(),
+                "unbalanced": bool(data["unbalanced"])}
 
-    signif_mat = np.zeros((N, N), dtype='int')
-    p_val_mat = np.zeros((N, N), dtype='float')
-    r_stat_mat = np.zeros((N, N), dtype='float')
 
-    s_i = np.array(np_list_diff[:, 0], dtype=int)
-    s_j = np.array(np_list_diff[:, 1], dtype=int)
+def return_pooled_labels(permut_plan):
+    """
+    group label of each pooled unit (all groups concatenated) for each seed
+    (nb_seeds, nb_pooled); for balanced plans, unit s of group g goes to
+    group (g - shift) % nb_groups
+    """
+    labels = np.asarray(permut_plan["labels"], dtype=int)
 
-    signif_mat[s_i, s_j] = np_list_diff[:, 3].astype(int)
-    signif_mat[s_j, s_i] = np_list_diff[:, 3].astype(int)
+    if permut_plan["unbalanced"]:
+        return labels
 
-    p_val_mat[s_i, s_j] = p_val_mat[s_j, s_i] = np_list_diff[:, 2]
-    r_stat_mat[s_i, s_j] = r_stat_mat[s_j, s_i] = np_list_diff[:, 4]
+    nb_groups = len(permut_plan["group_sizes"])
 
-    print(r_stat_mat)
+    orig_groups = np.arange(nb_groups)[np.newaxis, :, np.newaxis]
 
-    return signif_mat, p_val_mat, r_stat_mat
+    return ((orig_groups - labels[:, np.newaxis, :]) % nb_groups).reshape(
+        labels.shape[0], -1)
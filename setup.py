@@ -11,7 +11,8 @@ setup(
     author="David Meunier",
     description="Graph analysis for neuropycon (using nipype, and ephypype); based on previous packages dmgraphanalysis and then dmgraphanalysis_nodes and graphpype",
     lisence='BSD 3',
-    install_requires=['numpy>=1.3.0',
+    python_requires='>=3.7',
+    install_requires=['numpy>=1.17.0',
                       'statsmodels==0.8.0',
                       'patsy',
                       'nipype',